@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+角色 Bot 設定模組
+由角色目錄中同一份 system 快照建立不可變的 Bot 設定，權限 ID 預先轉為整數集合，配置內容變更時整個替換
+"""
+
+import hashlib
+import json
+from collections.abc import Mapping
+from typing import Any, FrozenSet, Iterable, Optional
+from character_catalog import CharacterView, EMPTY_MAPPING, character_catalog, thaw
+
+
+def normalize_ids(values: Optional[Iterable[Any]]) -> FrozenSet[int]:
+    """將 Firestore 中的 Discord ID（字串或數字）轉為整數集合，忽略無效的值"""
+    ids = set()
+    for value in values or ():
+        if isinstance(value, str):
+            if value.strip().isdigit():
+                ids.add(int(value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            ids.add(int(value))
+    return frozenset(ids)
+
+
+class BotConfig:
+    """單一角色 Bot 的不可變設定（空的 ID 集合表示不限制）"""
+    __slots__ = ('character_id', 'system', 'enable_dm', 'allowed_guild_ids', 'allowed_channel_ids',
+                 'allowed_dm_user_ids', 'burst_coalescing', 'intro', 'version')
+
+    def __init__(self, character_id: str, system: Optional[Mapping]):
+        settings = system if system is not None else EMPTY_MAPPING
+        values = {
+            'character_id': character_id,
+            'system': system,  # 建立設定的 system 視圖，用來判斷角色目錄是否已更新
+            'enable_dm': bool(settings.get('enable_dm', False)),
+            'allowed_guild_ids': normalize_ids(settings.get('allowed_guilds')),
+            'allowed_channel_ids': normalize_ids(settings.get('allowed_channels')),
+            'allowed_dm_user_ids': normalize_ids(settings.get('allowed_dm_users')),
+            'burst_coalescing': settings.get('burst_coalescing', EMPTY_MAPPING),
+            'intro': settings.get('intro'),
+        }
+        values['version'] = self._compute_version(values)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"BotConfig 不可修改（{name}）")
+
+    @classmethod
+    def from_view(cls, character_id: str, view: Optional[CharacterView]) -> "BotConfig":
+        return cls(character_id, view.system if view else None)
+
+    @classmethod
+    def load(cls, character_id: str) -> "BotConfig":
+        """從共用角色目錄的快照建立設定"""
+        return cls.from_view(character_id, character_catalog.get(character_id))
+
+    @staticmethod
+    def _compute_version(values: dict) -> str:
+        """正規化後欄位的內容雜湊；角色目錄重新載入但內容相同時版本不變"""
+        content = {
+            'exists': values['system'] is not None,
+            'enable_dm': values['enable_dm'],
+            'allowed_guild_ids': sorted(values['allowed_guild_ids']),
+            'allowed_channel_ids': sorted(values['allowed_channel_ids']),
+            'allowed_dm_user_ids': sorted(values['allowed_dm_user_ids']),
+            'burst_coalescing': thaw(values['burst_coalescing']),
+            'intro': thaw(values['intro']),
+        }
+        text = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=6).hexdigest()
+
+    def allows_dm_user(self, user_id: int) -> bool:
+        return not self.allowed_dm_user_ids or user_id in self.allowed_dm_user_ids
+
+    def allows_guild_channel(self, guild_id: int, channel_id: int) -> bool:
+        return ((not self.allowed_channel_ids or channel_id in self.allowed_channel_ids)
+                and (not self.allowed_guild_ids or guild_id in self.allowed_guild_ids))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+頻道訊息合併排程模組
+閒置頻道的訊息立即生成；生成進行中或剛結束時到達的多則訊息合併為一次生成，並確保每個頻道同時只有一個生成在進行
+"""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List
+
+# 常數定義
+DEFAULT_BURST_CONFIG = {
+    'window_ms': 1200,  # 生成結束後多久內到達的訊息會等到視窗結束再合併生成
+    'max_batch': 5,     # 單次生成最多合併的訊息數
+}
+
+
+class ChannelBurstScheduler:
+    """單一角色的頻道排程器（每個 CharacterBot 一個實例，只在該 Bot 的事件迴圈上使用）"""
+
+    def __init__(self, handler: Callable[[int, List], Awaitable[None]], window_ms: int = DEFAULT_BURST_CONFIG['window_ms'],
+                 max_batch: int = DEFAULT_BURST_CONFIG['max_batch']):
+        self.handler = handler
+        self.window = window_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._queues: Dict[int, List] = {}  # {channel_id: [message]}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._finished_at: Dict[int, float] = {}  # {channel_id: 上一次生成結束的時間}
+        self.batches = 0
+        self.merged_messages = 0
+
+    def submit(self, message):
+        """排入觸發回應的訊息；該頻道沒有進行中的生成時啟動處理"""
+        channel_id = message.channel.id
+        self._queues.setdefault(channel_id, []).append(message)
+        worker = self._workers.get(channel_id)
+        if worker is None or worker.done():
+            self._workers[channel_id] = asyncio.create_task(self._drain(channel_id))
+
+    def _prune_finished(self):
+        """移除視窗已結束的生成結束時間"""
+        now = time.monotonic()
+        for channel_id in [cid for cid, finished_at in self._finished_at.items() if now - finished_at >= self.window]:
+            del self._finished_at[channel_id]
+
+    def pending_count(self, channel_id: int) -> int:
+        """頻道中等待處理的訊息數"""
+        return len(self._queues.get(channel_id, []))
+
+    async def _drain(self, channel_id: int):
+        """依序處理頻道佇列；閒置頻道立即處理，生成期間到達的訊息在生成結束後立即合併處理"""
+        try:
+            # 上一次生成剛結束時等到視窗結束，讓緊接著的後續訊息一起處理
+            finished_at = self._finished_at.pop(channel_id, None)
+            if finished_at is not None:
+                remaining = self.window - (time.monotonic() - finished_at)
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+
+            while self._queues.get(channel_id):
+                queue = self._queues.pop(channel_id, [])
+                batch, rest = queue[:self.max_batch], queue[self.max_batch:]
+                if rest:
+                    self._queues[channel_id] = rest
+
+                self.batches += 1
+                self.merged_messages += len(batch) - 1
+                try:
+                    await self.handler(channel_id, batch)
+                except Exception as e:
+                    print(f"❌ 處理頻道 {channel_id} 的訊息時發生錯誤：{e}")
+                self._finished_at[channel_id] = time.monotonic()
+            self._prune_finished()
+        finally:
+            if self._workers.get(channel_id) is asyncio.current_task():
+                del self._workers[channel_id]
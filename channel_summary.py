@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+頻道滾動摘要模組
+頻道每累積一定數量的新訊息，就在背景以便宜的模型把新訊息併入既有摘要，
+提示詞改用「摘要 + 少量原始訊息」取代冗長的原始對話記錄
+"""
+
+import asyncio
+import threading
+from typing import Dict, Optional, Set, Tuple
+import google.generativeai as genai
+from firebase_utils import firebase_manager
+from group_conversation_tracker import CONTEXT_LIMIT, get_channel_summary, get_entries_between, get_log_position, set_channel_summary
+from llm_scheduler import llm_scheduler, LLMSchedulerOverloaded, LANE_BACKGROUND
+from usage_tracker import usage_tracker
+
+# 常數定義
+SUMMARY_PROMPT_TYPE = 'channel_summary'  # prompt/channel_summary：content、model 與 rolling 設定
+DEFAULT_SUMMARY_MODEL = 'gemini-2.0-flash'
+DEFAULT_SUMMARY_PROMPT = (
+    "以下是一個 Discord 群組頻道的先前摘要與之後的新對話。"
+    "請將新對話併入摘要，保留參與者、正在討論的話題、重要的事實與尚未解決的問題，"
+    "省略寒暄與重複內容。只輸出更新後的摘要，使用繁體中文，不超過 {max_chars} 字。"
+)
+DEFAULT_ROLLING_CONFIG = {
+    'enabled': True,
+    'every_messages': 8,     # 累積多少則尚未摘要的訊息後更新摘要
+    'raw_tail': 3,           # 提示詞中至少保留的最近原始訊息數（這些訊息不會併入摘要）
+    'max_chars': 400,        # 摘要長度上限
+}
+
+
+class ChannelSummarizer:
+    """頻道滾動摘要的排程與生成（所有角色共用，每個頻道同時只有一個更新工作）"""
+
+    def __init__(self):
+        self.firebase = firebase_manager
+        self._running: Set[int] = set()
+        self._lock = threading.Lock()  # 各角色 Bot 在不同執行緒的事件迴圈中呼叫
+        self.updates = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def get_config(self) -> dict:
+        """從 prompt/channel_summary 的 rolling 欄位讀取設定"""
+        config = DEFAULT_ROLLING_CONFIG.copy()
+        config.update(self.firebase.get_firestore_field(
+            collection='prompt',
+            document=SUMMARY_PROMPT_TYPE,
+            field='rolling',
+            default={},
+            cache_key="channel_summary_rolling",
+            show_load_message=False
+        ) or {})
+        # 新訊息需在環狀緩衝區丟棄前併入摘要
+        config['every_messages'] = max(1, min(config['every_messages'], CONTEXT_LIMIT - config['raw_tail']))
+        return config
+
+    def claim(self, channel_id: int) -> bool:
+        """頻道累積足夠新訊息且沒有進行中的更新時，登記一次更新並返回 True"""
+        config = self.get_config()
+        if not config['enabled']:
+            return False
+        summary = get_channel_summary(channel_id)
+        covered = summary[1] if summary else 0
+        if get_log_position(channel_id) - config['raw_tail'] - covered < config['every_messages']:
+            return False
+        with self._lock:
+            if channel_id in self._running:
+                return False
+            self._running.add(channel_id)
+            return True
+
+    async def update(self, channel_id: int, character_id: Optional[str] = None):
+        """將新訊息併入頻道摘要（需先以 claim 登記）"""
+        try:
+            config = self.get_config()
+            summary = get_channel_summary(channel_id)
+            previous, covered = summary if summary else ("", 0)
+            end = get_log_position(channel_id) - config['raw_tail']
+            entries = get_entries_between(channel_id, covered, end)
+            if not entries:
+                return
+
+            base_prompt, model_name = self.firebase.get_prompt_with_model(SUMMARY_PROMPT_TYPE)
+            if not base_prompt.strip():
+                base_prompt = DEFAULT_SUMMARY_PROMPT
+            try:
+                base_prompt = base_prompt.format(max_chars=config['max_chars'])
+            except (KeyError, IndexError) as e:
+                print(f"❌ channel_summary prompt 中使用了不存在的變數：{e}")
+            lines = "\n".join(f"{entry.user_name}：{entry.message}" for entry in entries)
+            prompt = f"{base_prompt}\n\n先前摘要：\n{previous or '（無）'}\n\n新的對話：\n{lines}"
+
+            model = genai.GenerativeModel(model_name or DEFAULT_SUMMARY_MODEL)  # type: ignore
+            async with llm_scheduler.slot(LANE_BACKGROUND, character_id):
+                response = await asyncio.to_thread(model.generate_content, prompt)
+            usage_tracker.record(SUMMARY_PROMPT_TYPE, model_name or DEFAULT_SUMMARY_MODEL,
+                                 getattr(response, 'usage_metadata', None), character_id)
+            text = response.text.strip() if response.text else ""
+            if self.firebase.is_empty_response(text):
+                self.failures += 1
+                return
+
+            set_channel_summary(channel_id, text[:config['max_chars']], end)
+            self.updates += 1
+            print(f"📝 頻道 {channel_id} 的滾動摘要已更新（併入 {len(entries)} 則訊息）")
+
+        except LLMSchedulerOverloaded:
+            # 過載時放棄，下一則訊息到達時會再嘗試
+            self.dropped += 1
+        except Exception as e:
+            self.failures += 1
+            self.firebase.log_error(f"更新頻道 {channel_id} 的滾動摘要", e)
+        finally:
+            with self._lock:
+                self._running.discard(channel_id)
+
+    def get_prompt_context(self, channel_id: int) -> Optional[Tuple[str, int]]:
+        """提示詞使用的摘要與需附上的原始訊息數（尚未併入摘要的訊息，至少 raw_tail 則）；停用或尚未生成時返回 None"""
+        config = self.get_config()
+        if not config['enabled']:
+            return None
+        summary = get_channel_summary(channel_id)
+        if not summary:
+            return None
+        text, covered = summary
+        return text, max(config['raw_tail'], get_log_position(channel_id) - covered)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'updates': self.updates, 'failures': self.failures, 'dropped': self.dropped, 'running': len(self._running)}
+
+
+# 全域頻道摘要實例
+channel_summarizer = ChannelSummarizer()
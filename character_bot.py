@@ -11,6 +11,15 @@ from firebase_utils import firebase_manager
 from character_registry_custom import CharacterRegistry
 import memory
 from emoji_responses import smart_emoji_manager
+from memory_consolidation import start_consolidation_scheduler
+from usage_tracker import usage_scope
+from rate_limiter import rate_limiter
+from channel_scheduler import ChannelBurstScheduler, DEFAULT_BURST_CONFIG
+from typing_prefetch import typing_prefetcher
+from bot_config import BotConfig
+from character_catalog import character_catalog
+from group_conversation_tracker import ensure_channel_restored, is_active_user, record_message
+from channel_summary import channel_summarizer
 from typing import List, Optional, Dict
 
 class CharacterBot:
@@ -28,6 +37,8 @@ class CharacterBot:
         # 先註冊角色，再取得角色名稱
         self.character_registry.register_character(self.character_id)
         self.character_name = self._get_character_name()
+        # 預先解析記憶處理使用的角色名稱
+        memory.preload_character_name(self.character_id)
 
         # 使用統一的 Firebase 管理器
         self.firebase = firebase_manager
@@ -46,21 +57,26 @@ class CharacterBot:
         # 載入環境變數
         self.token = os.getenv(token_env_var)
         
-        # 權限設定 - 從 Firestore 讀取（使用字串處理 Discord ID）
-        self.allowed_guild_ids = self._get_character_permission_from_firestore("allowed_guilds")
-        self.allowed_channel_ids = self._get_character_permission_from_firestore("allowed_channels")
-        # 新增：私訊權限設定
-        self.allowed_dm_users = self._get_character_permission_from_firestore("allowed_dm_users")
-        self.enable_dm = self._get_dm_enable_setting()
+        # 權限與私訊設定：由角色目錄中同一份 system 快照建立不可變設定（Discord ID 已轉為整數集合）
+        self.config = BotConfig.load(self.character_id)
+        self._config_system = self.config.system  # 上次檢查的角色目錄 system 視圖
+        if self.config.system is None:
+            self.firebase.log_error(f"查找 {self.character_id} 系統配置", "找不到系統配置")
         
         # 顯示簡化的權限設定
-        guild_count = len(self.allowed_guild_ids)
-        channel_count = len(self.allowed_channel_ids)
-        dm_users_count = len(self.allowed_dm_users)
-        dm_status = "啟用" if self.enable_dm else "停用"
+        guild_count = len(self.config.allowed_guild_ids)
+        channel_count = len(self.config.allowed_channel_ids)
+        dm_users_count = len(self.config.allowed_dm_user_ids)
+        dm_status = "啟用" if self.config.enable_dm else "停用"
         print(f"🔐 {self.character_name}: {guild_count} 個伺服器，{channel_count} 個頻道")
         print(f"💬 {self.character_name}: 私訊功能 {dm_status}，{dm_users_count} 個授權使用者")
         
+        # 背景工作（表情符號回應）的參照，避免工作在完成前被回收
+        self._background_tasks = set()
+        
+        # 頻道訊息合併排程（同一頻道同時只有一個生成在進行）
+        self.burst_scheduler = ChannelBurstScheduler(self._handle_batch, **self._get_burst_config())
+        
         # 設定事件處理器和指令
         self._setup_events_and_commands()
     
@@ -73,9 +89,96 @@ class CharacterBot:
         """取得角色名稱"""
         return self.character_registry.get_character_setting(self.character_id, 'name', self.character_id)
     
+    def _get_config(self) -> BotConfig:
+        """目前的 Bot 設定；角色目錄換上新的 system 視圖時重新建立，內容版本不同才替換"""
+        config = self.config
+        view = character_catalog.get(self.character_id)
+        system = view.system if view else None
+        if system is not self._config_system:
+            # 角色目錄每次 TTL 重新載入都會產生新的視圖，只比較視圖是否為同一物件會在內容未變時重複替換
+            self._config_system = system
+            updated = BotConfig.from_view(self.character_id, view)
+            if updated.version != config.version:
+                config = self.config = updated
+                print(f"🔄 {self.character_name} 的 Bot 設定已更新（版本 {config.version}）")
+        return config
+    
+    def _get_burst_config(self) -> dict:
+        """從 system.burst_coalescing 讀取訊息合併設定"""
+        config = DEFAULT_BURST_CONFIG.copy()
+        overrides = self.config.burst_coalescing
+        config.update({key: overrides[key] for key in config if key in overrides})
+        return config
+    
+    async def _handle_batch(self, channel_id: int, messages: List[discord.Message]):
+        """處理頻道排程器合併後的一批訊息"""
+        message = messages[-1]
+        for author_id in {str(incoming.author.id) for incoming in messages}:
+            typing_prefetcher.consume(self.character_id, author_id)
+            typing_prefetcher.remember_user(self.character_id, author_id)
+        
+        # Typing 狀態處理
+        typing_task = None
+        async def maintain_typing():
+            try:
+                while True:
+                    async with message.channel.typing():
+                        await asyncio.sleep(8)
+            except asyncio.CancelledError:
+                pass
+        
+        typing_task = asyncio.create_task(maintain_typing())
+        await asyncio.sleep(0.1)
+        
+        try:
+            # 此批訊息觸發的 Gemini 用量歸屬到角色、最後發言的使用者與伺服器
+            guild_id = str(message.guild.id) if message.guild else None
+            with usage_scope(self.character_id, str(message.author.id), guild_id):
+                await self.character_registry.handle_messages(
+                    messages, self.character_id, self.client, self.proactive_keywords, self.gemini_config
+                )
+        finally:
+            if typing_task and not typing_task.done():
+                typing_task.cancel()
+                try:
+                    await typing_task
+                except asyncio.CancelledError:
+                    pass
+    
+    def _can_prefetch(self, channel, user) -> bool:
+        """輸入中的使用者是否位於允許的頻道或私訊，且曾與角色對話或近期在頻道中活躍"""
+        config = self._get_config()
+        guild = getattr(channel, 'guild', None)
+        if guild is None:
+            if not (config.enable_dm and config.allows_dm_user(user.id)):
+                return False
+        elif not config.allows_guild_channel(guild.id, channel.id):
+            return False
+        
+        if typing_prefetcher.is_known_user(self.character_id, str(user.id)):
+            return True
+        return is_active_user(self.character_id, channel.id, user.id, 30)
+    
     async def _check_emoji_response(self, message) -> Optional[str]:
         """檢查是否需要回應表情符號"""
         return smart_emoji_manager.get_emoji_response(self.character_id, message.content, message.guild)
+    
+    def _spawn(self, coro) -> asyncio.Task:
+        """建立背景工作並保留參照"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    async def _react_with_emoji(self, message):
+        """依關鍵字對訊息加上表情符號"""
+        emoji_response = await self._check_emoji_response(message)
+        if emoji_response:
+            try:
+                await message.add_reaction(emoji_response)
+                print(f"😊 {self.character_id} 對關鍵字回應表情符號: {emoji_response}")
+            except Exception as e:
+                self.firebase.log_error("添加表情符號", e)
 
     def _setup_events_and_commands(self):
         """設定事件處理器與斜線指令"""
@@ -88,6 +191,9 @@ class CharacterBot:
         @self.client.event
         async def on_ready():
             print(f'🤖 {self.character_id} Bot 已成功登入為 {self.client.user}')
+            
+            # 啟動背景記憶統整排程
+            start_consolidation_scheduler(self.character_id)
 
             try:
                 synced = await self.client.tree.sync()
@@ -103,21 +209,45 @@ class CharacterBot:
         async def on_resumed():
             print(f'✅ {self.character_name} Bot 連線已恢復')
 
+        @self.client.event
+        async def on_guild_emojis_update(guild, before, after):
+            # 伺服器 emoji 變更時重建快照，挑選 emoji 時不需每則訊息重新建立串列
+            smart_emoji_manager.update_guild_emojis(guild, after)
+        
+        @self.client.event
+        async def on_guild_remove(guild):
+            smart_emoji_manager.forget_guild(guild)
+        
+        @self.client.event
+        async def on_typing(channel, user, when):
+            # 使用者開始輸入時預先載入記憶與配置，讓稍後的訊息直接命中快取
+            if user.bot or not self._can_prefetch(channel, user):
+                return
+            user_id = str(user.id)
+            if not typing_prefetcher.begin(self.character_id, user_id):
+                return
+            _, seconds = await asyncio.gather(
+                memory.prefetch_response_config(self.character_id),
+                memory.prefetch_user_memories(self.character_id, user_id)
+            )
+            typing_prefetcher.finish(self.character_id, user_id, seconds)
+
         @self.client.event
         async def on_message(message):
             # 忽略 Bot 自己的訊息
             if message.author == self.client.user:
                 return
             
-            # 權限檢查改進版
+            # 權限檢查（整數 ID 集合查詢）
+            config = self._get_config()
             # 檢查是否為私訊
             if message.guild is None:  # 私訊
                 # 檢查是否啟用私訊功能
-                if not self.enable_dm:
+                if not config.enable_dm:
                     return
                 
                 # 檢查使用者是否在允許私訊的名單中
-                if self.allowed_dm_users and str(message.author.id) not in self.allowed_dm_users:
+                if not config.allows_dm_user(message.author.id):
                     # 可選：向未授權的使用者發送提示訊息
                     try:
                         await message.author.send("❌ 抱歉，您沒有私訊權限。")
@@ -126,21 +256,28 @@ class CharacterBot:
                     return
             
             else:  # 伺服器訊息
-                # 原有的頻道和伺服器權限檢查
-                if self.allowed_channel_ids and str(message.channel.id) not in self.allowed_channel_ids:
-                    return
-                if self.allowed_guild_ids and str(message.guild.id) not in self.allowed_guild_ids:
+                # 頻道和伺服器權限檢查
+                if not config.allows_guild_channel(message.guild.id, message.channel.id):
                     return
             
-            # 檢查表情符號回應
-            emoji_response = await self._check_emoji_response(message)
-            if emoji_response:
-                try:
-                    await message.add_reaction(emoji_response)
-                    print(f"😊 {self.character_id} 對關鍵字回應表情符號: {emoji_response}")
-                except Exception as e:
-                    self.firebase.log_error("添加表情符號", e)
-                # 不 return，讓程式繼續處理文字回應
+            # 伺服器中所有允許的訊息（包含其他角色 Bot 的發言）都寫入共用的頻道事件記錄，同一則訊息只記錄一次；
+            # 啟動後頻道的第一則訊息先還原重啟前的記錄。私訊不寫入共用記錄，也不送去生成摘要
+            if message.guild is not None:
+                await ensure_channel_restored(message.channel.id)
+                record_message(
+                    message.channel.id,
+                    message.id,
+                    message.author.id,
+                    message.author.display_name,
+                    message.clean_content,
+                    is_bot=message.author.bot,
+                )
+                # 頻道累積足夠新訊息時在背景更新滾動摘要（同一頻道只會由一個 Bot 執行）
+                if channel_summarizer.claim(message.channel.id):
+                    self._spawn(channel_summarizer.update(message.channel.id, self.character_id))
+            
+            # 表情符號回應與文字回應互不相依，在背景進行不阻塞後續流程
+            self._spawn(self._react_with_emoji(message))
             
             # 檢查是否需要回應
             should_respond = await self.character_registry.should_respond(
@@ -150,30 +287,18 @@ class CharacterBot:
             if not should_respond:
                 return
             
-            # Typing 狀態處理... (您的原始邏輯)
-            typing_task = None
-            async def maintain_typing():
-                try:
-                    while True:
-                        async with message.channel.typing():
-                            await asyncio.sleep(8)
-                except asyncio.CancelledError:
-                    pass
-            
-            typing_task = asyncio.create_task(maintain_typing())
-            await asyncio.sleep(0.1)
+            # 速率限制：超過使用者／頻道／伺服器限制的訊息直接略過，不進入生成流程
+            if not rate_limiter.allow(
+                self.character_id,
+                str(message.author.id),
+                str(message.channel.id),
+                str(message.guild.id) if message.guild else None,
+            ):
+                print(f"🚦 {self.character_name} 略過超過速率限制的訊息：{message.author.display_name}")
+                return
             
-            try:
-                await self.character_registry.handle_message(
-                    message, self.character_id, self.client, self.proactive_keywords, self.gemini_config
-                )
-            finally:
-                if typing_task and not typing_task.done():
-                    typing_task.cancel()
-                    try:
-                        await typing_task
-                    except asyncio.CancelledError:
-                        pass
+            # 交給頻道排程器：短時間內的多則訊息合併為一次生成
+            self.burst_scheduler.submit(message)
         
         # --- 斜線指令 ---
         
@@ -231,12 +356,10 @@ class CharacterBot:
         async def character_intro(interaction: discord.Interaction):
             # 從 Firestore 讀取角色簡介
             try:
-                system_ref = self.db.collection(self.character_id).document('system')
-                system_doc = system_ref.get()
+                config = self._get_config()
                 
-                if system_doc.exists:
-                    system_config = system_doc.to_dict()
-                    intro_text = system_config.get('intro', '暫無角色簡介')
+                if config.system:
+                    intro_text = config.intro if config.intro is not None else '暫無角色簡介'
                 else:
                     intro_text = '❌ 找不到系統配置'
                 
@@ -254,61 +377,6 @@ class CharacterBot:
                     ephemeral=True
                 )
         
-    def _get_character_permission_from_firestore(self, permission_field: str) -> List[str]:
-        """從 Firestore 取得角色權限設定（使用字串處理 Discord ID）"""
-        if not self.db:
-            self.firebase.log_error(f"讀取 {self.character_id} 權限設定", "Firestore 未連接")
-            return []
-        
-        try:
-            # 從 Firestore 讀取系統配置
-            system_ref = self.db.collection(self.character_id).document('system')
-            system_doc = system_ref.get()
-            
-            if system_doc.exists:
-                system_config = system_doc.to_dict()
-                firestore_permissions = system_config.get(permission_field, [])
-                
-                # 將所有 Discord ID 轉換為字串，避免數字精度問題
-                processed_permissions = []
-                for x in firestore_permissions:
-                    if isinstance(x, str):
-                        # 如果是字串，直接使用
-                        if x.isdigit():
-                            processed_permissions.append(x)
-                    elif isinstance(x, (int, float)):
-                        # 如果是數字，轉換為字串
-                        processed_permissions.append(str(int(x)))
-                
-                return processed_permissions
-            else:
-                self.firebase.log_error(f"查找 {self.character_id} 系統配置", "找不到系統配置")
-                return []
-                
-        except Exception as e:
-            self.firebase.log_error(f"從 Firestore 讀取 {self.character_id} 權限", e)
-            return []
-        
-    def _get_dm_enable_setting(self) -> bool:
-        """從 Firestore 取得私訊功能啟用設定"""
-        if not self.db:
-            self.firebase.log_error(f"讀取 {self.character_id} 私訊功能設定", "Firestore 未連接")
-            return False
-        
-        try:
-            system_ref = self.db.collection(self.character_id).document('system')
-            system_doc = system_ref.get()
-            
-            if system_doc.exists:
-                system_config = system_doc.to_dict()
-                return system_config.get('enable_dm', False) # 預設為 False
-            else:
-                self.firebase.log_error(f"查找 {self.character_id} 系統配置", "找不到系統配置")
-                return False
-        except Exception as e:
-            self.firebase.log_error(f"從 Firestore 讀取 {self.character_id} 私訊功能設定", e)
-            return False
-        
     def run(self):
         """運行 Bot"""
         if not self.token:
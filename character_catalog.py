@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+角色資料目錄模組
+以單次批次讀取載入所有角色的 profile、system 與 emoji_system 文件，提供所有 Bot 共用的唯讀視圖
+"""
+
+import threading
+import time
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set
+from firebase_utils import firebase_manager
+
+# 常數定義
+CATALOG_DOCUMENTS = ('profile', 'system', 'emoji_system')
+CATALOG_TTL = 300  # 與 Firebase 管理器的快取時間相同，配置變更後最多 5 分鐘生效
+FAILURE_BACKOFF = 30  # 讀取失敗後多久內不再重試（秒），避免每則訊息都阻塞在 Firestore 上
+EMPTY_MAPPING = MappingProxyType({})
+
+
+def freeze(value: Any) -> Any:
+    """將 Firestore 資料轉為唯讀結構（dict → MappingProxyType、list → tuple）"""
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """將唯讀結構轉回可修改的 dict / list（寫回 Firestore 或序列化時使用）"""
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+
+class CharacterView(NamedTuple):
+    """單一角色的唯讀資料視圖；文件不存在時為 None"""
+    character_id: str
+    profile: Optional[Mapping]
+    system: Optional[Mapping]
+    emoji_system: Optional[Mapping]
+    loaded_at: float
+
+    @property
+    def enabled(self) -> bool:
+        return self.system is not None and bool(self.system.get('enabled', True))
+
+
+class CharacterCatalog:
+    """所有角色 Bot 共用的角色資料目錄"""
+
+    def __init__(self, ttl: float = CATALOG_TTL):
+        self.firebase = firebase_manager
+        self.ttl = ttl
+        self._views: Dict[str, CharacterView] = {}
+        self._lock = threading.Lock()  # 各角色 Bot 在不同執行緒中讀取
+        self._refreshing: Set[str] = set()  # 背景重新讀取中的角色
+        self._retry_after: Dict[str, float] = {}  # {character_id: 讀取失敗後可再次嘗試的時間}
+        self.batch_reads = 0
+        self.background_refreshes = 0
+
+    @property
+    def db(self):
+        """獲取 Firestore 資料庫實例"""
+        return self.firebase.db
+
+    def load(self, character_ids: Iterable[str]) -> List[str]:
+        """以單次 get_all 批次讀取多個角色的所有文件，返回有 system 文件的角色 ID"""
+        character_ids = list(dict.fromkeys(character_ids))
+        if not character_ids or not self.db:
+            return []
+
+        refs = [self.db.collection(character_id).document(document)
+                for character_id in character_ids for document in CATALOG_DOCUMENTS]
+        documents: Dict[str, Dict[str, Optional[dict]]] = {character_id: {} for character_id in character_ids}
+        try:
+            for snapshot in self.db.get_all(refs):
+                character_id = snapshot.reference.parent.id
+                documents[character_id][snapshot.reference.id] = snapshot.to_dict() if snapshot.exists else None
+        except Exception as e:
+            self.firebase.log_error(f"批次讀取 {len(character_ids)} 個角色的資料", e)
+            retry_after = time.monotonic() + FAILURE_BACKOFF
+            with self._lock:
+                self._retry_after.update((character_id, retry_after) for character_id in character_ids)
+            return []
+
+        now = time.monotonic()
+        views = {
+            character_id: CharacterView(
+                character_id,
+                *(freeze(docs[document]) if docs.get(document) is not None else None for document in CATALOG_DOCUMENTS),
+                now,
+            )
+            for character_id, docs in documents.items()
+        }
+        with self._lock:
+            self._views.update(views)
+            for character_id in views:
+                self._retry_after.pop(character_id, None)
+            self.batch_reads += 1
+        if len(views) > 1:
+            print(f"📚 角色目錄已載入 {len(views)} 個角色（{len(refs)} 份文件，1 次批次讀取）")
+        return [character_id for character_id, view in views.items() if view.system is not None]
+
+    def get(self, character_id: str) -> Optional[CharacterView]:
+        """獲取角色視圖
+
+        文件不存在時視圖中的欄位為 None，同樣快取到 TTL 為止（不會每次都重新讀取）。
+        超過 TTL 時先返回舊視圖並在背景重新讀取；尚未載入時才同步讀取，讀取失敗後 FAILURE_BACKOFF 秒內不再重試。
+        """
+        view = self._views.get(character_id)
+        now = time.monotonic()
+        if view is not None:
+            if now - view.loaded_at > self.ttl:
+                self._refresh_in_background(character_id)
+            return view
+        if now < self._retry_after.get(character_id, 0):
+            return None
+        self.load([character_id])
+        return self._views.get(character_id)
+
+    def _refresh_in_background(self, character_id: str):
+        with self._lock:
+            if character_id in self._refreshing:
+                return
+            self._refreshing.add(character_id)
+            self.background_refreshes += 1
+
+        def refresh():
+            try:
+                self.load([character_id])
+            finally:
+                with self._lock:
+                    self._refreshing.discard(character_id)
+
+        threading.Thread(target=refresh, name=f'catalog-refresh-{character_id}', daemon=True).start()
+
+    def get_profile(self, character_id: str) -> Optional[Mapping]:
+        view = self.get(character_id)
+        return view.profile if view else None
+
+    def get_system(self, character_id: str) -> Mapping:
+        """角色的 system 設定；文件不存在時返回空的唯讀映射"""
+        view = self.get(character_id)
+        return view.system if view and view.system is not None else EMPTY_MAPPING
+
+    def get_emoji_config(self, character_id: str) -> Optional[Mapping]:
+        view = self.get(character_id)
+        return view.emoji_system if view else None
+
+    def replace_document(self, character_id: str, document: str, data: Optional[dict]):
+        """寫入 Firestore 成功後以新內容替換視圖中的文件，不需重新讀取"""
+        with self._lock:
+            view = self._views.get(character_id)
+            if view is not None:
+                self._views[character_id] = view._replace(**{document: freeze(data) if data is not None else None})
+
+    def refresh(self, character_id: Optional[str] = None) -> List[str]:
+        """重新讀取單一角色或所有已載入的角色"""
+        if character_id:
+            return self.load([character_id])
+        with self._lock:
+            character_ids = list(self._views)
+        return self.load(character_ids)
+
+    def character_ids(self, enabled_only: bool = True) -> List[str]:
+        """已載入的角色 ID"""
+        with self._lock:
+            return [character_id for character_id, view in self._views.items() if view.enabled or not enabled_only]
+
+
+# 全域角色目錄實例
+character_catalog = CharacterCatalog()
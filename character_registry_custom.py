@@ -1,18 +1,33 @@
 import os
 import asyncio
+import hashlib
 import json
-from typing import Dict, Optional, List
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, List, Set
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import discord
 from firebase_utils import firebase_manager
+from character_catalog import character_catalog, thaw
+from keyword_matcher import KeywordMatcher
 import memory
+from pipeline_timing import PipelineTimer, pipeline_stats
+
+class CompiledPersona(NamedTuple):
+    """預先編譯的角色設定提示詞區塊"""
+    text: str
+    version: str  # 內容雜湊，設定變更時隨之改變
+
 
 class CharacterRegistry:
     """簡化的角色註冊器 - 專注於角色設定管理"""
     
     def __init__(self):
-        self.characters: Dict[str, dict] = {}
+        self.characters: Dict[str, Mapping] = {}  # {character_id: 角色目錄的唯讀 profile 視圖}
+        self.personas: Dict[str, CompiledPersona] = {}  # {character_id: 預先編譯的角色設定}
+        self._profile_sources: Dict[str, Mapping] = {}  # {character_id: 編譯時使用的角色目錄 profile 視圖}
+        self._keyword_matchers: Dict[str, tuple] = {}  # {character_id: (關鍵字列表, 比對器)}
+        self._background_tasks: Set[asyncio.Task] = set()  # 回覆後在背景進行的記憶保存
         self.firebase = firebase_manager
         self.db = self.firebase.db
 
@@ -24,55 +39,86 @@ class CharacterRegistry:
             return False
         
         try:
-            # 從 character_id/profile 讀取角色設定
-            doc_ref = self.db.collection(character_id).document('profile')
-            doc = doc_ref.get()
-            
-            if doc.exists:
-                character_data = doc.to_dict()
-                if character_data:  # 確保不是 None
-                    self.characters[character_id] = character_data
-                    return True
-                else:
-                    print(f"角色 {character_id} 的設定資料為空")
-                    return False
-            else:
+            # 從共用角色目錄取得 character_id/profile 的唯讀視圖
+            character_data = character_catalog.get_profile(character_id)
+            
+            if character_data is None:
                 print(f"錯誤：在 Firestore 中找不到 {character_id}/profile")
                 return False
+            if not character_data:
+                print(f"角色 {character_id} 的設定資料為空")
+                return False
+            self._set_character_data(character_id, character_data)
+            return True
         except Exception as e:
             print(f"註冊角色 {character_id} 失敗: {e}")
             return False
     
-    def _format_character_data(self, character_data: dict) -> str:
+    def _sync_character(self, character_id: str):
+        """角色目錄在 TTL 後換上新的 profile 視圖時重新編譯（只比較視圖是否為同一物件）"""
+        if character_id not in self.personas:
+            return
+        profile = character_catalog.get_profile(character_id)
+        if profile and profile is not self._profile_sources.get(character_id):
+            self._set_character_data(character_id, profile)
+    
+    def _set_character_data(self, character_id: str, character_data: Mapping):
+        """保存角色資料視圖並預先編譯提示詞區塊（persona 缺少時以 backstory 代替）"""
+        self._profile_sources[character_id] = character_data
+        previous = self.personas.get(character_id)
+        persona = self._compile_persona(character_data)
+        if previous and previous.version == persona.version:
+            return
+        if previous:
+            print(f"🔄 {character_id} 的角色設定已更新（版本 {persona.version}）")
+        
+        settings = character_data
+        if 'persona' not in settings and settings.get('backstory'):
+            print(f"🔧 使用 backstory 作為 {settings.get('name', '未知')} 的 persona")
+            settings = MappingProxyType({**settings, 'persona': settings['backstory']})
+        
+        self.characters[character_id] = settings
+        self.personas[character_id] = persona
+        print(f"🔧 {character_data.get('name', '未知')}角色資料：{len(character_data)} 欄，總長度 {len(persona.text)} 字符（版本 {persona.version}）")
+    
+    def _compile_persona(self, character_data: Mapping) -> CompiledPersona:
+        """將角色資料編譯為精簡的提示詞區塊（去除縮排空白以節省 token）"""
+        text = self._format_character_data(character_data)
+        version = hashlib.blake2b(text.encode('utf-8'), digest_size=6).hexdigest()
+        return CompiledPersona(text, version)
+    
+    def _format_character_data(self, character_data: Mapping) -> str:
         """將角色資料格式化為字串供 AI 使用"""
         if not character_data:
             return "角色資料未載入"
         
-        # 直接將整個 profile 轉換為 JSON 格式
-        import json
+        # 直接將整個 profile 轉換為精簡的 JSON 格式
         try:
-            formatted_data = json.dumps(character_data, ensure_ascii=False, indent=2)
-            print(f"🔧 {character_data.get('name', '未知')}角色資料：{len(character_data)} 欄，總長度 {len(formatted_data)} 字符")
-            return formatted_data
+            return json.dumps(thaw(character_data), ensure_ascii=False, separators=(',', ':'), default=str)
         except Exception as e:
             print(f"❌ 格式化角色資料失敗：{e}")
             return str(character_data)
+    
+    def get_character_persona(self, character_id: str) -> str:
+        """獲取預先編譯的角色設定提示詞區塊（角色目錄更新 profile 後會重新編譯）"""
+        self._sync_character(character_id)
+        persona = self.personas.get(character_id)
+        return persona.text if persona else "角色資料未載入"
 
     def get_character_setting(self, character_id: str, setting_key: str, default_value=None):
-        """獲取角色設定"""
+        """獲取角色設定（persona 的 backstory 備援已在註冊時處理）"""
         if character_id not in self.characters:
             return default_value
-            
-        character_data = self.characters[character_id]
-        
-        # 如果請求的是 persona，但資料中沒有，則使用 backstory
-        if setting_key == 'persona' and 'persona' not in character_data:
-            backstory = character_data.get('backstory', '')
-            if backstory:
-                print(f"🔧 使用 backstory 作為 {character_data.get('name', '未知')} 的 persona")
-                return backstory
         
-        return character_data.get(setting_key, default_value)
+        return self.characters[character_id].get(setting_key, default_value)
+    
+    def _get_keyword_matcher(self, character_id: str, proactive_keywords: List[str]) -> KeywordMatcher:
+        """獲取主動關鍵字比對器；關鍵字列表換成新的設定時才重新建立"""
+        cached = self._keyword_matchers.get(character_id)
+        if cached is None or cached[0] is not proactive_keywords:
+            cached = (proactive_keywords, KeywordMatcher.from_keywords(proactive_keywords))
+            self._keyword_matchers[character_id] = cached
+        return cached[1]
     
     async def should_respond(self, message, character_id, client, proactive_keywords=None):
         """檢查是否需要回應此訊息"""
@@ -85,7 +131,7 @@ class CharacterRegistry:
             return True
         
         if proactive_keywords:
-            contains_keyword = any(keyword.lower() in message.content.lower() for keyword in proactive_keywords)
+            contains_keyword = self._get_keyword_matcher(character_id, proactive_keywords).contains_any(message.content)
         
         return mentioned or contains_keyword
     
@@ -93,12 +139,13 @@ class CharacterRegistry:
         """建構群組對話上下文 - 簡化版本"""
         try:
             from group_conversation_tracker import get_conversation_summary, get_active_users_in_channel, get_recent_conversation_context
+            from channel_summary import channel_summarizer
             
             # 獲取群組摘要
             group_summary = get_conversation_summary(character_id, channel_id)
             
             # 獲取活躍使用者
-            active_users = get_active_users_in_channel(character_id, channel_id, 30)
+            active_users = get_active_users_in_channel(character_id, channel_id, 30, limit=4)  # 可能包含目前的使用者
             other_users = [user for user in active_users if user['name'] != user_name]
             
             # 建構上下文
@@ -110,13 +157,20 @@ class CharacterRegistry:
                 other_user_names = [user['name'] for user in other_users[:3]]
                 context_parts.append(f"其他活躍使用者：{', '.join(other_user_names)}")
             
+            # 有滾動摘要時以摘要涵蓋較早的對話，只附上尚未併入摘要的最近原始訊息
+            recent_limit = 8
+            rolling_context = channel_summarizer.get_prompt_context(channel_id)
+            if rolling_context:
+                rolling_summary, recent_limit = rolling_context
+                context_parts.append(f"較早的對話摘要：{rolling_summary}")
+            
             # 獲取最近對話記錄
-            recent_context = get_recent_conversation_context(character_id, channel_id, 8)
+            recent_context = get_recent_conversation_context(character_id, channel_id, recent_limit)
             if recent_context:
                 conversation_lines = []
                 for context in recent_context:
-                    if context['message'] and len(context['message']) > 5:
-                        conversation_lines.append(f"{context['user_name']}：{context['message']}")
+                    if context.message and len(context.message) > 5:
+                        conversation_lines.append(f"{context.user_name}：{context.message}")
                 
                 if conversation_lines:
                     context_parts.append(f"最近對話記錄：\n" + "\n".join(conversation_lines))
@@ -129,17 +183,25 @@ class CharacterRegistry:
     
     async def handle_message(self, message, character_id, client, proactive_keywords=None, gemini_config=None):
         """處理角色訊息（簡化版本）"""
-        
-        user_prompt = message.content
+        return await self.handle_messages([message], character_id, client, proactive_keywords, gemini_config)
+    
+    async def handle_messages(self, messages, character_id, client, proactive_keywords=None, gemini_config=None):
+        """處理同一頻道的一批訊息，合併為一次生成並回覆最後一則"""
         
         # 檢查是否被提及，如果是則移除提及標記
-        if client.user.mentioned_in(message):
-            user_prompt = user_prompt.replace(f'<@{client.user.id}>', '').strip()
+        inputs = []
+        for incoming in messages:
+            text = incoming.content
+            if client.user.mentioned_in(incoming):
+                text = text.replace(f'<@{client.user.id}>', '').strip()
+            if text:
+                inputs.append((incoming, text))
         
         # 直接使用當前角色 ID
         persona_id = character_id
+        message = inputs[-1][0] if inputs else messages[-1]
         
-        if not user_prompt:
+        if not inputs:
             try:
                 await message.reply("「想說什麼？我在聽。」", mention_author=False)
             except discord.errors.HTTPException:
@@ -148,8 +210,11 @@ class CharacterRegistry:
                 await message.channel.send("「想說什麼？我在聽。」")
             return True
         
+        user_prompt = inputs[-1][1]
+        
         try:
-            # 獲取角色資料
+            # 獲取角色資料（角色目錄的 profile 已更新時先重新編譯）
+            self._sync_character(persona_id)
             character_data = self.characters.get(persona_id, {})
             if not character_data:
                 try:
@@ -169,58 +234,83 @@ class CharacterRegistry:
             # 追蹤使用者活動
             try:
                 from group_conversation_tracker import track_user_activity
-                track_user_activity(character_id, channel_id, message.author.id, user_name, user_prompt)
+                for incoming, text in inputs:
+                    # 私訊只保留在記憶體中，不寫回共用的頻道記錄
+                    track_user_activity(character_id, channel_id, incoming.author.id, incoming.author.display_name, text, incoming.id,
+                                        persist=message.guild is not None)
             except Exception as e:
                 print(f"追蹤使用者活動時發生錯誤: {e}")
             
-            # 格式化角色描述
-            character_persona = self._format_character_data(character_data)
-            
-            # 獲取使用者記憶
-            user_memories = memory.get_character_user_memory(persona_id, user_id)
-            
-            # 建構群組上下文（簡化）
-            group_context = self._build_group_context(character_id, channel_id, user_name)
-            
-            # 生成回應
-            response = await memory.generate_character_response(
-                bot_name, 
-                character_persona, 
-                user_memories, 
-                user_prompt, 
-                user_name,
-                group_context,
-                gemini_config,
-                character_id  # 傳遞 character_id 參數
-            )
-            
-            # 保存記憶
-            memory_content = f"{user_name} 說：{user_prompt}"
-            save_success = await memory.save_character_user_memory(persona_id, user_id, memory_content, user_name)
-            if not save_success:
-                print(f"⚠️ 記憶保存失敗：{persona_id} - {user_id}")
+            # 記憶讀取與配置解析互不相依，在工作執行緒中並行進行
+            timer = PipelineTimer()
+            memory_task = asyncio.create_task(timer.timed('記憶', memory.get_relevant_character_user_memory(persona_id, user_id, user_prompt)))
+            config_task = asyncio.create_task(timer.timed('配置', memory.prefetch_response_config(character_id)))
+            # 讓出事件迴圈一次，兩個工作先把讀取交給工作執行緒，之後的同步區塊才會與讀取重疊
+            await asyncio.sleep(0)
+            
+            # 等待期間在事件迴圈上建構角色描述與群組上下文
+            with timer.stage('上下文'):
+                character_persona = self.get_character_persona(persona_id)
+                group_context = self._build_group_context(character_id, channel_id, user_name)
+            user_memories, _ = await asyncio.gather(memory_task, config_task)
+            
+            # 生成回應（多則訊息時一次回應所有人）
+            if len(inputs) > 1:
+                print(f"🧺 {bot_name} 合併 {len(inputs)} 則訊息為一次回應")
+            with timer.stage('生成'):
+                response = await memory.generate_character_response(
+                    bot_name,
+                    character_persona,
+                    user_memories,
+                    user_prompt,
+                    user_name,
+                    group_context,
+                    gemini_config,
+                    character_id,  # 傳遞 character_id 參數
+                    is_dm=message.guild is None,
+                    is_mention=client.user.mentioned_in(message),
+                    batched_inputs=[(incoming.author.display_name, text) for incoming, text in inputs] if len(inputs) > 1 else None
+                )
+            
+            if response is None:
+                # Gemini 排程過載，安靜地放棄這次回應
+                return True
             
             # 發送回應
-            try:
-                await message.reply(response, mention_author=False)
-            except discord.errors.HTTPException as e:
-                print(f"回覆失敗，改為普通發送：{e}")
-                # 檢查是否是內容長度錯誤 (error code: 50035)
-                if "50035" in str(e) or "4000 or fewer in length" in str(e) or "2000 or fewer in length" in str(e):
-                    await message.channel.send("「抱歉，我想講的話太多了……」")
-                else:
-                    await message.channel.send(f"{message.author.mention} {response}")
-            except Exception as e:
-                print(f"回覆時發生未知錯誤：{e}")
-                await message.channel.send(f"{message.author.mention} {response}")
+            sent = None
+            with timer.stage('回覆'):
+                try:
+                    sent = await message.reply(response, mention_author=False)
+                except discord.errors.HTTPException as e:
+                    print(f"回覆失敗，改為普通發送：{e}")
+                    # 檢查是否是內容長度錯誤 (error code: 50035)
+                    if "50035" in str(e) or "4000 or fewer in length" in str(e) or "2000 or fewer in length" in str(e):
+                        await message.channel.send("「抱歉，我想講的話太多了……」")
+                    else:
+                        sent = await message.channel.send(f"{message.author.mention} {response}")
+                except Exception as e:
+                    print(f"回覆時發生未知錯誤：{e}")
+                    sent = await message.channel.send(f"{message.author.mention} {response}")
+            pipeline_stats.record(timer, bot_name)
             
             # 追蹤BOT回應
             try:
                 from group_conversation_tracker import track_bot_response
-                track_bot_response(character_id, channel_id, bot_name, response)
+                # 帶上送出訊息的 ID，其他角色 Bot 收到同一則訊息時不會重複記錄
+                track_bot_response(character_id, channel_id, bot_name, response, sent.id if sent else None,
+                                   persist=message.guild is not None)
             except Exception as e:
                 print(f"追蹤BOT回應時發生錯誤：{e}")
             
+            # 回覆送出後才在背景保存記憶（每位使用者各自保存自己說的話），記憶提取不再延遲回應
+            user_contents: Dict[str, tuple] = {}
+            for incoming, text in inputs:
+                author_id = str(incoming.author.id)
+                name, lines = user_contents.get(author_id, (incoming.author.display_name, []))
+                lines.append(text)
+                user_contents[author_id] = (name, lines)
+            self._spawn(self._save_memories(persona_id, user_contents))
+        
         except Exception as e:
             print(f"處理訊息時發生錯誤：{e}")
             try:
@@ -230,4 +320,19 @@ class CharacterRegistry:
             except Exception:
                 await message.channel.send("「抱歉，我現在有點累……」")
         
-        return True 
\ No newline at end of file
+        return True
+    
+    async def _save_memories(self, persona_id: str, user_contents: Dict[str, tuple]):
+        """保存一批訊息中每位使用者的記憶"""
+        for author_id, (name, lines) in user_contents.items():
+            memory_content = f"{name} 說：{' '.join(lines)}"
+            save_success = await memory.save_character_user_memory(persona_id, author_id, memory_content, name)
+            if not save_success:
+                print(f"⚠️ 記憶保存失敗：{persona_id} - {author_id}")
+    
+    def _spawn(self, coro) -> asyncio.Task:
+        """建立背景工作並保留參照，避免工作在完成前被回收"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
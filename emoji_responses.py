@@ -6,20 +6,45 @@
 import os
 import json
 import random
+import threading
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
 from firebase_utils import firebase_manager
+from keyword_matcher import KeywordMatcher
+from character_catalog import character_catalog, thaw
 from dotenv import load_dotenv
-from typing import Dict, Optional, List
+from typing import Any, Dict, Iterable, Mapping, NamedTuple, Optional, List, Sequence, Set, Tuple
 
 # 載入環境變數
 load_dotenv()
 
+
+class GuildEmojiSnapshot(NamedTuple):
+    """伺服器自訂 emoji 的快照（預先轉為訊息用字串，挑選時不需建立新串列）"""
+    all: Tuple[str, ...]
+    static: Tuple[str, ...]
+    animated: Tuple[str, ...]
+
+    @classmethod
+    def from_emojis(cls, emojis: Iterable) -> "GuildEmojiSnapshot":
+        static, animated = [], []
+        for emoji in emojis:
+            (animated if emoji.animated else static).append(str(emoji))
+        return cls(tuple(static + animated), tuple(static), tuple(animated))
+
+
+EMPTY_GUILD_EMOJIS = GuildEmojiSnapshot((), (), ())
+
 class SmartEmojiResponseManager:
     """表情符號回應管理器"""
     
     def __init__(self):
         self.firebase = firebase_manager
         self.db = self.firebase.db
-        self.cache = {}  # 快取表情符號配置
+        self._matchers: Dict[str, tuple] = {}  # {character_id: (配置視圖, 情感關鍵字比對器)}，配置變更時重建
+        self._missing: Set[str] = set()  # 已提示過缺少 emoji_system 的角色，避免每則訊息重複輸出
+        self._guild_emojis: Dict[int, GuildEmojiSnapshot] = {}  # {guild_id: 快照}，收到 emoji 更新事件時重建
+        self._edit_lock = threading.Lock()  # 同一程序內的配置修改依序寫入與套用
 
     
     def get_emoji_response(self, character_id: str, message_content: str, guild=None) -> Optional[str]:
@@ -27,21 +52,17 @@ class SmartEmojiResponseManager:
         if not self.db:
             return None
         
-        # 檢查快取
-        if character_id not in self.cache:
-            self._load_emoji_config(character_id)
-        
-        if character_id not in self.cache:
+        # 從共用角色目錄取得唯讀配置
+        emoji_config = self._get_emoji_config(character_id)
+        if emoji_config is None:
             return None
         
-        emoji_config = self.cache[character_id]
-        
         # 檢查是否啟用
         if not emoji_config.get('enabled', True):
             return None
         
         # 分析訊息情感
-        detected_emotion = self._analyze_emotion(message_content, emoji_config)
+        detected_emotion = self._analyze_emotion(character_id, message_content, emoji_config)
         
         # 優先使用情感對應的 emoji
         if detected_emotion:
@@ -57,197 +78,194 @@ class SmartEmojiResponseManager:
         if general_emojis and general_probability is not None and random.random() < general_probability:
             return random.choice(general_emojis)
         
-        # 如果都沒有，嘗試使用伺服器自訂 emoji
-        if guild and hasattr(guild, 'emojis'):
-            server_emojis = list(guild.emojis)
-            server_probability = emoji_config.get('server_probability')  # 必須在資料庫中設定
-            if server_emojis and server_probability is not None and random.random() < server_probability:
-                return str(random.choice(server_emojis))
+        # 如果都沒有，嘗試使用伺服器自訂 emoji（私訊時為空的快照）
+        server_emojis = self.get_guild_emojis(guild).all
+        server_probability = emoji_config.get('server_probability')  # 必須在資料庫中設定
+        if server_emojis and server_probability is not None and random.random() < server_probability:
+            return random.choice(server_emojis)
         
         return None
     
-    def _analyze_emotion(self, message_content: str, emoji_config: Dict) -> Optional[str]:
-        """分析訊息情感"""
-        content = message_content.lower()
-        trigger_keywords = emoji_config.get('trigger_keywords', {})
-        
-        # 檢查每種情感
-        for emotion, keywords in trigger_keywords.items():
-            for keyword in keywords:
-                if keyword.lower() in content:
-                    return emotion
+    def get_guild_emojis(self, guild) -> GuildEmojiSnapshot:
+        """伺服器 emoji 快照；第一次使用時建立，之後由 on_guild_emojis_update 更新（沒有伺服器時返回空的快照）"""
+        if not guild or not hasattr(guild, 'emojis'):
+            return EMPTY_GUILD_EMOJIS
+        snapshot = self._guild_emojis.get(guild.id)
+        if snapshot is None:
+            snapshot = self._guild_emojis[guild.id] = GuildEmojiSnapshot.from_emojis(guild.emojis)
+        return snapshot
+    
+    def update_guild_emojis(self, guild, emojis: Optional[Iterable] = None):
+        """伺服器 emoji 變更時重建快照（各角色 Bot 都會收到同一事件，重建結果相同）"""
+        self._guild_emojis[guild.id] = GuildEmojiSnapshot.from_emojis(guild.emojis if emojis is None else emojis)
+    
+    def forget_guild(self, guild):
+        """Bot 離開伺服器時移除快照"""
+        self._guild_emojis.pop(guild.id, None)
+    
+    def _analyze_emotion(self, character_id: str, message_content: str, emoji_config: Mapping) -> Optional[str]:
+        """分析訊息情感（依 trigger_keywords 的順序，返回第一個符合的情感）"""
+        cached = self._matchers.get(character_id)
+        if cached is None or cached[0] is not emoji_config:
+            # 角色目錄重新載入或配置更新後會換成新的視圖，此時才重建比對器
+            cached = (emoji_config, KeywordMatcher.from_mapping(emoji_config.get('trigger_keywords', {})))
+            self._matchers[character_id] = cached
         
-        return None
+        return cached[1].first_label(message_content)
     
-    def _load_emoji_config(self, character_id: str):
-        """從 Firestore 載入表情符號配置"""
+    def _get_emoji_config(self, character_id: str) -> Optional[Mapping]:
+        """從共用角色目錄取得表情符號配置的唯讀視圖
+
+        文件不存在的結果也由角色目錄快取到 TTL 為止，之後在背景重新讀取，不會每則訊息都讀取 Firestore。
+        """
         if not self.db:
             print(f"❌ Firebase 未初始化，無法載入 {character_id} 配置")
-            return
-            
-        try:
-            doc_ref = self.db.collection(character_id).document('emoji_system')
-            doc = doc_ref.get()
-            
-            if doc.exists:
-                data = doc.to_dict()
-                self.cache[character_id] = data
-                print(f"✅ 載入 {character_id} 的表情符號配置")
-            else:
+            return None
+        
+        emoji_config = character_catalog.get_emoji_config(character_id)
+        if emoji_config is None:
+            if character_id not in self._missing:
+                self._missing.add(character_id)
                 print(f"❌ {character_id} 的 emoji_system 配置不存在，請在 Firestore 中手動建立")
-                
-        except Exception as e:
-            print(f"❌ 載入 {character_id} 表情符號配置失敗: {e}")
+        else:
+            self._missing.discard(character_id)
+        return emoji_config
+    
+    def edit_emoji_config(self, character_id: str) -> "EmojiConfigEdit":
+        """開始一組表情符號配置修改，呼叫 commit() 後以單次欄位層級 update() 寫入"""
+        return EmojiConfigEdit(self, character_id)
     
     def add_emotion_keyword(self, character_id: str, emotion: str, keyword: str):
         """新增情感關鍵字"""
-        if not self.db:
-            return False
-        
-        try:
-            if character_id not in self.cache:
-                self._load_emoji_config(character_id)
-            
-            if character_id not in self.cache:
-                return False
-            
-            config = self.cache[character_id]
-            if 'trigger_keywords' not in config:
-                config['trigger_keywords'] = {}
-            
-            if emotion not in config['trigger_keywords']:
-                config['trigger_keywords'][emotion] = []
-            
-            if keyword not in config['trigger_keywords'][emotion]:
-                config['trigger_keywords'][emotion].append(keyword)
-                self._save_emoji_config(character_id, config)
-                print(f"✅ 為 {character_id} 新增情感關鍵字：{emotion} -> {keyword}")
-                return True
-            
-            return False
-            
-        except Exception as e:
-            print(f"❌ 新增情感關鍵字失敗: {e}")
-            return False
+        if self.edit_emoji_config(character_id).add_keyword(emotion, keyword).commit():
+            print(f"✅ 為 {character_id} 新增情感關鍵字：{emotion} -> {keyword}")
+            return True
+        return False
     
     def add_emotion_emoji(self, character_id: str, emotion: str, emoji: str):
         """新增情感表情符號"""
-        if not self.db:
+        if self.edit_emoji_config(character_id).add_emoji(emotion, emoji).commit():
+            print(f"✅ 為 {character_id} 新增情感表情符號：{emotion} -> {emoji}")
+            return True
+        return False
+    
+    def set_emoji_enabled(self, character_id: str, enabled: bool):
+        """設定表情符號回應是否啟用"""
+        emoji_config = self._get_emoji_config(character_id)
+        if emoji_config is None:
             return False
+        if emoji_config.get('enabled', True) == enabled:
+            return True
         
-        try:
-            if character_id not in self.cache:
-                self._load_emoji_config(character_id)
-            
-            if character_id not in self.cache:
-                return False
-            
-            config = self.cache[character_id]
-            if 'trigger_emojis' not in config:
-                config['trigger_emojis'] = {}
-            
-            if emotion not in config['trigger_emojis']:
-                config['trigger_emojis'][emotion] = []
-            
-            if emoji not in config['trigger_emojis'][emotion]:
-                config['trigger_emojis'][emotion].append(emoji)
-                self._save_emoji_config(character_id, config)
-                print(f"✅ 為 {character_id} 新增情感表情符號：{emotion} -> {emoji}")
-                return True
-            
-            return False
-            
-        except Exception as e:
-            print(f"❌ 新增情感表情符號失敗: {e}")
+        if not self.edit_emoji_config(character_id).set_enabled(enabled).commit():
             return False
+        status = "啟用" if enabled else "停用"
+        print(f"✅ {character_id} 表情符號回應已{status}")
+        return True
     
-    def _save_emoji_config(self, character_id: str, config: Dict):
-        """儲存表情符號配置到 Firestore"""
-        if not self.db:
-            print(f"❌ Firebase 未初始化，無法儲存 {character_id} 配置")
-            return
-            
-        try:
-            doc_ref = self.db.collection(character_id).document('emoji_system')
-            doc_ref.set(config)
-            print(f"✅ 儲存 {character_id} 的表情系統配置")
-        except Exception as e:
-            print(f"❌ 儲存 {character_id} 表情符號配置失敗: {e}")
-    
-    def get_character_emotions(self, character_id: str) -> Dict[str, List[str]]:
-        """取得角色的所有情感關鍵字"""
-        if character_id not in self.cache:
-            self._load_emoji_config(character_id)
-        
-        if character_id in self.cache:
-            return self.cache[character_id].get('trigger_keywords', {})
-        
-        return {}
-    
-    def get_character_emoji_map(self, character_id: str) -> Dict[str, List[str]]:
-        """取得角色的所有情感表情符號映射"""
-        if character_id not in self.cache:
-            self._load_emoji_config(character_id)
-        
-        if character_id in self.cache:
-            return self.cache[character_id].get('trigger_emojis', {})
-        
-        return {}
-    
-    def set_emoji_enabled(self, character_id: str, enabled: bool):
-        """設定表情符號回應是否啟用"""
+    def _commit_edit(self, edit: "EmojiConfigEdit") -> bool:
+        """以欄位層級 update() 寫入修改；寫入成功後才更新角色目錄中的配置，返回是否有寫入"""
         if not self.db:
+            print(f"❌ Firebase 未初始化，無法儲存 {edit.character_id} 配置")
             return False
         
-        try:
-            if character_id not in self.cache:
-                self._load_emoji_config(character_id)
-            
-            if character_id not in self.cache:
+        with self._edit_lock:
+            emoji_config = self._get_emoji_config(edit.character_id)
+            if emoji_config is None:
                 return False
             
-            config = self.cache[character_id]
-            config['enabled'] = enabled
+            # 略過已存在的值，沒有實際變更時不寫入
+            unions = {}
+            for (field, emotion), values in edit.unions.items():
+                existing = emoji_config.get(field, {}).get(emotion, ())
+                new_values = [value for value in values if value not in existing]
+                if new_values:
+                    unions[(field, emotion)] = new_values
+            fields = {field: value for field, value in edit.fields.items() if emoji_config.get(field) != value}
+            if not unions and not fields:
+                return False
             
-            self._save_emoji_config(character_id, config)
+            updates = {
+                FieldPath(field, emotion).to_api_repr(): firestore.ArrayUnion(values)
+                for (field, emotion), values in unions.items()
+            }
+            updates.update(fields)
+            try:
+                self.db.collection(edit.character_id).document('emoji_system').update(updates)
+            except Exception as e:
+                self.firebase.log_error(f"更新 {edit.character_id} 的表情符號配置", e)
+                return False
             
-            status = "啟用" if enabled else "停用"
-            print(f"✅ {character_id} 表情符號回應已{status}")
+            # 寫入成功後才套用到快取中的配置
+            config = thaw(emoji_config)
+            for (field, emotion), values in unions.items():
+                config.setdefault(field, {}).setdefault(emotion, []).extend(values)
+            config.update(fields)
+            character_catalog.replace_document(edit.character_id, 'emoji_system', config)
+            print(f"✅ 更新 {edit.character_id} 的表情系統配置（{len(updates)} 個欄位）")
             return True
-            
-        except Exception as e:
-            print(f"❌ 設定表情符號回應狀態失敗: {e}")
-            return False
+    
+    def get_character_emotions(self, character_id: str) -> Mapping[str, Sequence[str]]:
+        """取得角色的所有情感關鍵字（唯讀）"""
+        emoji_config = self._get_emoji_config(character_id)
+        return emoji_config.get('trigger_keywords', {}) if emoji_config is not None else {}
+    
+    def get_character_emoji_map(self, character_id: str) -> Mapping[str, Sequence[str]]:
+        """取得角色的所有情感表情符號映射（唯讀）"""
+        emoji_config = self._get_emoji_config(character_id)
+        return emoji_config.get('trigger_emojis', {}) if emoji_config is not None else {}
     
     def refresh_cache(self, character_id: Optional[str] = None):
         """重新整理快取"""
         if character_id:
-            if character_id in self.cache:
-                del self.cache[character_id]
-            self._load_emoji_config(character_id)
+            self._matchers.pop(character_id, None)
+            self._missing.discard(character_id)
+            character_catalog.refresh(character_id)
         else:
-            self.cache.clear()
-            for char_id in ['shen_ze', 'gu_beichen', 'fan_chengxi']:
-                self._load_emoji_config(char_id)
+            # 重新讀取角色目錄中所有已載入的角色（單次批次讀取）
+            self._matchers.clear()
+            self._missing.clear()
+            character_catalog.refresh()
 
     def get_server_emoji_stats(self, guild) -> Dict:
         """獲取伺服器 emoji 統計資訊"""
-        if not guild or not hasattr(guild, 'emojis'):
-            return {"total": 0, "animated": 0, "static": 0, "sample": []}
-        
-        emojis = list(guild.emojis)
-        animated_count = sum(1 for emoji in emojis if emoji.animated)
-        static_count = len(emojis) - animated_count
-        
-        # 取前5個作為樣本
-        sample = [str(emoji) for emoji in emojis[:5]]
+        snapshot = self.get_guild_emojis(guild)
         
         return {
-            "total": len(emojis),
-            "animated": animated_count,
-            "static": static_count,
-            "sample": sample
+            "total": len(snapshot.all),
+            "animated": len(snapshot.animated),
+            "static": len(snapshot.static),
+            "sample": list(snapshot.all[:5])  # 取前5個作為樣本
         }
 
+class EmojiConfigEdit:
+    """累積多個表情符號配置修改，commit() 時合併為單次欄位層級 update()（陣列以 ArrayUnion 追加）"""
+
+    def __init__(self, manager: SmartEmojiResponseManager, character_id: str):
+        self.manager = manager
+        self.character_id = character_id
+        self.unions: Dict[Tuple[str, str], List[str]] = {}  # {(欄位, 情感): 要追加的值}
+        self.fields: Dict[str, Any] = {}
+
+    def _union(self, field: str, emotion: str, value: str) -> "EmojiConfigEdit":
+        values = self.unions.setdefault((field, emotion), [])
+        if value not in values:
+            values.append(value)
+        return self
+
+    def add_keyword(self, emotion: str, keyword: str) -> "EmojiConfigEdit":
+        return self._union('trigger_keywords', emotion, keyword)
+
+    def add_emoji(self, emotion: str, emoji: str) -> "EmojiConfigEdit":
+        return self._union('trigger_emojis', emotion, emoji)
+
+    def set_enabled(self, enabled: bool) -> "EmojiConfigEdit":
+        self.fields['enabled'] = enabled
+        return self
+
+    def commit(self) -> bool:
+        """寫入所有修改；沒有實際變更或寫入失敗時返回 False"""
+        return self.manager._commit_edit(self)
+
 # 全域實例
 smart_emoji_manager = SmartEmojiResponseManager() 
\ No newline at end of file
@@ -127,69 +127,17 @@ class FirebaseManager:
             return default
     
     def get_character_gemini_config(self, character_id: str) -> Dict[str, Any]:
-        """獲取角色的完整 Gemini 設定"""
-        if not self.db:
-            return {}
-        
-        try:
-            cache_key = f"{character_id}_gemini_config"
-            cached_config = self.get_from_cache(cache_key)
-            if cached_config is not None:
-                return cached_config
-            
-            # 從 Firestore 讀取
-            doc = self.db.collection(character_id).document('system').get()
-            if doc.exists:
-                system_data = doc.to_dict()
-                gemini_config = system_data.get('gemini_config', {})
-                character_name = system_data.get('name', character_id)  # 獲取角色名稱
-            else:
-                gemini_config = {}
-                character_name = character_id
-            
-            # 更新快取
-            self.set_to_cache(cache_key, gemini_config)
-            
-            # 只在首次載入時顯示訊息
-            if gemini_config and not self.get_from_cache(f"{character_id}_gemini_loaded"):
-                print(f"✅ 已載入角色 {character_name} 的 Gemini 設定")
-                self.set_to_cache(f"{character_id}_gemini_loaded", True)
-            
-            return gemini_config
-            
-        except Exception as e:
-            self.log_error(f"獲取角色 {character_id} Gemini 設定", e)
-            return {}
+        """獲取角色的完整 Gemini 設定（唯讀）"""
+        return self.get_character_system_config(character_id).get('gemini_config') or {}
     
     def get_character_system_config(self, character_id: str) -> Dict[str, Any]:
-        """獲取角色的完整系統設定"""
+        """獲取角色的完整系統設定（唯讀，由共用的角色目錄提供）"""
         if not self.db:
             return {}
         
-        try:
-            cache_key = f"{character_id}_system_config"
-            cached_config = self.get_from_cache(cache_key)
-            if cached_config is not None:
-                return cached_config
-            
-            # 從 Firestore 讀取
-            doc = self.db.collection(character_id).document('system').get()
-            system_config = doc.to_dict() if doc.exists else {}
-            
-            # 更新快取
-            self.set_to_cache(cache_key, system_config)
-            
-            # 只在首次載入時顯示訊息
-            if system_config and not self.get_from_cache(f"{character_id}_system_loaded"):
-                character_name = system_config.get('name', character_id)  # 獲取角色名稱
-                print(f"✅ 已載入角色 {character_name} 的系統設定")
-                self.set_to_cache(f"{character_id}_system_loaded", True)
-            
-            return system_config
-            
-        except Exception as e:
-            self.log_error(f"獲取角色 {character_id} 系統設定", e)
-            return {}
+        # 角色目錄依賴本模組，於使用時才匯入以避免循環匯入
+        from character_catalog import character_catalog
+        return character_catalog.get_system(character_id)
     
     def get_prompt_with_model(self, prompt_type: str) -> Tuple[str, str]:
         """從 Firestore 獲取指定類型的 prompt 和 model 設定"""
@@ -227,42 +175,17 @@ class FirebaseManager:
             return "", "gemini-2.0-flash"
         
         try:
+            system_config = self.get_character_system_config(character_id)
+            custom_prompt = system_config.get('custom_prompt', '') if system_config.get('allowed_custom_prompt', False) else ''
+            
             # 檢查快取，避免重複顯示訊息
             cache_key = f"{character_id}_prompt_source"
-            cached_source = self.get_from_cache(cache_key)
-            
-            if cached_source is None:
-                # 首次載入，檢查prompt來源
-                system_doc = self.db.collection(character_id).document('system').get()
-                if system_doc.exists:
-                    system_config = system_doc.to_dict()
-                    allowed_custom_prompt = system_config.get('allowed_custom_prompt', False)
-                    
-                    if allowed_custom_prompt:
-                        custom_prompt = system_config.get('custom_prompt', '')
-                        if custom_prompt:
-                            print(f"✅ {character_id} 使用自定義提示詞")
-                            self.set_to_cache(cache_key, "custom")
-                        else:
-                            print(f"✅ {character_id} 使用預設提示詞")
-                            self.set_to_cache(cache_key, "default")
-                    else:
-                        print(f"✅ {character_id} 使用預設提示詞")
-                        self.set_to_cache(cache_key, "default")
-                else:
-                    print(f"✅ {character_id} 使用預設提示詞")
-                    self.set_to_cache(cache_key, "default")
+            if self.get_from_cache(cache_key) is None:
+                print(f"✅ {character_id} 使用{'自定義' if custom_prompt else '預設'}提示詞")
+                self.set_to_cache(cache_key, "custom" if custom_prompt else "default")
             
-            # 獲取實際的prompt內容
-            system_doc = self.db.collection(character_id).document('system').get()
-            if system_doc.exists:
-                system_config = system_doc.to_dict()
-                allowed_custom_prompt = system_config.get('allowed_custom_prompt', False)
-                
-                if allowed_custom_prompt:
-                    custom_prompt = system_config.get('custom_prompt', '')
-                    if custom_prompt:
-                        return custom_prompt, "gemini-2.0-flash"
+            if custom_prompt:
+                return custom_prompt, "gemini-2.0-flash"
             
             # 使用統一的prompt集合
             return self.get_prompt_with_model(prompt_type)
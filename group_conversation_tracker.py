@@ -5,9 +5,65 @@
 """
 
 import asyncio
+import atexit
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Set
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Set, Tuple
 from firebase_utils import firebase_manager
+from timing_wheel import TimingWheel
+
+# 常數定義
+CONTEXT_LIMIT = 30  # 每個頻道保留的對話記錄數
+CONTEXT_COLLECTION = 'group_context'  # 頻道事件記錄的持久化集合：group_context/{channel_id}
+PERSIST_BATCH_SIZE = 400  # 每個寫入批次的文件數（Firestore 上限 500）
+SUMMARY_MAX_AGE = 60  # 頻道沒有新訊息時，摘要最多沿用的秒數（活躍時間窗仍會隨時間移動）
+DEFAULT_TRACKER_CONFIG = {
+    'user_retention_minutes': 60,      # 使用者最後發言後保留活動記錄的時間
+    'channel_retention_minutes': 120,  # 頻道最後一則對話後保留上下文的時間
+    'sweep_interval_seconds': 30,      # 背景清理與寫入的間隔
+    'persist_context': True,           # 是否將頻道事件記錄寫回 Firestore 並於重啟後還原
+}
+
+
+class ConversationEntry:
+    """一則對話記錄（使用者名稱經過 intern，同一使用者的記錄共用同一字串）"""
+    __slots__ = ('user_id', 'user_name', 'message', 'timestamp', 'is_bot', 'message_id', 'character_id')
+
+    def __init__(self, user_id: int, user_name: str, message: str, timestamp: datetime, is_bot: bool = False,
+                 message_id: Optional[int] = None, character_id: Optional[str] = None):
+        self.user_id = user_id
+        self.user_name = sys.intern(user_name)
+        self.message = message
+        self.timestamp = timestamp
+        self.is_bot = is_bot
+        self.message_id = message_id
+        self.character_id = character_id  # 本程序中的角色發言時記錄角色 ID
+
+    def to_dict(self) -> dict:
+        """轉為 dict（寫入 Firestore 時使用，時間戳帶時區，避免本地時間被當成 UTC 儲存）"""
+        return {
+            'user_id': self.user_id,
+            'user_name': self.user_name,
+            'message': self.message,
+            'timestamp': self.timestamp.astimezone(),
+            'is_bot': self.is_bot,
+            'message_id': self.message_id,
+            'character_id': self.character_id
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ConversationEntry":
+        """從 Firestore 資料還原（時間戳轉回本地時間，與 datetime.now() 可直接比較）"""
+        timestamp = data['timestamp']
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone().replace(tzinfo=None)
+        return cls(data.get('user_id', 0), data.get('user_name', ''), data.get('message', ''), timestamp,
+                   data.get('is_bot', False), data.get('message_id'), data.get('character_id'))
+
 
 class GroupConversationTracker:
     """群組對話追蹤器"""
@@ -15,84 +71,148 @@ class GroupConversationTracker:
     def __init__(self):
         # 使用統一的 Firebase 管理器
         self.firebase = firebase_manager
-        self.active_users: Dict[str, Dict[int, Dict[str, dict]]] = {}  # {character_id: {channel_id: {user_id: user_data}}}
-        self.channel_contexts: Dict[str, Dict[int, List[dict]]] = {}   # {character_id: {channel_id: [message_contexts]}}
+        self.active_users: Dict[str, Dict[int, "OrderedDict[str, dict]"]] = {}  # {character_id: {channel_id: {user_id: user_data}}}，依最後活動時間排序
+        self.channel_logs: Dict[int, Deque[ConversationEntry]] = {}  # {channel_id: 環狀緩衝區}，同一程序中所有角色共用
+        self._log_message_ids: Dict[int, Set[int]] = {}  # {channel_id: 緩衝區內的訊息 ID}，多個 Bot 收到同一則訊息時去重
+        self._lock = threading.RLock()  # 各角色 Bot 在不同執行緒中讀寫，背景清理執行緒也會刪除項目
+        self._config = DEFAULT_TRACKER_CONFIG.copy()
+        # 過期排程：('user', character_id, channel_id, user_id) 或 ('channel', channel_id)
+        self._wheel = TimingWheel(DEFAULT_TRACKER_CONFIG['sweep_interval_seconds'],
+                                  DEFAULT_TRACKER_CONFIG['channel_retention_minutes'] * 60, time.time())
+        self._sweeper: Optional[threading.Thread] = None
+        self._channel_versions: Dict[int, int] = {}  # 頻道每則新訊息或活動遞增，作為摘要快取的版本
+        self._log_totals: Dict[int, int] = {}  # {channel_id: 累計寫入的記錄數}，作為記錄的位置
+        self._channel_summaries: Dict[int, Tuple[str, int]] = {}  # {channel_id: (滾動摘要, 摘要涵蓋到的位置)}
+        self._summary_cache: Dict[int, Dict[str, Tuple[int, float, str]]] = {}  # {channel_id: {character_id: (版本, 建立時間, 摘要)}}
+        self._dirty_channels: Set[int] = set()  # 有新記錄、尚未寫回 Firestore 的頻道
+        self._restored_channels: Set[int] = set()  # 本次啟動後已嘗試從 Firestore 還原的頻道
+        self._expired_channels: Set[int] = set()  # 已過期、待從 Firestore 刪除文件的頻道
+        self.persisted_writes = 0
+        self.restored_channels = 0
+        self.sweeps = 0
+        self.evicted_users = 0
+        self.evicted_channels = 0
         
     @property
     def db(self):
         """獲取 Firestore 資料庫實例"""
         return self.firebase.db
     
-    def _ensure_channel_context_exists(self, character_id: str, channel_id: int):
-        """確保頻道上下文存在"""
-        if character_id not in self.channel_contexts:
-            self.channel_contexts[character_id] = {}
+    def get_config(self) -> dict:
+        """從 prompt/system 的 group_tracker 欄位讀取保留時間與清理間隔"""
+        config = DEFAULT_TRACKER_CONFIG.copy()
+        config.update(self.firebase.get_firestore_field(
+            collection='prompt',
+            document='system',
+            field='group_tracker',
+            default={},
+            cache_key="group_tracker"
+        ) or {})
+        return config
+    
+    def _ensure_channel_log_exists(self, channel_id: int) -> Deque[ConversationEntry]:
+        """確保頻道事件記錄存在"""
+        buffer = self.channel_logs.get(channel_id)
+        if buffer is None:
+            buffer = self.channel_logs[channel_id] = deque(maxlen=CONTEXT_LIMIT)
+            self._log_message_ids[channel_id] = set()
+            self._wheel.schedule(('channel', channel_id),
+                                 time.time() + self._config['channel_retention_minutes'] * 60)
+            self._ensure_sweeper()
+        return buffer
+    
+    def _bump_version(self, channel_id: int):
+        self._channel_versions[channel_id] = self._channel_versions.get(channel_id, 0) + 1
+    
+    def _add_to_channel_log(self, channel_id: int, context_entry: ConversationEntry, persist: bool = True) -> bool:
+        """添加到頻道事件記錄（固定長度的環狀緩衝區會自動丟棄最舊的記錄）；已記錄過的訊息 ID 返回 False
+
+        persist 為 False 時（私訊）只保留在記憶體中，不寫回 Firestore
+        """
+        buffer = self._ensure_channel_log_exists(channel_id)
+        message_ids = self._log_message_ids[channel_id]
+        if context_entry.message_id is not None:
+            if context_entry.message_id in message_ids:
+                return False
+            message_ids.add(context_entry.message_id)
+        if len(buffer) == buffer.maxlen:
+            message_ids.discard(buffer[0].message_id)
+        buffer.append(context_entry)
+        self._log_totals[channel_id] = self._log_totals.get(channel_id, 0) + 1
+        self._bump_version(channel_id)
+        if persist:
+            self._dirty_channels.add(channel_id)
+        return True
+    
+    def record_message(self, channel_id: int, message_id: int, user_id: int, user_name: str, message_content: str,
+                       is_bot: bool = False) -> bool:
+        """記錄頻道中的一則允許的訊息（不論是否觸發角色回應）；同一則訊息只記錄一次"""
+        if not message_content:
+            return False
+        with self._lock:
+            context_entry = ConversationEntry(user_id, user_name, message_content, datetime.now(), is_bot, message_id)
+            return self._add_to_channel_log(channel_id, context_entry)
+    
+    def track_user_activity(self, character_id: str, channel_id: int, user_id: int, user_name: str, message_content: str,
+                            message_id: Optional[int] = None, persist: bool = True):
+        """追蹤使用者活動（觸發該角色回應的訊息）"""
+        with self._lock:
+            # 初始化活躍使用者結構
+            if character_id not in self.active_users:
+                self.active_users[character_id] = {}
+            if channel_id not in self.active_users[character_id]:
+                self.active_users[character_id][channel_id] = OrderedDict()
             
-        if channel_id not in self.channel_contexts[character_id]:
-            self.channel_contexts[character_id][channel_id] = []
-    
-    def _add_to_conversation_context(self, character_id: str, channel_id: int, context_entry: dict):
-        """添加對話上下文並維護30則限制"""
-        self.channel_contexts[character_id][channel_id].append(context_entry)
-        
-        # 只保留最近30則對話記錄
-        if len(self.channel_contexts[character_id][channel_id]) > 30:
-            self.channel_contexts[character_id][channel_id] = self.channel_contexts[character_id][channel_id][-30:]
-    
-    def track_user_activity(self, character_id: str, channel_id: int, user_id: int, user_name: str, message_content: str):
-        """追蹤使用者活動"""
-        # 初始化活躍使用者結構
-        if character_id not in self.active_users:
-            self.active_users[character_id] = {}
-        if channel_id not in self.active_users[character_id]:
-            self.active_users[character_id][channel_id] = {}
-        
-        # 更新活躍使用者
-        current_time = datetime.now()
-        user_id_str = str(user_id)
-        self.active_users[character_id][channel_id][user_id_str] = {
-            'name': user_name,
-            'last_activity': current_time,
-            'message_count': self.active_users[character_id][channel_id].get(user_id_str, {}).get('message_count', 0) + 1,
-            'last_message': message_content[:100]  # 只保留前100字符
-        }
-        
-        # 添加對話上下文
-        self._ensure_channel_context_exists(character_id, channel_id)
-        context_entry = {
-            'user_id': user_id,
-            'user_name': user_name,
-            'message': message_content,
-            'timestamp': current_time,
-            'is_bot': False
-        }
-        self._add_to_conversation_context(character_id, channel_id, context_entry)
+            # 更新活躍使用者（移到最新的一端，索引維持依最後活動時間排序）
+            current_time = datetime.now()
+            user_id_str = str(user_id)
+            channel_users = self.active_users[character_id][channel_id]
+            previous = channel_users.get(user_id_str)
+            channel_users[user_id_str] = {
+                'name': sys.intern(user_name),
+                'last_activity': current_time,
+                'message_count': (previous['message_count'] if previous else 0) + 1,
+                'last_message': message_content[:100]  # 只保留前100字符
+            }
+            channel_users.move_to_end(user_id_str)
+            if previous is None:
+                # 只在新使用者時排程；之後的活動由清理時重新檢查並延後，不需每則訊息移動排程
+                self._wheel.schedule(('user', character_id, channel_id, user_id_str),
+                                     current_time.timestamp() + self._config['user_retention_minutes'] * 60)
+            
+            # 添加到頻道事件記錄（Bot 收到訊息時通常已記錄過，依訊息 ID 去重）
+            context_entry = ConversationEntry(user_id, user_name, message_content, current_time, message_id=message_id)
+            if not self._add_to_channel_log(channel_id, context_entry, persist):
+                self._bump_version(channel_id)
     
-    def track_bot_response(self, character_id: str, channel_id: int, bot_name: str, response_content: str):
+    def track_bot_response(self, character_id: str, channel_id: int, bot_name: str, response_content: str,
+                           message_id: Optional[int] = None, persist: bool = True):
         """追蹤BOT回應"""
-        # 添加BOT回應到對話上下文
-        self._ensure_channel_context_exists(character_id, channel_id)
-        current_time = datetime.now()
-        context_entry = {
-            'user_id': 0,  # BOT的ID設為0
-            'user_name': bot_name,
-            'message': response_content,
-            'timestamp': current_time,
-            'is_bot': True
-        }
-        self._add_to_conversation_context(character_id, channel_id, context_entry)
+        # 添加BOT回應到頻道事件記錄，其他角色也能看到這則發言
+        with self._lock:
+            current_time = datetime.now()
+            context_entry = ConversationEntry(0, bot_name, response_content, current_time, is_bot=True,  # BOT的ID設為0
+                                              message_id=message_id, character_id=character_id)
+            if not self._add_to_channel_log(channel_id, context_entry, persist):
+                # 其他角色 Bot 先收到這則發言時已記錄，補上發言的角色
+                for logged in reversed(self.channel_logs[channel_id]):
+                    if logged.message_id == message_id:
+                        logged.character_id = character_id
+                        break
     
-    def get_active_users_in_channel(self, character_id: str, channel_id: int, minutes: int = 30) -> List[dict]:
-        """獲取指定時間內在該頻道活躍的使用者"""
-        if character_id not in self.active_users or channel_id not in self.active_users[character_id]:
-            return []
-        
+    def get_active_users_in_channel(self, character_id: str, channel_id: int, minutes: int = 30, limit: Optional[int] = None) -> List[dict]:
+        """獲取指定時間內在該頻道活躍的使用者（依最後活動時間由新到舊，只走訪回傳的使用者）"""
         current_time = datetime.now()
         cutoff_time = current_time - timedelta(minutes=minutes)
         
         active_users = []
-        for user_id_str, user_data in self.active_users[character_id][channel_id].items():
-            if user_data['last_activity'] > cutoff_time:
+        with self._lock:
+            if character_id not in self.active_users or channel_id not in self.active_users[character_id]:
+                return []
+            
+            for user_id_str, user_data in reversed(self.active_users[character_id][channel_id].items()):
+                if user_data['last_activity'] <= cutoff_time or (limit is not None and len(active_users) >= limit):
+                    break
                 active_users.append({
                     'user_id': int(user_id_str),
                     'name': user_data['name'],
@@ -101,20 +221,66 @@ class GroupConversationTracker:
                     'last_message': user_data['last_message']
                 })
         
-        # 按最後活動時間排序
-        active_users.sort(key=lambda x: x['last_activity'], reverse=True)
         return active_users
     
-    def get_recent_conversation_context(self, character_id: str, channel_id: int, limit: int = 10) -> List[dict]:
-        """獲取最近的對話上下文"""
-        if character_id not in self.channel_contexts or channel_id not in self.channel_contexts[character_id]:
-            return []
-        
-        return self.channel_contexts[character_id][channel_id][-limit:]
+    def is_active_user(self, character_id: str, channel_id: int, user_id: int, minutes: int = 30) -> bool:
+        """使用者是否在指定時間內於該頻道活躍（O(1) 查詢）"""
+        cutoff_time = datetime.now() - timedelta(minutes=minutes)
+        with self._lock:
+            user_data = self.active_users.get(character_id, {}).get(channel_id, {}).get(str(user_id))
+            return user_data is not None and user_data['last_activity'] > cutoff_time
+    
+    def get_recent_conversation_context(self, character_id: str, channel_id: int, limit: int = 10) -> List[ConversationEntry]:
+        """角色看到的最近對話上下文：共用頻道事件記錄的最後 limit 則（包含其他角色的發言）"""
+        with self._lock:
+            buffer = self.channel_logs.get(channel_id)
+            if not buffer:
+                return []
+            
+            return list(islice(buffer, max(len(buffer) - limit, 0), None))
+    
+    def get_log_position(self, channel_id: int) -> int:
+        """頻道記錄目前的位置（累計寫入的記錄數）"""
+        with self._lock:
+            return self._log_totals.get(channel_id, 0)
+    
+    def get_entries_between(self, channel_id: int, start: int, end: int) -> List[ConversationEntry]:
+        """位置介於 [start, end) 的記錄；已被環狀緩衝區丟棄的部分不會返回"""
+        with self._lock:
+            buffer = self.channel_logs.get(channel_id)
+            if not buffer:
+                return []
+            first = self._log_totals.get(channel_id, 0) - len(buffer)  # 緩衝區第一則記錄的位置
+            return list(islice(buffer, max(start - first, 0), max(end - first, 0)))
+    
+    def get_channel_summary(self, channel_id: int) -> Optional[Tuple[str, int]]:
+        """頻道的滾動摘要與摘要涵蓋到的位置"""
+        with self._lock:
+            return self._channel_summaries.get(channel_id)
+    
+    def set_channel_summary(self, channel_id: int, summary: str, position: int):
+        """更新頻道的滾動摘要（頻道已被清理時忽略）"""
+        with self._lock:
+            if channel_id not in self.channel_logs:
+                return
+            self._channel_summaries[channel_id] = (summary, position)
+            self._bump_version(channel_id)
+            self._dirty_channels.add(channel_id)
     
     def get_conversation_summary(self, character_id: str, channel_id: int) -> str:
-        """生成對話摘要"""
-        active_users = self.get_active_users_in_channel(character_id, channel_id)
+        """生成對話摘要（在頻道出現下一則訊息前沿用已生成的摘要）"""
+        now = time.monotonic()
+        with self._lock:
+            version = self._channel_versions.get(channel_id, 0)
+            cached = self._summary_cache.get(channel_id, {}).get(character_id)
+            if cached is not None and cached[0] == version and now - cached[1] < SUMMARY_MAX_AGE:
+                return cached[2]
+            summary = self._build_conversation_summary(character_id, channel_id)
+            self._summary_cache.setdefault(channel_id, {})[character_id] = (version, now, summary)
+            return summary
+    
+    def _build_conversation_summary(self, character_id: str, channel_id: int) -> str:
+        active_users = self.get_active_users_in_channel(character_id, channel_id, limit=5)
         recent_context = self.get_recent_conversation_context(character_id, channel_id, 5)
         
         if not active_users:
@@ -123,7 +289,7 @@ class GroupConversationTracker:
         summary_parts = []
         
         # 活躍使用者摘要
-        user_names = [user['name'] for user in active_users[:5]]  # 最多5個使用者
+        user_names = [user['name'] for user in active_users]  # 最多5個使用者
         if len(user_names) == 1:
             summary_parts.append(f"目前 {user_names[0]} 正在與我對話")
         else:
@@ -133,101 +299,360 @@ class GroupConversationTracker:
         if recent_context:
             recent_topics = []
             for context in recent_context[-6:]:  # 最近6則（包含BOT回應）
-                if context['message'] and len(context['message']) > 10:
+                if context.message and len(context.message) > 10:
                     # 區分BOT和使用者訊息
-                    if context.get('is_bot', False):
-                        recent_topics.append(f"{context['user_name']}（BOT）：{context['message'][:30]}...")
+                    if context.is_bot and context.character_id == character_id:
+                        recent_topics.append(f"{context.user_name}（我）：{context.message[:30]}...")
+                    elif context.is_bot:
+                        recent_topics.append(f"{context.user_name}（BOT）：{context.message[:30]}...")
                     else:
-                        recent_topics.append(f"{context['user_name']}：{context['message'][:30]}...")
+                        recent_topics.append(f"{context.user_name}：{context.message[:30]}...")
             
             if recent_topics:
                 summary_parts.append(f"最近的對話：{' | '.join(recent_topics)}")
         
         return " | ".join(summary_parts)
     
-    async def save_group_context_to_firestore(self, character_id: str, channel_id: int):
-        """將群組對話上下文保存到 Firestore"""
-        if not self.db:
-            return False
+    def restore_channel(self, channel_id: int) -> int:
+        """啟動後頻道第一次出現訊息時，從 Firestore 還原保留期限內的對話記錄，返回還原的筆數"""
+        with self._lock:
+            if channel_id in self._restored_channels:
+                return 0
+            self._restored_channels.add(channel_id)
+        if not self.db or not self._config['persist_context']:
+            return 0
         
         try:
-            active_users = self.get_active_users_in_channel(character_id, channel_id)
-            recent_context = self.get_recent_conversation_context(character_id, channel_id, 20)
-            
-            # 保存到 Firestore
-            doc_ref = self.db.collection(character_id).document('group_context').collection('channels').document(str(channel_id))
-            
-            doc_ref.set({
-                'last_updated': datetime.now(),
-                'active_users': active_users,
-                'recent_context': recent_context,
-                'summary': self.get_conversation_summary(character_id, channel_id)
-            })
-            
-            return True
+            doc = self.db.collection(CONTEXT_COLLECTION).document(str(channel_id)).get()
+            if not doc.exists:
+                return 0
+            cutoff_time = datetime.now() - timedelta(minutes=self._config['channel_retention_minutes'])
+            data = doc.to_dict() or {}
+            restored = [ConversationEntry.from_dict(message) for message in data.get('messages', [])]
+            restored = [entry for entry in restored if entry.timestamp > cutoff_time]
         except Exception as e:
-            print(f"保存群組上下文時發生錯誤: {e}")
-            return False
+            self.firebase.log_error(f"還原頻道 {channel_id} 的對話記錄", e)
+            return 0
+        if not restored:
+            # 文件中的記錄都已過期，下次寫回時一併刪除
+            with self._lock:
+                if channel_id not in self.channel_logs:
+                    self._expired_channels.add(channel_id)
+            return 0
+        
+        with self._lock:
+            # 讀取期間可能已有新訊息：還原的記錄放在前面，依訊息 ID 去重後重建緩衝區
+            buffer = self._ensure_channel_log_exists(channel_id)
+            current = list(buffer)
+            current_ids = {entry.message_id for entry in current if entry.message_id is not None}
+            merged = [entry for entry in restored if entry.message_id is None or entry.message_id not in current_ids] + current
+            buffer.clear()
+            buffer.extend(merged)
+            self._log_message_ids[channel_id] = {entry.message_id for entry in buffer if entry.message_id is not None}
+            # 還原的記錄視為位於目前位置之前；滾動摘要涵蓋除了最後 summary_pending 則以外的記錄
+            total = self._log_totals[channel_id] = max(self._log_totals.get(channel_id, 0), len(buffer))
+            if data.get('summary'):
+                pending = min(data.get('summary_pending', 0) + len(current), len(buffer))
+                self._channel_summaries[channel_id] = (data['summary'], total - pending)
+            self._bump_version(channel_id)
+            self.restored_channels += 1
+        print(f"♻️ 已還原頻道 {channel_id} 的 {len(restored)} 則對話記錄")
+        return len(restored)
+    
+    async def ensure_channel_restored(self, channel_id: int) -> int:
+        """在工作執行緒中還原頻道記錄（每個頻道每次啟動只讀取一次）"""
+        if channel_id in self._restored_channels:
+            return 0
+        return await asyncio.to_thread(self.restore_channel, channel_id)
+    
+    def flush_dirty_channels(self) -> int:
+        """將有新記錄的頻道分批寫回 Firestore，並刪除已過期頻道的文件（延遲寫入，每個頻道每個間隔最多寫入一次），返回寫入的文件數"""
+        if not self.db or not self._config['persist_context']:
+            return 0
+        with self._lock:
+            dirty, self._dirty_channels = self._dirty_channels, set()
+            # 過期後又出現新訊息的頻道改為寫入新記錄
+            expired = {channel_id for channel_id in self._expired_channels if channel_id not in self.channel_logs}
+            self._expired_channels = set()
+            retention = timedelta(minutes=self._config['channel_retention_minutes'])
+            snapshots: Dict[int, Optional[dict]] = dict.fromkeys(expired)
+            for channel_id in dirty:
+                if channel_id not in self.channel_logs:
+                    continue
+                buffer = self.channel_logs[channel_id]
+                snapshot = {'messages': [entry.to_dict() for entry in buffer]}
+                if buffer:
+                    # 供 Firestore TTL 政策刪除不再出現訊息的頻道（例如重啟後不再活動的頻道）
+                    snapshot['expire_at'] = (buffer[-1].timestamp + retention).astimezone()
+                if channel_id in self._channel_summaries:
+                    summary, position = self._channel_summaries[channel_id]
+                    snapshot['summary'] = summary
+                    snapshot['summary_pending'] = self._log_totals.get(channel_id, 0) - position
+                snapshots[channel_id] = snapshot
+        if not snapshots:
+            return 0
+        
+        written = 0
+        channel_ids = list(snapshots)
+        for start in range(0, len(channel_ids), PERSIST_BATCH_SIZE):
+            chunk = channel_ids[start:start + PERSIST_BATCH_SIZE]
+            try:
+                batch = self.db.batch()
+                for channel_id in chunk:
+                    doc_ref = self.db.collection(CONTEXT_COLLECTION).document(str(channel_id))
+                    if snapshots[channel_id] is None:
+                        batch.delete(doc_ref)
+                    else:
+                        batch.set(doc_ref, dict(snapshots[channel_id], last_updated=datetime.now()))
+                batch.commit()
+                written += len(chunk)
+            except Exception as e:
+                self.firebase.log_error(f"寫入 {len(chunk)} 個頻道的對話記錄", e)
+                # 寫入失敗時標回待寫入，下次再試
+                with self._lock:
+                    self._dirty_channels.update(channel_id for channel_id in chunk if channel_id in self.channel_logs)
+                    self._expired_channels.update(channel_id for channel_id in chunk if snapshots[channel_id] is None)
+        
+        with self._lock:
+            self.persisted_writes += written
+        return written
     
     def cleanup_old_activity(self, character_id: str, minutes: int = 60):
         """清理過期的活動記錄"""
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(minutes=minutes)
+        with self._lock:
+            current_time = datetime.now()
+            cutoff_time = current_time - timedelta(minutes=minutes)
         
-        if character_id in self.active_users:
-            for channel_id in list(self.active_users[character_id].keys()):
-                # 清理過期的使用者活動
-                expired_users = []
-                for user_id_str, user_data in self.active_users[character_id][channel_id].items():
-                    if user_data['last_activity'] < cutoff_time:
-                        expired_users.append(user_id_str)
-                
-                for user_id_str in expired_users:
-                    del self.active_users[character_id][channel_id][user_id_str]
+            channel_ids = list(self.active_users.get(character_id, {}))
+            if character_id in self.active_users:
+                for channel_id in channel_ids:
+                    # 清理過期的使用者活動
+                    # 索引依最後活動時間排序，從最舊的一端移除直到遇到未過期的使用者
+                    channel_users = self.active_users[character_id][channel_id]
+                    while channel_users and next(iter(channel_users.values()))['last_activity'] < cutoff_time:
+                        channel_users.popitem(last=False)
                 
-                # 如果頻道沒有活躍使用者，清理頻道記錄
-                if not self.active_users[character_id][channel_id]:
-                    del self.active_users[character_id][channel_id]
-        
-        if character_id in self.channel_contexts:
-            for channel_id in list(self.channel_contexts[character_id].keys()):
-                # 清理過期的對話上下文
-                self.channel_contexts[character_id][channel_id] = [
-                    context for context in self.channel_contexts[character_id][channel_id]
-                    if context['timestamp'] > cutoff_time
-                ]
+                    # 如果頻道沒有活躍使用者，清理頻道記錄
+                    if not self.active_users[character_id][channel_id]:
+                        del self.active_users[character_id][channel_id]
+        
+            for channel_id in channel_ids:
+                # 清理該角色所在頻道的過期對話記錄（記錄依時間排序，從最舊的一端移除）
+                buffer = self.channel_logs.get(channel_id)
+                if buffer is None:
+                    continue
+                while buffer and buffer[0].timestamp <= cutoff_time:
+                    self._log_message_ids[channel_id].discard(buffer.popleft().message_id)
                 
                 # 如果頻道沒有對話記錄，清理頻道記錄
-                if not self.channel_contexts[character_id][channel_id]:
-                    del self.channel_contexts[character_id][channel_id]
+                if not buffer:
+                    self._remove_channel_log(channel_id)
+    
+    def _remove_channel_log(self, channel_id: int):
+        """移除過期的頻道事件記錄與相關快取，並排定刪除 Firestore 中的文件（呼叫端需持有鎖）"""
+        del self.channel_logs[channel_id]
+        del self._log_message_ids[channel_id]
+        # 保留在 _restored_channels 中：文件即將刪除，之後再出現訊息時不需重新讀取
+        self._dirty_channels.discard(channel_id)
+        if channel_id in self._restored_channels and self._config['persist_context']:
+            self._expired_channels.add(channel_id)  # 私訊不會還原也不會寫回，沒有文件需要刪除
+        self._channel_versions.pop(channel_id, None)
+        self._summary_cache.pop(channel_id, None)
+        self._log_totals.pop(channel_id, None)
+        self._channel_summaries.pop(channel_id, None)
+    
+    def sweep(self) -> Dict[str, int]:
+        """背景清理：只處理時間輪中已到期的項目，不掃描所有頻道"""
+        self._config = self.get_config()
+        user_retention = timedelta(minutes=self._config['user_retention_minutes'])
+        channel_retention = timedelta(minutes=self._config['channel_retention_minutes'])
+        evicted_users = evicted_channels = 0
+        
+        with self._lock:
+            now = datetime.now()
+            for key in self._wheel.advance(now.timestamp()):
+                if key[0] == 'user':
+                    _, character_id, channel_id, user_id_str = key
+                    channel_users = self.active_users.get(character_id, {}).get(channel_id)
+                    user_data = channel_users.get(user_id_str) if channel_users else None
+                    if user_data is None:
+                        continue
+                    expires_at = user_data['last_activity'] + user_retention
+                    if expires_at > now:
+                        # 期間內仍有活動，依最後活動時間重新排程
+                        self._wheel.schedule(key, expires_at.timestamp())
+                        continue
+                    del channel_users[user_id_str]
+                    evicted_users += 1
+                    if not channel_users:
+                        del self.active_users[character_id][channel_id]
+                        if not self.active_users[character_id]:
+                            del self.active_users[character_id]
+                else:
+                    _, channel_id = key
+                    buffer = self.channel_logs.get(channel_id)
+                    if buffer is None:
+                        continue
+                    if buffer:
+                        expires_at = buffer[-1].timestamp + channel_retention
+                        if expires_at > now:
+                            self._wheel.schedule(key, expires_at.timestamp())
+                            continue
+                    self._remove_channel_log(channel_id)
+                    evicted_channels += 1
+            
+            self.sweeps += 1
+            self.evicted_users += evicted_users
+            self.evicted_channels += evicted_channels
+        
+        if evicted_users or evicted_channels:
+            print(f"🧹 群組追蹤清理：移除 {evicted_users} 位閒置使用者、{evicted_channels} 個閒置頻道")
+        return {'users': evicted_users, 'channels': evicted_channels}
+    
+    def _ensure_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name='group-tracker-sweeper', daemon=True)
+                self._sweeper.start()
+    
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self._config['sweep_interval_seconds'])
+            try:
+                # 先寫回再清理，被清理的頻道在下一次寫回時刪除文件
+                self.flush_dirty_channels()
+                self.sweep()
+            except Exception as e:
+                print(f"群組追蹤清理時發生錯誤: {e}")
+    
+    def sweeper_stats(self) -> Dict[str, int]:
+        """背景清理的累計統計"""
+        with self._lock:
+            return {
+                'sweeps': self.sweeps,
+                'evicted_users': self.evicted_users,
+                'evicted_channels': self.evicted_channels,
+                'scheduled': len(self._wheel),
+                'tracked_channels': len(self.channel_logs),
+                'dirty_channels': len(self._dirty_channels),
+                'expired_channels': len(self._expired_channels),
+                'persisted_writes': self.persisted_writes,
+                'restored_channels': self.restored_channels,
+            }
 
 # 全域群組對話追蹤器實例
 _group_tracker = GroupConversationTracker()
+atexit.register(_group_tracker.flush_dirty_channels)
 
-def track_user_activity(character_id: str, channel_id: int, user_id: int, user_name: str, message_content: str):
-    """追蹤使用者活動"""
-    _group_tracker.track_user_activity(character_id, channel_id, user_id, user_name, message_content)
+def record_message(channel_id: int, message_id: int, user_id: int, user_name: str, message_content: str, is_bot: bool = False) -> bool:
+    """記錄頻道中的一則允許的訊息"""
+    return _group_tracker.record_message(channel_id, message_id, user_id, user_name, message_content, is_bot)
 
-def track_bot_response(character_id: str, channel_id: int, bot_name: str, response_content: str):
-    """追蹤BOT回應"""
-    _group_tracker.track_bot_response(character_id, channel_id, bot_name, response_content)
+async def ensure_channel_restored(channel_id: int) -> int:
+    """啟動後頻道第一次出現訊息時還原對話記錄"""
+    return await _group_tracker.ensure_channel_restored(channel_id)
 
-def get_active_users_in_channel(character_id: str, channel_id: int, minutes: int = 30) -> List[dict]:
+def track_user_activity(character_id: str, channel_id: int, user_id: int, user_name: str, message_content: str,
+                        message_id: Optional[int] = None, persist: bool = True):
+    """追蹤使用者活動（私訊傳入 persist=False）"""
+    _group_tracker.track_user_activity(character_id, channel_id, user_id, user_name, message_content, message_id, persist)
+
+def track_bot_response(character_id: str, channel_id: int, bot_name: str, response_content: str,
+                       message_id: Optional[int] = None, persist: bool = True):
+    """追蹤BOT回應（私訊傳入 persist=False）"""
+    _group_tracker.track_bot_response(character_id, channel_id, bot_name, response_content, message_id, persist)
+
+def get_active_users_in_channel(character_id: str, channel_id: int, minutes: int = 30, limit: Optional[int] = None) -> List[dict]:
     """獲取指定時間內在該頻道活躍的使用者"""
-    return _group_tracker.get_active_users_in_channel(character_id, channel_id, minutes)
+    return _group_tracker.get_active_users_in_channel(character_id, channel_id, minutes, limit)
+
+def is_active_user(character_id: str, channel_id: int, user_id: int, minutes: int = 30) -> bool:
+    """使用者是否在指定時間內於該頻道活躍"""
+    return _group_tracker.is_active_user(character_id, channel_id, user_id, minutes)
+
+def get_log_position(channel_id: int) -> int:
+    """頻道記錄目前的位置"""
+    return _group_tracker.get_log_position(channel_id)
+
+def get_entries_between(channel_id: int, start: int, end: int) -> List[ConversationEntry]:
+    """位置介於 [start, end) 的記錄"""
+    return _group_tracker.get_entries_between(channel_id, start, end)
+
+def get_channel_summary(channel_id: int) -> Optional[Tuple[str, int]]:
+    """頻道的滾動摘要與摘要涵蓋到的位置"""
+    return _group_tracker.get_channel_summary(channel_id)
+
+def set_channel_summary(channel_id: int, summary: str, position: int):
+    """更新頻道的滾動摘要"""
+    _group_tracker.set_channel_summary(channel_id, summary, position)
 
 def get_conversation_summary(character_id: str, channel_id: int) -> str:
     """生成對話摘要"""
     return _group_tracker.get_conversation_summary(character_id, channel_id)
 
-def get_recent_conversation_context(character_id: str, channel_id: int, limit: int = 10) -> List[dict]:
+def get_recent_conversation_context(character_id: str, channel_id: int, limit: int = 10) -> List[ConversationEntry]:
     """獲取最近的對話上下文"""
     return _group_tracker.get_recent_conversation_context(character_id, channel_id, limit)
 
-async def save_group_context_to_firestore(character_id: str, channel_id: int):
-    """將群組對話上下文保存到 Firestore"""
-    return await _group_tracker.save_group_context_to_firestore(character_id, channel_id)
-
 def cleanup_old_activity(character_id: str, minutes: int = 60):
     """清理過期的活動記錄"""
-    _group_tracker.cleanup_old_activity(character_id, minutes) 
\ No newline at end of file
+    _group_tracker.cleanup_old_activity(character_id, minutes) 
+
+def get_sweeper_stats() -> Dict[str, int]:
+    """背景清理的累計統計"""
+    return _group_tracker.sweeper_stats()
+
+def _run_benchmark(channel_count: int = 5000, messages_per_channel: int = 60):
+    """記憶體與吞吐量基準測試：比較舊版 dict + 串列切片與環狀緩衝區 + __slots__ 記錄"""
+    import random
+    import time
+    import tracemalloc
+
+    random.seed(41)
+    user_names = [f"使用者{i}" for i in range(200)]
+    events = [(random.randrange(channel_count), random.randrange(200)) for _ in range(channel_count * messages_per_channel)]
+
+    def legacy_store():
+        contexts: Dict[int, List[dict]] = {}
+        for channel_id, user in events:
+            context = contexts.setdefault(channel_id, [])
+            context.append({
+                'user_id': user,
+                'user_name': ''.join(user_names[user]),  # 模擬每則訊息帶來的新字串
+                'message': "哈囉大家今天過得如何",
+                'timestamp': datetime.now(),
+                'is_bot': False
+            })
+            if len(context) > CONTEXT_LIMIT:
+                contexts[channel_id] = context[-CONTEXT_LIMIT:]
+        return contexts
+
+    def ring_store():
+        contexts: Dict[int, Deque[ConversationEntry]] = {}
+        for channel_id, user in events:
+            buffer = contexts.get(channel_id)
+            if buffer is None:
+                buffer = contexts[channel_id] = deque(maxlen=CONTEXT_LIMIT)
+            buffer.append(ConversationEntry(user, ''.join(user_names[user]), "哈囉大家今天過得如何", datetime.now()))
+        return contexts
+
+    print(f"{channel_count} 個頻道、共 {len(events)} 則訊息")
+    print(f"{'實作':<16} {'吞吐量 (則/秒)':>16} {'保留記憶體 (MB)':>18}")
+    for label, store in (("dict + 切片", legacy_store), ("deque + __slots__", ring_store)):
+        start = time.perf_counter()
+        store()
+        elapsed = time.perf_counter() - start
+
+        # 記憶體另外量測，避免 tracemalloc 的額外負擔影響吞吐量
+        tracemalloc.start()
+        contexts = store()
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<16} {len(events) / elapsed:>16,.0f} {retained / 1024 / 1024:>18.1f}")
+        del contexts
+
+
+if __name__ == "__main__":
+    _run_benchmark()
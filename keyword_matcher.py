@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+多關鍵字比對模組
+以 Aho-Corasick 自動機一次掃描訊息，供主動關鍵字與表情符號情感關鍵字共用
+"""
+
+from collections import deque
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+
+class KeywordMatcher:
+    """Aho-Corasick 多關鍵字比對器（不分大小寫）
+
+    關鍵字分組並依順序決定優先權：比對結果返回出現於訊息中、順序最前面的分組標籤，
+    與逐一檢查每組關鍵字的結果相同，但每則訊息只需掃描一次。
+    """
+
+    NO_MATCH = -1
+
+    def __init__(self, groups: Sequence[Tuple[Hashable, Iterable[str]]]):
+        self.labels: List[Hashable] = [label for label, _ in groups]
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[int] = [self.NO_MATCH]  # 每個節點可比對到的最高優先分組
+        self._empty_match = self.NO_MATCH  # 空字串關鍵字永遠符合
+        self.keyword_count = 0
+
+        for priority, (_, keywords) in enumerate(groups):
+            for keyword in keywords:
+                self._add(keyword.lower(), priority)
+        self._build_failure_links()
+
+    @classmethod
+    def from_keywords(cls, keywords: Iterable[str]) -> "KeywordMatcher":
+        """建立單一分組的比對器"""
+        return cls([(True, keywords)])
+
+    @classmethod
+    def from_mapping(cls, mapping: Dict[Hashable, Iterable[str]]) -> "KeywordMatcher":
+        """依字典順序建立分組比對器（例如 {emotion: [keywords]}）"""
+        return cls(list(mapping.items()))
+
+    @staticmethod
+    def _better(a: int, b: int) -> int:
+        if a == KeywordMatcher.NO_MATCH:
+            return b
+        if b == KeywordMatcher.NO_MATCH:
+            return a
+        return min(a, b)
+
+    def _add(self, keyword: str, priority: int):
+        self.keyword_count += 1
+        if not keyword:
+            self._empty_match = self._better(self._empty_match, priority)
+            return
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(self.NO_MATCH)
+            node = next_node
+        self._output[node] = self._better(self._output[node], priority)
+
+    def _build_failure_links(self):
+        """建立失敗連結，並把非根節點的轉移預先展開成 DFA，掃描時不需沿失敗連結回溯"""
+        queue = deque(self._goto[0].values())
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._better(self._output[child], self._output[self._fail[child]])
+
+        # 根節點的轉移在掃描時另外查詢，其餘節點繼承失敗節點的轉移（依 BFS 順序，失敗節點一定先完成）
+        self._delta: List[Dict[str, int]] = [{} for _ in self._goto]
+        for node in order:
+            fail = self._fail[node]
+            inherited = self._delta[fail] if fail else {}
+            self._delta[node] = {**inherited, **self._goto[node]} if inherited else self._goto[node]
+
+    def _scan(self, text: str, stop_at_first: bool) -> int:
+        best = self._empty_match
+        if best == 0 or (stop_at_first and best != self.NO_MATCH):
+            return best
+        delta, root, output = self._delta, self._goto[0], self._output
+        no_match = self.NO_MATCH
+        node = 0
+        for char in text.lower():
+            node = delta[node].get(char) or root.get(char, 0)
+            found = output[node]
+            if found != no_match:
+                if best == no_match or found < best:
+                    best = found
+                if best == 0 or stop_at_first:
+                    break
+        return best
+
+    def contains_any(self, text: str) -> bool:
+        """訊息是否包含任一關鍵字（找到第一個就停止）"""
+        return self._scan(text, stop_at_first=True) != self.NO_MATCH
+
+    def first_label(self, text: str) -> Optional[Hashable]:
+        """返回訊息中出現的最高優先分組標籤"""
+        priority = self._scan(text, stop_at_first=False)
+        return None if priority == self.NO_MATCH else self.labels[priority]
+
+
+def _run_benchmark():
+    """微基準測試：比較逐一 `keyword in content` 與 Aho-Corasick 的每則訊息耗時"""
+    import random
+    import string
+    import timeit
+
+    random.seed(26)
+    alphabet = string.ascii_lowercase + "你我他好累開心難過生氣早安晚安哈哈"
+    messages = [''.join(random.choices(alphabet, k=random.randint(5, 120))) for _ in range(200)]
+
+    print(f"{'關鍵字數':>8} {'逐一比對 (µs/則)':>18} {'Aho-Corasick (µs/則)':>22} {'加速':>6}")
+    for keyword_count in (10, 50, 200, 1000):
+        keywords = [''.join(random.choices(alphabet, k=random.randint(2, 6))) for _ in range(keyword_count)]
+        groups = {f"emotion_{i}": keywords[i::8] for i in range(8)}
+        matcher = KeywordMatcher.from_mapping(groups)
+
+        def naive():
+            for message in messages:
+                content = message.lower()
+                next((emotion for emotion, words in groups.items() for word in words if word.lower() in content), None)
+
+        def compiled():
+            for message in messages:
+                matcher.first_label(message)
+
+        naive_time = min(timeit.repeat(naive, number=5, repeat=3)) / (5 * len(messages)) * 1e6
+        compiled_time = min(timeit.repeat(compiled, number=5, repeat=3)) / (5 * len(messages)) * 1e6
+        print(f"{keyword_count:>8} {naive_time:>18.2f} {compiled_time:>22.2f} {naive_time / compiled_time:>5.1f}x")
+
+
+if __name__ == "__main__":
+    _run_benchmark()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Gemini 呼叫排程模組
+所有角色共用同一組 API 金鑰，依優先通道（私訊／提及 > 主動關鍵字 > 背景記憶處理）與
+角色、伺服器間的加權公平佇列分配同時進行的呼叫數，過載時優先捨棄低優先工作
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from firebase_utils import firebase_manager
+from usage_tracker import current_usage_scope
+
+# 優先通道（數字越小越優先）
+LANE_INTERACTIVE = 0  # 私訊與直接提及
+LANE_PROACTIVE = 1    # 主動關鍵字回應
+LANE_BACKGROUND = 2   # 背景記憶提取與統整
+LANE_NAMES = ('interactive', 'proactive', 'background')
+
+# 常數定義
+DEFAULT_SCHEDULER_CONFIG = {
+    'max_concurrent': 4,   # 同時進行的 Gemini 呼叫上限
+    'max_queued': 40,      # 所有通道合計的等待上限，超過時捨棄最低優先的等待工作
+    'lane_max_queued': {'interactive': 40, 'proactive': 20, 'background': 10},
+    'lane_max_wait_s': {'interactive': 60, 'proactive': 30, 'background': 120},  # 等待超過此時間即放棄
+}
+MAX_FLOW_TAGS = 1000  # 保留的公平佇列流量標記上限
+
+
+class LLMSchedulerOverloaded(Exception):
+    """排程過載，請求被捨棄"""
+
+
+class _Waiter:
+    """等待中的呼叫（future 屬於呼叫端的事件迴圈）"""
+    __slots__ = ('lane', 'seq', 'finish', 'loop', 'future', 'state', 'enqueued_at')
+
+    def __init__(self, lane: int, seq: int, finish: float, loop: asyncio.AbstractEventLoop):
+        self.lane = lane
+        self.seq = seq
+        self.finish = finish
+        self.loop = loop
+        self.future = loop.create_future()
+        self.state = 'queued'  # queued → granted / dropped
+        self.enqueued_at = time.monotonic()
+
+
+class LLMScheduler:
+    """跨執行緒的 Gemini 呼叫排程器（所有角色 Bot 共用一個實例）
+
+    各通道內以虛擬完成時間做加權公平佇列：每個（角色, 伺服器）流量的請求標記為
+    max(通道虛擬時間, 該流量上次的標記) + 1 / 權重，永遠先放行標記最小的請求，
+    因此單一熱門伺服器無法佔滿所有名額。通道之間採嚴格優先。
+    """
+
+    def __init__(self):
+        self.firebase = firebase_manager
+        self._lock = threading.Lock()  # 各角色 Bot 在不同執行緒的事件迴圈中呼叫
+        self._queues: List[List[Tuple[float, int, _Waiter]]] = [[] for _ in LANE_NAMES]
+        self._queued = [0] * len(LANE_NAMES)
+        self._virtual_time = [0.0] * len(LANE_NAMES)
+        self._flow_tags: Dict[Tuple[int, str, str], float] = {}  # {(通道, character_id, guild_id): 上次標記}
+        self._active = 0
+        self._seq = itertools.count()
+        self._stats = {name: {'granted': 0, 'dropped_overload': 0, 'dropped_timeout': 0, 'evicted': 0, 'wait': 0.0}
+                       for name in LANE_NAMES}
+
+    def get_config(self) -> dict:
+        """從 prompt/system 的 llm_scheduler 欄位讀取設定"""
+        config = DEFAULT_SCHEDULER_CONFIG.copy()
+        config.update(self.firebase.get_firestore_field(
+            collection='prompt',
+            document='system',
+            field='llm_scheduler',
+            default={},
+            cache_key="llm_scheduler"
+        ) or {})
+        return config
+
+    def _get_weight(self, character_id: Optional[str]) -> float:
+        """角色的公平佇列權重（system.llm_weight，預設 1）"""
+        if not character_id:
+            return 1.0
+        weight = self.firebase.get_character_system_config(character_id).get('llm_weight', 1)
+        return max(float(weight), 0.01)
+
+    def _tag(self, lane: int, character_id: Optional[str], guild_id: Optional[str], weight: float) -> float:
+        """計算並記錄流量的虛擬完成時間（呼叫端需持有鎖）"""
+        flow = (lane, character_id or '', guild_id or 'dm')
+        finish = max(self._virtual_time[lane], self._flow_tags.get(flow, 0.0)) + 1 / weight
+        self._flow_tags[flow] = finish
+        if len(self._flow_tags) > MAX_FLOW_TAGS:
+            # 標記已落後虛擬時間的流量不再有影響，可以安全移除
+            self._flow_tags = {key: tag for key, tag in self._flow_tags.items()
+                               if tag > self._virtual_time[key[0]]}
+        return finish
+
+    def _evict_lowest(self, lane: int) -> Optional[_Waiter]:
+        """移除比指定通道優先權更低、最晚加入的等待工作（呼叫端需持有鎖）"""
+        for lower in range(len(LANE_NAMES) - 1, lane, -1):
+            candidates = [entry for entry in self._queues[lower] if entry[2].state == 'queued']
+            if candidates:
+                waiter = max(candidates, key=lambda entry: entry[1])[2]
+                waiter.state = 'dropped'
+                self._queued[lower] -= 1
+                self._stats[LANE_NAMES[lower]]['evicted'] += 1
+                return waiter
+        return None
+
+    def _pop_next(self) -> Optional[_Waiter]:
+        """取出最高優先通道中虛擬完成時間最小的等待工作（呼叫端需持有鎖）"""
+        for lane, queue in enumerate(self._queues):
+            while queue:
+                finish, _, waiter = heapq.heappop(queue)
+                if waiter.state != 'queued':
+                    continue  # 已逾時或被捨棄
+                self._virtual_time[lane] = max(self._virtual_time[lane], finish)
+                self._queued[lane] -= 1
+                return waiter
+        return None
+
+    def _grant(self, waiter: _Waiter):
+        """放行等待工作（呼叫端需持有鎖）"""
+        waiter.state = 'granted'
+        self._active += 1
+        stats = self._stats[LANE_NAMES[waiter.lane]]
+        stats['granted'] += 1
+        stats['wait'] += time.monotonic() - waiter.enqueued_at
+
+    def _notify(self, waiter: _Waiter, error: Optional[Exception] = None):
+        """在呼叫端的事件迴圈上喚醒等待工作"""
+        def resolve():
+            if waiter.future.done():
+                # 呼叫端已放棄等待，名額立即交還
+                if error is None:
+                    self.release()
+            elif error is None:
+                waiter.future.set_result(None)
+            else:
+                waiter.future.set_exception(error)
+        try:
+            waiter.loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # 事件迴圈已關閉
+            if error is None:
+                self.release()
+
+    async def acquire(self, lane: int, character_id: Optional[str] = None, guild_id: Optional[str] = None):
+        """取得一個呼叫名額；過載或等待逾時時拋出 LLMSchedulerOverloaded"""
+        config = self.get_config()
+        weight = self._get_weight(character_id)
+        lane_name = LANE_NAMES[lane]
+        loop = asyncio.get_running_loop()
+        evicted = None
+
+        with self._lock:
+            waiter = _Waiter(lane, next(self._seq), self._tag(lane, character_id, guild_id, weight), loop)
+            if self._active < config['max_concurrent'] and not any(self._queued):
+                # 不需排隊時也推進通道虛擬時間，避免閒置時大量呼叫的流量累積標記領先，競爭開始後被其他流量餓死
+                self._virtual_time[lane] = max(self._virtual_time[lane], waiter.finish)
+                self._grant(waiter)
+                return
+
+            if self._queued[lane] >= config['lane_max_queued'].get(lane_name, config['max_queued']):
+                self._stats[lane_name]['dropped_overload'] += 1
+                raise LLMSchedulerOverloaded(f"{lane_name} 通道等待數已達上限")
+            if sum(self._queued) >= config['max_queued']:
+                evicted = self._evict_lowest(lane)
+                if evicted is None:
+                    self._stats[lane_name]['dropped_overload'] += 1
+                    raise LLMSchedulerOverloaded("排程等待數已達上限")
+
+            heapq.heappush(self._queues[lane], (waiter.finish, waiter.seq, waiter))
+            self._queued[lane] += 1
+
+        if evicted is not None:
+            print(f"🚮 排程過載，捨棄一個 {LANE_NAMES[evicted.lane]} 工作")
+            self._notify(evicted, LLMSchedulerOverloaded("被較高優先的工作取代"))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), config['lane_max_wait_s'].get(lane_name, 60))
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter.state == 'queued':
+                    waiter.state = 'dropped'
+                    self._queued[lane] -= 1
+                    self._stats[lane_name]['dropped_timeout'] += 1
+                    raise LLMSchedulerOverloaded(f"{lane_name} 通道等待逾時")
+            # 逾時的同時剛好被放行：等待通知送達後照常使用名額
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.state == 'queued':
+                    waiter.state = 'dropped'
+                    self._queued[lane] -= 1
+                    raise
+            # 已被放行但呼叫端取消：等通知送達後交還名額
+            waiter.future.add_done_callback(lambda future: future.exception() is None and self.release())
+            raise
+
+    def release(self):
+        """交還名額並放行下一個等待工作"""
+        with self._lock:
+            self._active -= 1
+            waiter = self._pop_next()
+            if waiter is not None:
+                self._grant(waiter)
+        if waiter is not None:
+            self._notify(waiter)
+
+    @asynccontextmanager
+    async def slot(self, lane: int, character_id: Optional[str] = None, guild_id: Optional[str] = None):
+        """在名額內執行一段 Gemini 呼叫；未指定時依目前的用量歸屬決定角色與伺服器"""
+        scope = current_usage_scope()
+        await self.acquire(lane, character_id or scope.character_id, guild_id or scope.guild_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, dict]:
+        """各通道的放行、捨棄次數、平均等待時間與目前等待數"""
+        with self._lock:
+            result = {
+                name: {
+                    'granted': stats['granted'],
+                    'dropped_overload': stats['dropped_overload'],
+                    'dropped_timeout': stats['dropped_timeout'],
+                    'evicted': stats['evicted'],
+                    'avg_wait': stats['wait'] / stats['granted'] if stats['granted'] else 0.0,
+                    'queued': self._queued[lane],
+                }
+                for lane, (name, stats) in enumerate(self._stats.items())
+            }
+            result['active'] = self._active
+            return result
+
+
+# 全域排程器實例
+llm_scheduler = LLMScheduler()
+
+
+def _run_fairness_check():
+    """公平性檢查：一個角色先在無競爭時大量呼叫，之後兩個角色同時排隊時應交錯放行"""
+    async def main():
+        scheduler = LLMScheduler()
+        scheduler.get_config = lambda: dict(DEFAULT_SCHEDULER_CONFIG, max_concurrent=1)
+        scheduler._get_weight = lambda character_id: 1.0
+        for _ in range(50):
+            async with scheduler.slot(LANE_INTERACTIVE, 'A', 'guild'):
+                pass
+
+        order = []
+
+        async def call(character_id: str):
+            async with scheduler.slot(LANE_INTERACTIVE, character_id, 'guild'):
+                order.append(character_id)
+                await asyncio.sleep(0)
+
+        blocker = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot(LANE_INTERACTIVE, 'C', 'guild'):
+                await blocker.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        calls = [asyncio.create_task(call(character_id)) for character_id in 'AB' * 8]
+        await asyncio.sleep(0)
+        blocker.set()
+        await asyncio.gather(holder, *calls)
+        return ''.join(order)
+
+    order = asyncio.run(main())
+    longest_run = max(len(run) for run in order.replace('AB', 'A B').replace('BA', 'B A').split())
+    print(f"放行順序：{order}")
+    assert longest_run <= 2, "無競爭的呼叫累積了標記領先，競爭時未交錯放行"
+    print("✅ 兩個角色交錯放行")
+
+
+if __name__ == "__main__":
+    _run_fairness_check()
@@ -14,6 +14,7 @@ from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 from firebase_utils import firebase_manager
 from character_bot import run_character_bot_with_restart
+from character_catalog import character_catalog
 
 # 設定 Discord 日誌級別，減少詳細訊息
 logging.getLogger('discord.client').setLevel(logging.WARNING)
@@ -45,27 +46,15 @@ class MultiBotLauncher:
             return []
         
         # 排除的集合名稱（範本、測試等）
-        excluded_collections = ["template", "prompt"]
+        excluded_collections = ["template", "prompt", "usage", "group_context"]
         
         try:
             # 獲取所有頂層集合
             collections = self.db.collections()
-            character_ids = []
+            candidate_ids = [collection.id for collection in collections if collection.id not in excluded_collections]
             
-            for collection in collections:
-                collection_id = collection.id
-                
-                # 檢查是否在排除清單中
-                if collection_id in excluded_collections:
-                    continue
-                
-                # 檢查是否為角色集合（有 system 文件）
-                system_ref = self.db.collection(collection_id).document('system')
-                system_doc = system_ref.get()
-                
-                if system_doc.exists:
-                    character_ids.append(collection_id)
-            return character_ids
+            # 以單次批次讀取載入所有候選集合的 profile、system、emoji_system，有 system 文件的才是角色集合
+            return character_catalog.load(candidate_ids)
             
         except Exception as e:
             self.firebase.log_error("獲取角色集合", e)
@@ -84,13 +73,10 @@ class MultiBotLauncher:
             
             for character_id in character_ids:
                 try:
-                    # 從 Firestore 讀取系統配置
-                    system_ref = self.db.collection(character_id).document('system')
-                    system_doc = system_ref.get()
+                    # 從角色目錄讀取系統配置（已在批次讀取時載入）
+                    system_config = character_catalog.get_system(character_id)
                     
-                    if system_doc.exists:
-                        system_config = system_doc.to_dict()
-                        
+                    if system_config:
                         if system_config.get('enabled', True):  # 只載入啟用的角色
                             character_name = system_config.get('name', character_id)
                             bots.append({
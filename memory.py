@@ -6,17 +6,29 @@
 from dotenv import load_dotenv
 load_dotenv()
 import asyncio
+import inspect
+import time
+import weakref
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, NamedTuple, Optional
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from firebase_utils import firebase_manager
+from memory_index import memory_retriever
+from memory_cache import UserMemoryCache
+from memory_consolidation import consolidation_scheduler
+from model_router import model_router
+from message_complexity import classify_message, complexity_tier_stats
+from usage_tracker import usage_tracker
+from llm_scheduler import llm_scheduler, LLMSchedulerOverloaded, LANE_INTERACTIVE, LANE_PROACTIVE, LANE_BACKGROUND
 from functools import wraps
 
 
 # 常數定義
 DEFAULT_MODEL = 'gemini-2.0-flash'  # 預設模型
 DEFAULT_RESPONSE_MODEL = 'gemini-2.5-pro'  # 預設回應模型
+DEFAULT_RETRIEVAL_CONFIG = {'mode': 'recent', 'top_k': 5, 'recent': 3}  # 預設記憶檢索設定
 
 # 全域配置 Gemini API
 import os
@@ -27,43 +39,43 @@ if api_key:
 else:
     print("⚠️ 未找到 GOOGLE_API_KEY")
 
+class MemoryContext(NamedTuple):
+    """單一記憶請求的上下文（角色與使用者名稱）"""
+    character_id: Optional[str] = None
+    character_name: str = "角色"
+    user_name: str = "使用者"
+
+# 每個 asyncio task 各自擁有的記憶上下文，並行的記憶處理不會互相覆蓋
+_memory_context: ContextVar[MemoryContext] = ContextVar('memory_context', default=MemoryContext())
+
 def with_character_context(func):
-    """裝飾器：自動為函式提供 character_name 和 user_name 變數"""
+    """裝飾器：在呼叫期間設定 character_name 和 user_name 上下文"""
+    signature = inspect.signature(func)
+    
+    def build_context(self, args, kwargs) -> MemoryContext:
+        # 從參數中提取 character_id 和 user_name（支援位置參數與關鍵字參數）
+        bound = signature.bind_partial(self, *args, **kwargs)
+        character_id = bound.arguments.get('character_id')
+        user_name = bound.arguments.get('user_name') or "使用者"
+        character_name = self.resolve_character_name(character_id) if character_id else "角色"
+        return MemoryContext(character_id, character_name, user_name)
+    
     @wraps(func)
     async def wrapper(self, *args, **kwargs):
-        # 從參數中提取 character_id 和 user_name
-        character_id = kwargs.get('character_id') or (args[0] if args else None)
-        user_name = kwargs.get('user_name', "使用者")
-        
-        # 從 character_id 獲取 character_name
-        if character_id:
-            system_config = self.firebase.get_character_system_config(character_id)
-            character_name = system_config.get('name', character_id)
-        else:
-            character_name = "角色"
-        
-        # 將變數添加到 self 中，讓所有方法都能使用
-        self._current_character_name = character_name
-        self._current_user_name = user_name
-        
-        return await func(self, *args, **kwargs)
+        token = _memory_context.set(build_context(self, args, kwargs))
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            _memory_context.reset(token)
     
     @wraps(func)
     def sync_wrapper(self, *args, **kwargs):
         # 同步版本的裝飾器
-        character_id = kwargs.get('character_id') or (args[0] if args else None)
-        user_name = kwargs.get('user_name', "使用者")
-        
-        if character_id:
-            system_config = self.firebase.get_character_system_config(character_id)
-            character_name = system_config.get('name', character_id)
-        else:
-            character_name = "角色"
-        
-        self._current_character_name = character_name
-        self._current_user_name = user_name
-        
-        return func(self, *args, **kwargs)
+        token = _memory_context.set(build_context(self, args, kwargs))
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            _memory_context.reset(token)
     
     # 根據函式是否為 async 返回對應的裝飾器
     if asyncio.iscoroutinefunction(func):
@@ -77,35 +89,64 @@ class MemoryManager:
     def __init__(self):
         # 使用統一的 Firebase 管理器
         self.firebase = firebase_manager
-        # 初始化當前上下文變數
-        self._current_character_name = "角色"
-        self._current_user_name = "使用者"
+        # 每個（角色, 使用者）記憶列表的 LRU 快取
+        self.memory_cache = UserMemoryCache()
+        # 分層摘要快取：[長期印象, 中期摘要...]
+        self.tier_cache = UserMemoryCache()
+        # 預先解析的角色名稱 {character_id: character_name}
+        self._character_names: Dict[str, str] = {}
+        # 每個（角色, 使用者）的寫入鎖，避免同一使用者的記憶並行寫入時互相覆蓋
+        self._user_locks: "weakref.WeakValueDictionary[tuple, asyncio.Lock]" = weakref.WeakValueDictionary()
     
     @property
     def db(self):
         """獲取 Firestore 資料庫實例"""
         return self.firebase.db
     
+    @property
+    def context(self) -> MemoryContext:
+        """獲取當前請求的記憶上下文"""
+        return _memory_context.get()
+    
     @property
     def character_name(self):
         """獲取當前角色名稱"""
-        return self._current_character_name
+        return _memory_context.get().character_name
     
     @property
     def user_name(self):
         """獲取當前使用者名稱"""
-        return self._current_user_name
+        return _memory_context.get().user_name
+    
+    def resolve_character_name(self, character_id: str) -> str:
+        """獲取角色名稱，只在第一次使用時讀取系統設定"""
+        character_name = self._character_names.get(character_id)
+        if character_name is None:
+            system_config = self.firebase.get_character_system_config(character_id)
+            character_name = system_config.get('name', character_id)
+            self._character_names[character_id] = character_name
+        return character_name
+    
+    def _get_user_lock(self, character_id: str, user_id: str) -> asyncio.Lock:
+        """獲取（角色, 使用者）的寫入鎖"""
+        key = (character_id, user_id)
+        lock = self._user_locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._user_locks[key] = lock
+        return lock
     
     def format_with_context(self, text: str) -> str:
         """使用當前上下文格式化文字"""
+        context = _memory_context.get()
         try:
             return text.format(
-                character_name=self._current_character_name,
-                user_name=self._current_user_name
+                character_name=context.character_name,
+                user_name=context.user_name
             )
         except KeyError as e:
             print(f"❌ 格式化文字時使用了不存在的變數：{e}")
-            print(f"📋 可用變數：character_name={self._current_character_name}, user_name={self._current_user_name}")
+            print(f"📋 可用變數：character_name={context.character_name}, user_name={context.user_name}")
             return text
     
     def _get_prompt_and_model(self, prompt_type: str, character_id: str = None) -> tuple[str, str]:
@@ -151,7 +192,10 @@ class MemoryManager:
             else:
                 prompt = f"{formatted_prompt}\n\nConversation:\n{content}"
             
-            response = await asyncio.to_thread(model.generate_content, prompt)
+            # 記憶提取與統整走最低優先的背景通道
+            async with llm_scheduler.slot(LANE_BACKGROUND, self.context.character_id):
+                response = await asyncio.to_thread(model.generate_content, prompt)
+            usage_tracker.record(prompt_type, model_name, getattr(response, 'usage_metadata', None), self.context.character_id)
             result = response.text.strip() if response.text else ""
             
             if self.firebase.is_empty_response(result):
@@ -160,6 +204,8 @@ class MemoryManager:
             
             return result
             
+        except LLMSchedulerOverloaded:
+            raise
         except Exception as e:
             return self.firebase.log_error(f"{prompt_type} 處理", e, self._get_fallback_response(prompt_type, content))
     
@@ -179,65 +225,181 @@ class MemoryManager:
             print("❌ Firestore 資料庫連接失敗，無法保存記憶")
             return False
             
+        # 用量達預算時略過記憶提取
+        if usage_tracker.should_skip_memory(character_id):
+            print(f"💸 {self.character_name} 今日用量已達預算，略過記憶提取：{user_id}")
+            return True
+        
         try:
             print(f"📝 正在處理記憶：{character_id} - {user_id}")
             
             # 使用統一的 Gemini 處理方法
             summarized_memory = await self._process_with_gemini('user_memories', content)
             
-            # 獲取或建立記憶文檔
-            doc_ref = self.db.collection(character_id).document('users')
-            doc = doc_ref.get()  # type: ignore
-            all_users_memories = doc.to_dict() if doc.exists else {}
-            
-            if not doc.exists:
-                print(f"🆕 為角色 {self.character_name} 建立新的使用者記憶文檔")
-            
-            # 更新使用者記憶
-            user_memories = all_users_memories.get(user_id, [])
-            user_memories.append(summarized_memory)
+            # 同一使用者的讀取、附加與寫入需依序進行；不同使用者與角色可完全並行
+            async with self._get_user_lock(character_id, user_id):
+                # 更新使用者記憶（優先使用快取，避免重複讀取整份文件）
+                user_memories = self._load_user_memories(character_id, user_id)
+                user_memories.append(summarized_memory)
+                
+                # 只寫入此使用者的欄位，寫入成功後同步更新快取
+                doc_ref = self.db.collection(character_id).document('users')
+                doc_ref.set({user_id: user_memories}, merge=True)
+                self.memory_cache.put((character_id, user_id), user_memories)
             
-            # 檢查記憶限制並統整
+            # 超過記憶門檻時交給背景排程統整，不佔用回應流程
             memory_limit = firebase_manager.get_memory_limit()
             if len(user_memories) > memory_limit:
-                print(f"📋 使用者 {user_id} 記憶超過 {memory_limit} 則，正在統整記憶……")
-                consolidated_memory = await self._process_with_gemini('memories_summary', "", user_memories)
-                user_memories = [consolidated_memory]
-                print(f"✅ 記憶已統整完成")
-            
-            # 保存到 Firestore
-            all_users_memories[user_id] = user_memories
-            doc_ref.set(all_users_memories)
+                consolidation_scheduler.schedule(character_id, user_id, user_name, len(user_memories))
+            else:
+                consolidation_scheduler.touch(character_id, user_id)
             
             print(f"✅ 記憶保存成功：使用者 {user_id} 現有 {len(user_memories)} 則記憶")
             return True
             
+        except LLMSchedulerOverloaded as e:
+            print(f"🚮 Gemini 排程過載，略過記憶提取：{user_id}（{e}）")
+            return False
         except Exception as e:
             self.firebase.log_error("保存記憶", e)
             return False
 
+    def _load_user_memories(self, character_id: str, user_id: str) -> List[str]:
+        """讀取使用者的完整記憶列表，快取未命中時才讀取 Firestore"""
+        cache_key = (character_id, user_id)
+        cached_memories = self.memory_cache.get(cache_key)
+        if cached_memories is not None:
+            return cached_memories
+        
+        user_memories = []
+        doc_ref = self.db.collection(character_id).document('users')
+        doc = doc_ref.get()  # type: ignore
+        
+        if doc.exists:
+            data = doc.to_dict()
+            if data and user_id in data:
+                user_memories = data[user_id]
+        
+        self.memory_cache.put(cache_key, user_memories)
+        return list(user_memories)
+
+    def _load_user_tiers(self, character_id: str, user_id: str) -> tuple[str, List[str]]:
+        """讀取使用者的分層摘要（長期印象, 中期摘要列表）"""
+        cache_key = (character_id, user_id)
+        cached_tiers = self.tier_cache.get(cache_key)
+        if cached_tiers is None:
+            tiers = {}
+            doc = self.db.collection(character_id).document('memory_tiers').get()  # type: ignore
+            if doc.exists:
+                tiers = (doc.to_dict() or {}).get(user_id, {})
+            cached_tiers = [tiers.get('profile', '')] + list(tiers.get('mid_term', []))
+            self.tier_cache.put(cache_key, cached_tiers)
+        return cached_tiers[0], cached_tiers[1:]
+
+    def _load_layered_memories(self, character_id: str, user_id: str) -> tuple[List[str], List[str]]:
+        """讀取分層記憶，返回（長期印象, 中期摘要 + 近期原始記憶）"""
+        profile, mid_term = self._load_user_tiers(character_id, user_id)
+        return ([profile] if profile else []), mid_term + self._load_user_memories(character_id, user_id)
+
     @with_character_context
     def get_character_user_memory(self, character_id: str, user_id: str, limit: int = 25) -> List[str]:
-        """獲取角色與使用者的對話記憶"""
+        """獲取角色與使用者的對話記憶（長期印象、中期摘要與近期記憶）"""
         if not self.db:
             return []
             
         try:
-            doc_ref = self.db.collection(character_id).document('users')
-            doc = doc_ref.get()  # type: ignore
-            
-            if doc.exists:
-                data = doc.to_dict()
-                if data and user_id in data:
-                    user_memories = data[user_id]
-                    return user_memories[-limit:] if len(user_memories) > limit else user_memories
-            
-            return []
+            profile, user_memories = self._load_layered_memories(character_id, user_id)
+            return profile + (user_memories[-limit:] if len(user_memories) > limit else user_memories)
                 
         except Exception as e:
             self.firebase.log_error("獲取記憶", e)
             return []
 
+    def get_retrieval_config(self, character_id: str) -> dict:
+        """獲取角色的記憶檢索設定（system/memory_retrieval）"""
+        config = DEFAULT_RETRIEVAL_CONFIG.copy()
+        config.update(self.firebase.get_character_system_config(character_id).get('memory_retrieval') or {})
+        return config
+
+    @with_character_context
+    async def get_relevant_character_user_memory(self, character_id: str, user_id: str, query: str, limit: int = 25) -> List[str]:
+        """依目前訊息獲取最相關的記憶；未啟用 relevance 模式時返回最近的記憶"""
+        if not self.db:
+            return []
+        
+        try:
+            # 快取未命中時會讀取 Firestore，放到工作執行緒避免阻塞事件迴圈
+            profile, user_memories = await asyncio.to_thread(self._load_layered_memories, character_id, user_id)
+        except Exception as e:
+            self.firebase.log_error("獲取記憶", e)
+            return []
+        
+        recent_memories = profile + user_memories[-limit:]
+        config = self.get_retrieval_config(character_id)
+        if config.get('mode') != 'relevance' or not memory_retriever.available:
+            return recent_memories
+        
+        try:
+            return profile + await asyncio.to_thread(
+                memory_retriever.rank, character_id, user_id, user_memories, query,
+                int(config.get('top_k', 5)), int(config.get('recent', 3))
+            )
+        except Exception as e:
+            return self.firebase.log_error("相關記憶檢索", e, recent_memories)
+
+    @with_character_context
+    async def consolidate_user_memories(self, character_id: str, user_id: str, user_name: str = "使用者",
+                                        keep_recent: int = 5, mid_term_limit: int = 5) -> bool:
+        """將較舊的原始記憶統整為中期摘要，中期摘要過多時再併入長期印象"""
+        if not self.db:
+            return False
+        
+        lock = self._get_user_lock(character_id, user_id)
+        # Firestore 讀寫都在工作執行緒中進行，不阻塞 Bot 的事件迴圈
+        async with lock:
+            raw_memories = await asyncio.to_thread(self._load_user_memories, character_id, user_id)
+        if len(raw_memories) <= keep_recent:
+            return True
+        
+        # Gemini 呼叫不持有鎖，統整期間仍可寫入新記憶
+        folded = raw_memories[:-keep_recent]
+        summary = await self._process_with_gemini('memories_summary', "", folded)
+        if summary == self._get_fallback_response('memories_summary', ""):
+            print(f"⚠️ 記憶統整失敗，保留原始記憶：{character_id} - {user_id}")
+            return False
+        
+        profile, mid_term = await asyncio.to_thread(self._load_user_tiers, character_id, user_id)
+        mid_term.append(summary)
+        if len(mid_term) > mid_term_limit:
+            # 優先使用 memories_profile 提示詞，未設定時沿用 memories_summary
+            profile_prompt_type = 'memories_profile' if self.firebase.get_prompt_with_model('memories_profile')[0].strip() else 'memories_summary'
+            overflow = mid_term[:len(mid_term) - mid_term_limit + 1]
+            new_profile = await self._process_with_gemini(profile_prompt_type, "", ([profile] if profile else []) + overflow)
+            if new_profile != self._get_fallback_response(profile_prompt_type, ""):
+                profile = new_profile
+                mid_term = mid_term[len(overflow):]
+        
+        async with lock:
+            # 只移除已統整的舊記憶，保留統整期間新增的記憶
+            current = await asyncio.to_thread(self._load_user_memories, character_id, user_id)
+            if current[:len(folded)] == folded:
+                remaining = current[len(folded):]
+            else:
+                folded_set = set(folded)
+                remaining = [m for m in current if m not in folded_set]
+            
+            batch = self.db.batch()
+            batch.set(self.db.collection(character_id).document('memory_tiers'),
+                      {user_id: {'profile': profile, 'mid_term': mid_term, 'updated_at': datetime.now()}}, merge=True)
+            batch.set(self.db.collection(character_id).document('users'), {user_id: remaining}, merge=True)
+            await asyncio.to_thread(batch.commit)
+            
+            self.tier_cache.put((character_id, user_id), [profile] + mid_term)
+            self.memory_cache.put((character_id, user_id), remaining)
+        
+        print(f"✅ 記憶已統整完成：使用者 {user_id} 近期 {len(remaining)} 則、中期摘要 {len(mid_term)} 則")
+        return True
+
 # 全域記憶管理器實例
 _memory_manager = MemoryManager()
 
@@ -249,16 +411,60 @@ def get_character_user_memory(character_id: str, user_id: str, limit: int = 25)
     """獲取角色與使用者的對話記憶"""
     return _memory_manager.get_character_user_memory(character_id, user_id, limit)
 
+async def get_relevant_character_user_memory(character_id: str, user_id: str, query: str, limit: int = 25) -> List[str]:
+    """依目前訊息獲取最相關的角色與使用者記憶"""
+    return await _memory_manager.get_relevant_character_user_memory(character_id, user_id, query, limit)
+
+async def consolidate_user_memories(character_id: str, user_id: str, user_name: str = "使用者",
+                                    keep_recent: int = 5, mid_term_limit: int = 5) -> bool:
+    """統整使用者記憶為分層摘要"""
+    return await _memory_manager.consolidate_user_memories(character_id, user_id, user_name,
+                                                          keep_recent=keep_recent, mid_term_limit=mid_term_limit)
+
+def _resolve_response_config(character_id: str):
+    """讀取回應生成需要的角色配置與 system 提示詞（結果會留在 Firebase 管理器的快取中）"""
+    firebase_manager.get_character_gemini_config(character_id)
+    firebase_manager.get_character_prompt_config(character_id, 'system')
+    usage_tracker.get_degraded_model(character_id)
+
+async def prefetch_response_config(character_id: str):
+    """在工作執行緒中預先解析回應配置，讓生成時直接命中快取"""
+    try:
+        await asyncio.to_thread(_resolve_response_config, character_id)
+    except Exception as e:
+        firebase_manager.log_error(f"預先解析 {character_id} 回應配置", e)
+
+async def prefetch_user_memories(character_id: str, user_id: str) -> float:
+    """預先載入使用者的分層記憶到快取，返回載入耗時（秒）"""
+    if not _memory_manager.db:
+        return 0.0
+    start_time = time.perf_counter()
+    try:
+        await asyncio.to_thread(_memory_manager._load_layered_memories, character_id, user_id)
+    except Exception as e:
+        firebase_manager.log_error(f"預取 {character_id} - {user_id} 記憶", e)
+    return time.perf_counter() - start_time
+
+def get_memory_cache_stats() -> Dict[str, float]:
+    """獲取記憶快取的命中率統計"""
+    return _memory_manager.memory_cache.stats()
+
+def preload_character_name(character_id: str) -> str:
+    """預先解析角色名稱，之後的記憶處理不再讀取系統設定"""
+    return _memory_manager.resolve_character_name(character_id)
+
 def get_current_context() -> tuple[str, str]:
     """獲取當前上下文（角色名稱和使用者名稱）"""
-    return _memory_manager.character_name, _memory_manager.user_name
+    context = _memory_manager.context
+    return context.character_name, context.user_name
 
 def format_text_with_context(text: str) -> str:
     """使用當前上下文格式化文字"""
     return _memory_manager.format_with_context(text)
 
 def _build_system_prompt(character_name: str, character_persona: str, user_display_name: str, 
-                        group_context: str, user_memories: List[str], user_prompt: str, character_id: str = None) -> str:
+                        group_context: str, user_memories: List[str], user_prompt: str, character_id: str = None,
+                        batched_inputs: Optional[List[tuple]] = None) -> str:
     """構建系統提示詞"""
     # 獲取系統提示詞模板
     if character_id:
@@ -279,6 +485,12 @@ def _build_system_prompt(character_name: str, character_persona: str, user_displ
     
     memory_context = "\n".join(user_memories) if user_memories else "暫無記憶"
     
+    # 合併的多則訊息逐行列出，回應時需顧及每一位使用者
+    if batched_inputs:
+        current_input = "\n".join(f"{name}：{text}" for name, text in batched_inputs)
+    else:
+        current_input = f"{user_display_name}：{user_prompt}"
+    
     return f"""{formatted_system_prompt}
 
 ## 角色設定
@@ -291,14 +503,14 @@ def _build_system_prompt(character_name: str, character_persona: str, user_displ
 {memory_context}
 
 ## 目前輸入
-{user_display_name}：{user_prompt}
+{current_input}
 """
 
-async def generate_character_response(character_name: str, character_persona: str, user_memories: List[str], user_prompt: str, user_display_name: str, group_context: str = "", gemini_config: Optional[dict] = None, character_id: str = None) -> str:
-    """生成角色回應"""
+async def generate_character_response(character_name: str, character_persona: str, user_memories: List[str], user_prompt: str, user_display_name: str, group_context: str = "", gemini_config: Optional[dict] = None, character_id: str = None, is_dm: bool = False, is_mention: bool = False, batched_inputs: Optional[List[tuple]] = None) -> Optional[str]:
+    """生成角色回應；Gemini 排程過載而放棄時返回 None"""
     try:
         # 合併配置設定
-        firestore_config = firebase_manager.get_character_gemini_config(character_name)
+        firestore_config = firebase_manager.get_character_gemini_config(character_id or character_name)
         merged_config = firestore_config.copy()
         if gemini_config:
             merged_config.update(gemini_config)
@@ -308,21 +520,59 @@ async def generate_character_response(character_name: str, character_persona: st
             print(f"⚠️ 角色 {character_name} 被停用")
             return "「我現在不太方便說話……」"
         
-        # 顯示設定資訊
+        # 依訊息複雜度選擇模型與輸出長度（gemini_config.complexity_tiers）
         model_name = merged_config.get('model', DEFAULT_RESPONSE_MODEL)
+        context_length = len(group_context) + sum(len(m) for m in user_memories)
+        if batched_inputs:
+            user_prompt_for_scoring = "\n".join(text for _, text in batched_inputs)
+        else:
+            user_prompt_for_scoring = user_prompt
+        complexity = classify_message(user_prompt_for_scoring, merged_config.get('complexity_tiers', []), is_dm, is_mention, context_length)
+        if complexity.model:
+            model_name = complexity.model
+        if complexity.max_output_tokens:
+            merged_config['max_output_tokens'] = complexity.max_output_tokens
+        
+        # 用量接近每日預算時改用較便宜的模型
+        actual_character_id = character_id if character_id else character_name
+        degraded_model = usage_tracker.get_degraded_model(actual_character_id)
+        if degraded_model and degraded_model != model_name:
+            print(f"💸 {character_name} 今日用量接近預算，改用 {degraded_model}")
+            model_name = degraded_model
+        
+        # 顯示設定資訊
         if firestore_config:
             print(f"🎭 使用角色 {character_name} 的設定: model={model_name}, temp={merged_config.get('temperature', '預設')}")
         
-        # 建立模型和提示詞
-        model = _memory_manager._create_gemini_model(model_name, merged_config)
-        actual_character_id = character_id if character_id else character_name
+        # 建立提示詞
         system_prompt = _build_system_prompt(character_name, character_persona, user_display_name, 
-                                           group_context, user_memories, user_prompt, actual_character_id)
+                                           group_context, user_memories, user_prompt, actual_character_id,
+                                           batched_inputs)
         
-        # 生成回應
-        response = await asyncio.to_thread(model.generate_content, system_prompt)
+        # 依路由策略生成回應（對沖、重試退避、斷路器與備援模型）
+        # 私訊與提及走最高優先通道，主動關鍵字回應次之
+        routing_policy = model_router.get_policy(merged_config)
+        lane = LANE_INTERACTIVE if is_dm or is_mention else LANE_PROACTIVE
+        async with llm_scheduler.slot(lane, actual_character_id):
+            start_time = time.perf_counter()
+            response, used_model = await model_router.generate(
+                system_prompt,
+                [model_name] + list(routing_policy['fallback_models']),
+                lambda name: _memory_manager._create_gemini_model(name, merged_config),
+                routing_policy,
+                # 每次呼叫（包含落敗的對沖與重試）都計入用量
+                lambda name, usage: usage_tracker.record('system', name, usage, actual_character_id)
+            )
+        if used_model != model_name:
+            print(f"🔀 {character_name} 的回應改由 {used_model} 生成")
+        usage_metadata = getattr(response, 'usage_metadata', None)
+        complexity_tier_stats.record(complexity.tier, used_model, time.perf_counter() - start_time, usage_metadata)
         return response.text if response.text else "「抱歉，我現在腦中沒什麼想法……」"
         
+    except LLMSchedulerOverloaded as e:
+        # 過載時直接放棄這次回應，不回覆錯誤訊息
+        print(f"🚮 Gemini 排程過載，略過 {character_name} 的回應：{e}")
+        return None
     except ValueError as e:
         print(f"❌ {e}")
         return "「抱歉，我現在有點累……」"
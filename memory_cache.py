@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+記憶快取模組
+以 LRU 方式快取每個（角色, 使用者）的記憶列表，減少 Firestore 讀取
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+# 常數定義
+DEFAULT_MAX_ENTRIES = 1024  # 最多快取的使用者數
+DEFAULT_TTL = 600  # 快取有效時間（秒）
+
+
+class UserMemoryCache:
+    """（角色, 使用者）記憶列表的 LRU 快取，具容量與 TTL 限制"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple[float, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[List[str]]:
+        """讀取快取；過期或不存在時返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            stored_at, memories = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(memories)
+
+    def put(self, key: Hashable, memories: List[str]):
+        """寫入快取（寫入時複製，避免呼叫端修改快取內容）"""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), list(memories))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """移除指定快取"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """清除所有快取"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """快取命中率等統計資訊"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+記憶統整排程模組
+在使用者閒置或離峰時段於背景統整記憶，建立分層摘要（近期原始記憶、中期摘要、長期印象）
+"""
+
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+from zoneinfo import ZoneInfo
+from firebase_utils import firebase_manager
+from usage_tracker import usage_scope
+from llm_scheduler import LLMSchedulerOverloaded
+
+# 常數定義
+DEFAULT_CONSOLIDATION_CONFIG = {
+    'keep_recent': 5,           # 統整後保留的近期原始記憶數
+    'mid_term_limit': 5,        # 中期摘要上限，超過時併入長期印象
+    'idle_minutes': 10,         # 使用者閒置多久後開始統整
+    'off_peak_hours': [2, 7],   # 離峰時段（當地時間，起訖小時）
+    'timezone': 'Asia/Taipei',
+    'max_concurrent_jobs': 2,   # 同時進行的統整工作上限
+    'check_interval': 60,       # 排程檢查間隔（秒）
+}
+
+
+class PendingConsolidation:
+    """等待中的統整工作"""
+    __slots__ = ('user_name', 'last_activity', 'memory_count')
+
+    def __init__(self, user_name: str, memory_count: int):
+        self.user_name = user_name
+        self.last_activity = time.monotonic()
+        self.memory_count = memory_count
+
+
+class MemoryConsolidationScheduler:
+    """背景記憶統整排程器（所有角色共用，限制同時進行的工作數）"""
+
+    def __init__(self):
+        self.firebase = firebase_manager
+        self._pending: Dict[Tuple[str, str], PendingConsolidation] = {}
+        self._owners: Dict[str, asyncio.AbstractEventLoop] = {}  # {character_id: event_loop}
+        self._runners: Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+        self._jobs: Set[asyncio.Task] = set()  # 保留進行中工作的參照，避免執行途中被回收
+        self._running = 0
+        self._lock = threading.Lock()  # 各角色 Bot 在不同執行緒中運行
+        self.completed = 0
+        self.failed = 0
+
+    def get_config(self) -> dict:
+        """從 prompt/memories_summary 的 consolidation 欄位讀取設定"""
+        config = DEFAULT_CONSOLIDATION_CONFIG.copy()
+        config.update(self.firebase.get_firestore_field(
+            collection='prompt',
+            document='memories_summary',
+            field='consolidation',
+            default={},
+            cache_key="memory_consolidation"
+        ) or {})
+        return config
+
+    def schedule(self, character_id: str, user_id: str, user_name: str, memory_count: int):
+        """登記需要統整的使用者；實際統整在背景進行"""
+        with self._lock:
+            job = self._pending.get((character_id, user_id))
+            if job is None:
+                self._pending[(character_id, user_id)] = PendingConsolidation(user_name, memory_count)
+            else:
+                job.user_name = user_name
+                job.last_activity = time.monotonic()
+                job.memory_count = memory_count
+
+    def touch(self, character_id: str, user_id: str):
+        """使用者有新活動時延後其統整工作"""
+        with self._lock:
+            job = self._pending.get((character_id, user_id))
+            if job is not None:
+                job.last_activity = time.monotonic()
+
+    def _is_off_peak(self, config: dict) -> bool:
+        start, end = config['off_peak_hours']
+        hour = datetime.now(ZoneInfo(config['timezone'])).hour
+        return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+    def _take_due_jobs(self, characters: Set[str], config: dict, memory_limit: int) -> List[Tuple[Tuple[str, str], PendingConsolidation]]:
+        """取出到期的工作（使用者閒置、離峰時段，或記憶已超過上限兩倍）"""
+        now = time.monotonic()
+        idle_seconds = config['idle_minutes'] * 60
+        off_peak = self._is_off_peak(config)
+        due = []
+        with self._lock:
+            for key, job in list(self._pending.items()):
+                if self._running >= config['max_concurrent_jobs']:
+                    break
+                if key[0] not in characters:
+                    continue
+                if off_peak or now - job.last_activity >= idle_seconds or job.memory_count > memory_limit * 2:
+                    del self._pending[key]
+                    self._running += 1
+                    due.append((key, job))
+        return due
+
+    async def _run_job(self, key: Tuple[str, str], job: PendingConsolidation, config: dict):
+        import memory
+        character_id, user_id = key
+        try:
+            with usage_scope(character_id, user_id):
+                success = await memory.consolidate_user_memories(
+                    character_id, user_id, job.user_name,
+                    keep_recent=config['keep_recent'], mid_term_limit=config['mid_term_limit']
+                )
+            with self._lock:
+                if success:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+        except LLMSchedulerOverloaded:
+            # Gemini 排程過載時放回佇列，稍後再統整
+            self.schedule(character_id, user_id, job.user_name, job.memory_count)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            self.firebase.log_error(f"統整 {character_id} - {user_id} 記憶", e)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    async def _run(self, loop: asyncio.AbstractEventLoop):
+        """排程迴圈：只處理在此事件迴圈上運行的角色"""
+        while True:
+            config = self.get_config()
+            await asyncio.sleep(config['check_interval'])
+            try:
+                with self._lock:
+                    characters = {cid for cid, owner in self._owners.items() if owner is loop}
+                for key, job in self._take_due_jobs(characters, config, self.firebase.get_memory_limit()):
+                    print(f"🗂️ 背景統整記憶：{key[0]} - {key[1]}")
+                    task = asyncio.create_task(self._run_job(key, job, config))
+                    with self._lock:
+                        self._jobs.add(task)
+                    task.add_done_callback(self._discard_job)
+            except Exception as e:
+                self.firebase.log_error("記憶統整排程", e)
+
+    def _discard_job(self, task: asyncio.Task):
+        with self._lock:
+            self._jobs.discard(task)
+
+    def start(self, character_id: str):
+        """在目前的事件迴圈上啟動排程（重複呼叫不會建立多個排程）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._owners[character_id] = loop
+            runner = self._runners.get(loop)
+            if runner is None or runner.done():
+                self._runners[loop] = loop.create_task(self._run(loop))
+
+    def stats(self) -> Dict[str, int]:
+        """排程統計資訊"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'running': self._running,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+
+# 全域記憶統整排程器實例
+consolidation_scheduler = MemoryConsolidationScheduler()
+
+def start_consolidation_scheduler(character_id: str):
+    """在目前的事件迴圈上啟動記憶統整排程"""
+    consolidation_scheduler.start(character_id)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+記憶向量索引模組
+為每個角色維護本地的記憶向量索引（NumPy memmap），依目前訊息檢索最相關的記憶
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # numpy 未安裝時退回「最近記憶」模式
+    np = None
+
+# 常數定義
+DEFAULT_INDEX_DIR = os.getenv("MEMORY_INDEX_DIR", "memory_index")  # 索引檔案根目錄
+DEFAULT_EMBEDDING_MODEL = 'models/text-embedding-004'  # 預設嵌入模型
+INITIAL_CAPACITY = 64  # 索引初始容量（列數）
+
+
+def memory_digest(text: str) -> str:
+    """計算記憶文字的摘要，作為索引鍵"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class HashingEmbedder:
+    """離線嵌入器：以字元 n-gram 特徵雜湊產生向量，不需網路（供測試與備援使用）"""
+
+    def __init__(self, dim: int = 256, ngram: int = 2):
+        self.dim = dim
+        self.ngram = ngram
+        self.name = f"hashing-{dim}-{ngram}"
+
+    def embed(self, texts: Sequence[str]):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            lowered = text.lower()
+            for n in range(1, self.ngram + 1):
+                for i in range(len(lowered) - n + 1):
+                    digest = hashlib.blake2b(lowered[i:i + n].encode('utf-8'), digest_size=8).digest()
+                    value = int.from_bytes(digest, 'little')
+                    sign = 1.0 if value >> 63 else -1.0
+                    vectors[row, value % self.dim] += sign
+        return vectors
+
+
+class GeminiEmbedder:
+    """使用 Gemini embedding API 的嵌入器"""
+
+    def __init__(self, model: str = DEFAULT_EMBEDDING_MODEL, dim: Optional[int] = None):
+        self.model = model
+        self.dim = dim
+        self.name = f"gemini-{model}-{dim or 'full'}"
+
+    def embed(self, texts: Sequence[str]):
+        import google.generativeai as genai
+        result = genai.embed_content(model=self.model, content=list(texts), output_dimensionality=self.dim)  # type: ignore
+        return np.asarray(result['embedding'], dtype=np.float32)
+
+
+class CharacterMemoryIndex:
+    """單一角色的記憶向量索引，向量儲存在 memory-mapped 的 .npy 檔案中"""
+
+    def __init__(self, character_id: str, index_dir: str, embedder):
+        self.character_id = character_id
+        self.embedder = embedder
+        self.path = os.path.join(index_dir, character_id)
+        self._vectors_path = os.path.join(self.path, 'vectors.npy')
+        self._meta_path = os.path.join(self.path, 'meta.json')
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._dim = 0
+        self._count = 0  # 已使用的列數（含失效列）
+        self._rows: Dict[str, int] = {}  # {user_id:digest: row}
+        self._load()
+
+    def _load(self):
+        """載入既有索引；嵌入器不同時捨棄舊索引"""
+        if not (os.path.exists(self._meta_path) and os.path.exists(self._vectors_path)):
+            return
+        try:
+            with open(self._meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('embedder') != self.embedder.name:
+                print(f"🔄 {self.character_id} 的記憶索引嵌入器已變更，將重新建立索引")
+                return
+            self._vectors = np.load(self._vectors_path, mmap_mode='r+')
+            self._dim = int(meta['dim'])
+            self._count = int(meta['count'])
+            self._rows = {key: row for key, row in meta['rows'].items()}
+        except Exception as e:
+            print(f"❌ 載入 {self.character_id} 記憶索引失敗，將重新建立：{e}")
+            self._vectors = None
+            self._dim = self._count = 0
+            self._rows = {}
+
+    def _save_meta(self):
+        meta = {'embedder': self.embedder.name, 'dim': self._dim, 'count': self._count, 'rows': self._rows}
+        tmp_path = f"{self._meta_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self._meta_path)
+
+    def _allocate(self, capacity: int):
+        """配置新的 memmap 檔案，只搬移仍有效的列（順便壓縮失效列）"""
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self._vectors_path}.tmp.npy"
+        vectors = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, self._dim))
+        rows = {}
+        for new_row, (key, old_row) in enumerate(sorted(self._rows.items(), key=lambda item: item[1])):
+            vectors[new_row] = self._vectors[old_row]
+            rows[key] = new_row
+        vectors.flush()
+        del vectors
+        self._vectors = None
+        os.replace(tmp_path, self._vectors_path)
+        self._vectors = np.load(self._vectors_path, mmap_mode='r+')
+        self._rows = rows
+        self._count = len(rows)
+
+    def _append(self, keys: List[str], vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+        if self._vectors is None:
+            self._dim = vectors.shape[1]
+            self._rows = {}
+            self._count = 0
+            self._allocate(max(INITIAL_CAPACITY, len(keys)))
+        elif self._count + len(keys) > self._vectors.shape[0]:
+            capacity = self._vectors.shape[0]
+            while len(self._rows) + len(keys) > capacity // 2:
+                capacity *= 2
+            self._allocate(capacity)
+        start = self._count
+        self._vectors[start:start + len(keys)] = vectors
+        for offset, key in enumerate(keys):
+            self._rows[key] = start + offset
+        self._count += len(keys)
+        self._vectors.flush()
+        self._save_meta()
+
+    def sync_user(self, user_id: str, memories: Sequence[str]) -> List[int]:
+        """確保使用者的每則記憶都已嵌入（每則只嵌入一次），返回對應的列號"""
+        with self._lock:
+            keys = [f"{user_id}:{memory_digest(text)}" for text in memories]
+            current = set(keys)
+            prefix = f"{user_id}:"
+            # 已被統整或刪除的記憶標記為失效，下次擴容時壓縮掉
+            stale = [key for key in self._rows if key.startswith(prefix) and key not in current]
+            for key in stale:
+                del self._rows[key]
+
+            missing = list(dict.fromkeys(key for key in keys if key not in self._rows))
+            if missing:
+                texts = {key: text for key, text in zip(keys, memories)}
+                self._append(missing, self.embedder.embed([texts[key] for key in missing]))
+            elif stale:
+                self._save_meta()
+
+            return [self._rows[key] for key in keys]
+
+    def score(self, rows: List[int], query_vector) -> List[float]:
+        """計算指定列與查詢向量的餘弦相似度"""
+        with self._lock:
+            matrix = self._vectors[rows]
+        norm = float(np.linalg.norm(query_vector))
+        if norm == 0.0:
+            return [0.0] * len(rows)
+        return (matrix @ (query_vector / norm)).tolist()
+
+
+class MemoryRetriever:
+    """依相關性排序記憶：取前 top_k 則最相關記憶，再加上最近幾則"""
+
+    def __init__(self, embedder=None, index_dir: str = DEFAULT_INDEX_DIR):
+        self.index_dir = index_dir
+        self._embedder = embedder
+        self._indexes: Dict[str, CharacterMemoryIndex] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        """numpy 是否可用"""
+        return np is not None
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            self._embedder = GeminiEmbedder() if os.getenv("GOOGLE_API_KEY") else HashingEmbedder()
+        return self._embedder
+
+    def set_embedder(self, embedder):
+        """替換嵌入器（例如測試時改用離線的 HashingEmbedder）"""
+        with self._lock:
+            self._embedder = embedder
+            self._indexes.clear()
+
+    def get_index(self, character_id: str) -> CharacterMemoryIndex:
+        with self._lock:
+            if character_id not in self._indexes:
+                self._indexes[character_id] = CharacterMemoryIndex(character_id, self.index_dir, self.embedder)
+            return self._indexes[character_id]
+
+    def rank(self, character_id: str, user_id: str, memories: List[str], query: str,
+             top_k: int = 5, recent: int = 3) -> List[str]:
+        """返回最相關的 top_k 則記憶加上最近 recent 則記憶（保持原本的時間順序）"""
+        top_k, recent = max(top_k, 0), max(recent, 0)
+        if len(memories) <= top_k + recent or not query.strip():
+            # 不用 memories[-n:]：n 為 0 時會返回整個列表
+            return memories[max(len(memories) - top_k - recent, 0):]
+
+        index = self.get_index(character_id)
+        rows = index.sync_user(user_id, memories)
+
+        split = len(memories) - recent
+        query_vector = self.embedder.embed([query])[0]
+        scores = index.score(rows[:split], query_vector)
+
+        best = sorted(range(split), key=lambda i: scores[i], reverse=True)[:top_k]
+        return [memories[i] for i in sorted(best)] + memories[split:]
+
+
+# 全域記憶檢索器實例
+memory_retriever = MemoryRetriever()
+
+def set_memory_embedder(embedder):
+    """替換記憶檢索使用的嵌入器"""
+    memory_retriever.set_embedder(embedder)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+訊息複雜度分級模組
+依訊息長度、提問數、對話型態與上下文長度評分，對應到不同的模型與輸出長度
+"""
+
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional
+from model_router import estimate_cost
+
+# 常數定義
+QUESTION_PATTERN = re.compile(r'[?？]|嗎|呢|什麼|為什麼|怎麼|如何|哪')
+LENGTH_STEPS = (10, 40, 120, 300)  # 訊息長度分段（字元）
+CONTEXT_STEP = 1500  # 上下文每多少字元加一分
+MAX_CONTEXT_SCORE = 2
+
+
+class MessageComplexity(NamedTuple):
+    """訊息分級結果"""
+    score: float
+    tier: str
+    model: Optional[str]
+    max_output_tokens: Optional[int]
+
+
+def score_message(text: str, is_dm: bool = False, is_mention: bool = False, context_length: int = 0) -> float:
+    """計算訊息複雜度分數（純本地計算，不呼叫 API）"""
+    length = len(text.strip())
+    score = float(sum(1 for step in LENGTH_STEPS if length > step))
+    score += min(len(QUESTION_PATTERN.findall(text)), 3)
+    if is_dm:
+        score += 1
+    if is_mention:
+        score += 1
+    score += min(context_length // CONTEXT_STEP, MAX_CONTEXT_SCORE)
+    return score
+
+
+def classify_message(text: str, tiers: List[dict], is_dm: bool = False, is_mention: bool = False,
+                     context_length: int = 0) -> MessageComplexity:
+    """依 gemini_config.complexity_tiers 將訊息對應到分級；沒有符合的分級時沿用角色預設模型"""
+    score = score_message(text, is_dm, is_mention, context_length)
+    for tier in tiers:
+        max_score = tier.get('max_score')
+        if max_score is None or score <= max_score:
+            return MessageComplexity(score, tier.get('name', 'tier'), tier.get('model'), tier.get('max_output_tokens'))
+    return MessageComplexity(score, 'default', None, None)
+
+
+class ComplexityTierStats:
+    """各分級的延遲與成本統計"""
+
+    def __init__(self):
+        self._stats: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, tier: str, model_name: str, latency: float, usage_metadata=None):
+        """記錄一次回應並輸出該次的延遲與成本"""
+        input_tokens = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+        output_tokens = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+        cost = estimate_cost(model_name, input_tokens, output_tokens)
+        with self._lock:
+            stats = self._stats.setdefault(tier, {'count': 0, 'latency': 0.0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0})
+            stats['count'] += 1
+            stats['latency'] += latency
+            stats['input_tokens'] += input_tokens
+            stats['output_tokens'] += output_tokens
+            stats['cost'] += cost
+        print(f"📊 分級 {tier}（{model_name}）：{latency:.2f} 秒，輸入 {input_tokens} / 輸出 {output_tokens} tokens，約 ${cost:.5f}")
+
+    def summary(self) -> Dict[str, dict]:
+        """各分級的平均延遲與累計成本"""
+        with self._lock:
+            return {
+                tier: {
+                    'count': stats['count'],
+                    'avg_latency': stats['latency'] / stats['count'],
+                    'input_tokens': stats['input_tokens'],
+                    'output_tokens': stats['output_tokens'],
+                    'cost': stats['cost'],
+                }
+                for tier, stats in self._stats.items()
+            }
+
+
+# 全域分級統計實例
+complexity_tier_stats = ComplexityTierStats()
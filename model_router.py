@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Gemini 模型路由模組
+追蹤各模型的延遲與錯誤率，支援對沖請求、重試退避與斷路器
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 常數定義
+DEFAULT_ROUTING_POLICY = {
+    'fallback_models': ['gemini-2.0-flash'],  # 依序使用的備援模型
+    'hedge_after_ms': None,           # 超過此時間未回應即對備援模型送出對沖請求；None 表示使用主模型的 p95
+    'default_hedge_after_ms': 8000,   # 樣本不足時的對沖門檻
+    'max_retries': 2,                 # 遇到 429/5xx 時的重試次數
+    'backoff_base_ms': 500,
+    'backoff_max_ms': 4000,
+    'breaker_failure_threshold': 5,   # 連續失敗幾次後斷路
+    'breaker_cooldown_s': 60,         # 斷路後多久允許試探請求
+    'demote_error_rate': 0.5,         # 滾動錯誤率超過此值的模型排到候選清單最後
+}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# 各模型每百萬 tokens 的價格（美元）：(輸入, 輸出)
+MODEL_PRICING = {
+    'gemini-2.5-pro': (1.25, 10.0),
+    'gemini-2.5-flash': (0.30, 2.50),
+    'gemini-2.5-flash-lite': (0.10, 0.40),
+    'gemini-2.0-flash': (0.10, 0.40),
+    'gemini-2.0-flash-lite': (0.075, 0.30),
+}
+STATS_WINDOW = 100  # 統計的滾動視窗大小
+MIN_SAMPLES_FOR_P95 = 10
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """判斷錯誤是否為可重試的 429/5xx 或逾時"""
+    code = getattr(error, 'code', None)
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return True
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+def estimate_cost(model_name: str, input_tokens: int, output_tokens: int) -> float:
+    """依 MODEL_PRICING 估算一次呼叫的費用（美元），未知模型視為 0"""
+    input_price, output_price = MODEL_PRICING.get(model_name, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+class CircuitBreaker:
+    """簡單的斷路器：closed → open → half-open（每次冷卻後只放行一個試探請求）"""
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def is_available(self, cooldown: float) -> bool:
+        """是否可以送出請求（不改變狀態，用於排序候選模型）"""
+        if self.state == 'closed':
+            return True
+        if self.probe_in_flight:
+            return False
+        return self.state == 'half-open' or time.monotonic() - self.opened_at >= cooldown
+
+    def acquire(self, cooldown: float) -> bool:
+        """實際送出請求前呼叫；斷路中冷卻結束時登記唯一的試探請求"""
+        if not self.is_available(cooldown):
+            return False
+        if self.state != 'closed':
+            self.state = 'half-open'
+            self.probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self, threshold: int):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def release_probe(self):
+        """試探請求以非暫時性錯誤結束時釋放名額，下一個請求可以再試探"""
+        self.probe_in_flight = False
+
+
+class ModelStats:
+    """單一模型的滾動延遲與錯誤統計"""
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self.latencies = deque(maxlen=window)  # 成功請求的延遲（秒）
+        self.outcomes = deque(maxlen=window)   # True 表示失敗
+        self.breaker = CircuitBreaker()
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class ModelRouter:
+    """Gemini 模型路由器（所有角色共用）"""
+
+    def __init__(self):
+        self._stats: Dict[str, ModelStats] = {}
+        self._lock = threading.Lock()  # 統計會在 to_thread 的工作執行緒中更新
+
+    def _get_stats(self, model_name: str) -> ModelStats:
+        stats = self._stats.get(model_name)
+        if stats is None:
+            stats = self._stats[model_name] = ModelStats()
+        return stats
+
+    def get_policy(self, gemini_config: Optional[dict]) -> dict:
+        """合併預設策略與角色 gemini_config.routing 設定"""
+        policy = DEFAULT_ROUTING_POLICY.copy()
+        if gemini_config:
+            policy.update(gemini_config.get('routing') or {})
+        return policy
+
+    def record(self, model_name: str, latency: float, error: Optional[Exception], policy: dict):
+        """記錄一次呼叫的結果"""
+        with self._lock:
+            stats = self._get_stats(model_name)
+            stats.outcomes.append(error is not None)
+            if error is None:
+                stats.latencies.append(latency)
+                stats.breaker.record_success()
+            elif is_retryable_error(error):
+                previous_state = stats.breaker.state
+                stats.breaker.record_failure(policy['breaker_failure_threshold'])
+                if stats.breaker.state == 'open' and previous_state != 'open':
+                    print(f"⚡ 模型 {model_name} 連續失敗，暫停使用 {policy['breaker_cooldown_s']} 秒")
+            else:
+                stats.breaker.release_probe()
+
+    def _is_available(self, model_name: str, policy: dict) -> bool:
+        with self._lock:
+            return self._get_stats(model_name).breaker.is_available(policy['breaker_cooldown_s'])
+
+    def _acquire(self, model_name: str, policy: dict) -> bool:
+        """只在實際送出請求的模型上呼叫"""
+        with self._lock:
+            return self._get_stats(model_name).breaker.acquire(policy['breaker_cooldown_s'])
+
+    def _order_candidates(self, model_names: List[str], policy: dict) -> List[str]:
+        """可用的候選模型；滾動錯誤率過高（且樣本足夠）的模型排到最後"""
+        with self._lock:
+            available = []
+            for name in dict.fromkeys(model_names):
+                stats = self._get_stats(name)
+                if stats.breaker.is_available(policy['breaker_cooldown_s']):
+                    demoted = len(stats.outcomes) >= MIN_SAMPLES_FOR_P95 and stats.error_rate > policy['demote_error_rate']
+                    available.append((demoted, name))
+        return [name for _, name in sorted(available, key=lambda item: item[0])]
+
+    def _next_candidate(self, remaining: List[str], policy: dict) -> Optional[str]:
+        """依序取出下一個能取得斷路器名額的模型"""
+        while remaining:
+            name = remaining.pop(0)
+            if self._acquire(name, policy):
+                return name
+        return None
+
+    def _hedge_threshold(self, model_name: str, policy: dict) -> float:
+        """對沖門檻（秒）：優先使用設定值，其次是主模型的 p95"""
+        if policy.get('hedge_after_ms'):
+            return policy['hedge_after_ms'] / 1000
+        with self._lock:
+            stats = self._get_stats(model_name)
+            p95 = stats.percentile(0.95) if len(stats.latencies) >= MIN_SAMPLES_FOR_P95 else None
+        return p95 if p95 is not None else policy['default_hedge_after_ms'] / 1000
+
+    def _timed_call(self, model_name: str, model, prompt, policy: dict,
+                    on_usage: Optional[Callable[[str, object], None]] = None):
+        """在工作執行緒中呼叫模型並記錄延遲與用量（即使等待端已取消也會記錄，對沖、重試與備援呼叫都會計費）"""
+        start = time.perf_counter()
+        try:
+            response = model.generate_content(prompt)
+        except Exception as e:
+            self.record(model_name, time.perf_counter() - start, e, policy)
+            raise
+        self.record(model_name, time.perf_counter() - start, None, policy)
+        if on_usage is not None:
+            on_usage(model_name, getattr(response, 'usage_metadata', None))
+        return response
+
+    async def _call_with_retry(self, model_name: str, model_factory: Callable, prompt, policy: dict,
+                               on_usage: Optional[Callable[[str, object], None]] = None):
+        """呼叫單一模型，遇到 429/5xx 時以指數退避重試"""
+        model = model_factory(model_name)
+        for attempt in range(policy['max_retries'] + 1):
+            try:
+                return await asyncio.to_thread(self._timed_call, model_name, model, prompt, policy, on_usage)
+            except Exception as e:
+                if not is_retryable_error(e) or attempt == policy['max_retries'] or not self._is_available(model_name, policy):
+                    raise
+                delay = min(policy['backoff_base_ms'] * (2 ** attempt), policy['backoff_max_ms']) / 1000
+                print(f"🔁 模型 {model_name} 回應錯誤（{e}），{delay:.1f} 秒後重試")
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+    async def generate(self, prompt, model_names: List[str], model_factory: Callable,
+                       policy: Optional[dict] = None,
+                       on_usage: Optional[Callable[[str, object], None]] = None) -> Tuple[object, str]:
+        """依策略生成內容，返回（回應, 實際使用的模型名稱）
+
+        on_usage(模型名稱, usage_metadata) 會在每次成功的 generate_content 後於工作執行緒中呼叫，
+        包含對沖、重試、備援與等待端已取消的呼叫（目前的 usage_scope 會隨 to_thread 傳遞）
+        """
+        policy = policy or DEFAULT_ROUTING_POLICY
+        remaining = self._order_candidates(model_names, policy)
+        # 所有模型都在斷路中時仍以第一個模型嘗試
+        primary = self._next_candidate(remaining, policy) or model_names[0]
+        tasks = {asyncio.create_task(self._call_with_retry(primary, model_factory, prompt, policy, on_usage)): primary}
+        last_error: Optional[BaseException] = None
+        try:
+            # 主模型超過門檻仍未回應時，對下一個模型送出對沖請求
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_threshold(primary, policy))
+            hedge = self._next_candidate(remaining, policy) if not done else None
+            if hedge:
+                print(f"🏃 模型 {primary} 回應過慢，對沖請求 {hedge}")
+                tasks[asyncio.create_task(self._call_with_retry(hedge, model_factory, prompt, policy, on_usage))] = hedge
+
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    model_name = tasks.pop(task)
+                    if task.exception() is None:
+                        return task.result(), model_name
+                    last_error = task.exception()
+                    print(f"⚠️ 模型 {model_name} 生成失敗：{last_error}")
+
+                # 全部失敗時依序改用備援模型
+                fallback = self._next_candidate(remaining, policy) if not tasks else None
+                if fallback:
+                    tasks[asyncio.create_task(self._call_with_retry(fallback, model_factory, prompt, policy, on_usage))] = fallback
+
+            raise last_error or RuntimeError("沒有可用的模型")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict[str, dict]:
+        """各模型的 p50/p95 延遲、錯誤率與斷路器狀態"""
+        with self._lock:
+            return {
+                name: {
+                    'p50': stats.percentile(0.5),
+                    'p95': stats.percentile(0.95),
+                    'error_rate': stats.error_rate,
+                    'samples': len(stats.outcomes),
+                    'breaker': stats.breaker.state,
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+# 全域模型路由器實例
+model_router = ModelRouter()
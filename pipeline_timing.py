@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+訊息處理階段計時模組
+記錄 handle_message 各階段（記憶讀取、配置解析、群組上下文、生成、回覆）的耗時與端到端延遲
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Dict, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class PipelineTimer:
+    """單次訊息處理的階段計時（階段可並行，總耗時以實際經過時間計算）"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        """等待並記錄一個可與其他階段並行的工作"""
+        with self.stage(name):
+            return await awaitable
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def format(self) -> str:
+        parts = [f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.stages.items()]
+        return " | ".join(parts + [f"總計 {self.total * 1000:.0f}ms"])
+
+
+class PipelineStats:
+    """各階段與端到端延遲的累計統計（所有角色共用）"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, timer: PipelineTimer, label: Optional[str] = None):
+        """記錄一次處理並輸出各階段耗時"""
+        durations = dict(timer.stages, total=timer.total)
+        with self._lock:
+            for name, seconds in durations.items():
+                stats = self._stats.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+                stats['count'] += 1
+                stats['seconds'] += seconds
+                stats['max'] = max(stats['max'], seconds)
+        print(f"⏱️ {label + '：' if label else ''}{timer.format()}")
+
+    def summary(self) -> Dict[str, dict]:
+        """各階段的平均與最大耗時（毫秒）"""
+        with self._lock:
+            return {
+                name: {
+                    'count': stats['count'],
+                    'avg_ms': stats['seconds'] / stats['count'] * 1000,
+                    'max_ms': stats['max'] * 1000,
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+# 全域階段統計實例
+pipeline_stats = PipelineStats()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+訊息速率限制模組
+以 token bucket 對每位使用者、頻道與伺服器做准入控制，超過限制的訊息在進入生成流程前直接略過
+"""
+
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from firebase_utils import firebase_manager
+
+# 常數定義
+DEFAULT_RATE_LIMITS = {
+    'user': {'capacity': 5, 'refill_per_minute': 6},      # 每位使用者可連續觸發 5 次，之後每 10 秒恢復 1 次
+    'channel': {'capacity': 15, 'refill_per_minute': 20},
+    'guild': {'capacity': 40, 'refill_per_minute': 60},
+}
+PRUNE_INTERVAL = 300  # 清除閒置 bucket 的間隔（秒）
+
+
+class TokenBucket:
+    """單一 token bucket"""
+
+    __slots__ = ('tokens', 'updated_at')
+
+    def __init__(self, capacity: float, now: float):
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, capacity: float, rate: float, now: float):
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+
+class RateLimiter:
+    """每個角色的使用者／頻道／伺服器速率限制（所有角色共用一個實例）"""
+
+    def __init__(self):
+        self.firebase = firebase_manager
+        self._buckets: Dict[Tuple[str, str, str], TokenBucket] = {}  # {(character_id, 範圍, ID): bucket}
+        self._counters: Dict[str, Dict[str, int]] = {}  # {character_id: {'allowed': n, 'dropped_user': n, ...}}
+        self._lock = threading.Lock()  # 各角色 Bot 在不同執行緒的事件迴圈中呼叫
+        self._last_prune = time.monotonic()
+
+    def get_limits(self, character_id: str) -> Dict[str, dict]:
+        """合併預設值與角色 system.rate_limit 設定；未設定 rate_limit 或 enabled 為 false 時全部不限制，設為 null 的範圍不限制"""
+        limits = {scope: config.copy() for scope, config in DEFAULT_RATE_LIMITS.items()}
+        overrides = self.firebase.get_character_system_config(character_id).get('rate_limit') or {}
+        # 沒有設定 rate_limit 的角色維持原本的行為，不套用預設限制
+        limits['enabled'] = bool(overrides) and overrides.get('enabled', True)
+        for scope, config in overrides.items():
+            if scope not in DEFAULT_RATE_LIMITS:
+                continue
+            if config is None:
+                limits[scope] = None
+            else:
+                limits[scope].update(config)
+        return limits
+
+    def allow(self, character_id: str, user_id: str, channel_id: Optional[str] = None,
+              guild_id: Optional[str] = None) -> bool:
+        """檢查並消耗各範圍的 token；任一範圍不足時不消耗並返回 False"""
+        limits = self.get_limits(character_id)
+        if not limits['enabled']:
+            return True
+        scopes = [('user', user_id), ('channel', channel_id), ('guild', guild_id)]
+        now = time.monotonic()
+
+        with self._lock:
+            counters = self._counters.setdefault(character_id, {'allowed': 0})
+            checked = []
+            for scope, scope_id in scopes:
+                config = limits.get(scope)
+                if scope_id is None or not config:
+                    continue
+                capacity = float(config['capacity'])
+                key = (character_id, scope, str(scope_id))
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(capacity, now)
+                else:
+                    bucket.refill(capacity, config['refill_per_minute'] / 60, now)
+                if bucket.tokens < 1:
+                    counters[f'dropped_{scope}'] = counters.get(f'dropped_{scope}', 0) + 1
+                    return False
+                checked.append(bucket)
+
+            # 所有範圍都有 token 才一起扣除，避免被擋下的訊息消耗其他範圍的額度
+            for bucket in checked:
+                bucket.tokens -= 1
+            counters['allowed'] += 1
+
+            if now - self._last_prune >= PRUNE_INTERVAL:
+                self._prune(now)
+        return True
+
+    def _prune(self, now: float):
+        """移除閒置超過清除間隔的 bucket，避免記錄每一位出現過的使用者（呼叫端需持有鎖）"""
+        self._last_prune = now
+        stale = [key for key, bucket in self._buckets.items() if now - bucket.updated_at >= PRUNE_INTERVAL]
+        for key in stale:
+            del self._buckets[key]
+
+    def stats(self, character_id: Optional[str] = None) -> Dict[str, dict]:
+        """各角色的放行與各範圍略過次數"""
+        with self._lock:
+            if character_id is not None:
+                return {character_id: dict(self._counters.get(character_id, {'allowed': 0}))}
+            return {cid: dict(counters) for cid, counters in self._counters.items()}
+
+
+# 全域速率限制實例
+rate_limiter = RateLimiter()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+時間輪模組
+依到期時間把鍵分到固定數量的時間桶，每次推進只處理已到期的桶，不需掃描所有項目
+"""
+
+import math
+from typing import Dict, Hashable, List
+
+
+class TimingWheel:
+    """雜湊時間輪
+
+    每個鍵只會出現在一個時間桶中；到期時間超過一整圈的鍵會留在桶內，等轉到對應的圈數才取出。
+    鍵被取出後由呼叫端檢查實際狀態，仍未過期時再以新的到期時間重新排入（延遲更新，活動時不需移動鍵）。
+    """
+
+    def __init__(self, tick: float, horizon: float, now: float):
+        self.tick = tick
+        self._buckets: List[Dict[Hashable, int]] = [{} for _ in range(max(1, math.ceil(horizon / tick)) + 1)]
+        self._slots: Dict[Hashable, int] = {}  # {鍵: 到期的 tick}
+        self._current = int(now // tick)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._slots
+
+    def schedule(self, key: Hashable, deadline: float):
+        """排入（或改排）鍵的到期時間"""
+        target = max(int(deadline // self.tick), self._current + 1)
+        previous = self._slots.get(key)
+        if previous is not None:
+            self._buckets[previous % len(self._buckets)].pop(key, None)
+        self._slots[key] = target
+        self._buckets[target % len(self._buckets)][key] = target
+
+    def cancel(self, key: Hashable):
+        target = self._slots.pop(key, None)
+        if target is not None:
+            self._buckets[target % len(self._buckets)].pop(key, None)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """推進到目前時間，取出所有已到期的鍵"""
+        now_tick = int(now // self.tick)
+        due = []
+        # 落後超過一整圈時每個桶只需處理一次
+        for tick in range(max(self._current + 1, now_tick - len(self._buckets) + 1), now_tick + 1):
+            bucket = self._buckets[tick % len(self._buckets)]
+            expired = [key for key, target in bucket.items() if target <= now_tick]
+            for key in expired:
+                del bucket[key]
+                del self._slots[key]
+            due.extend(expired)
+        self._current = max(self._current, now_tick)
+        return due
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+輸入中預取模組
+使用者開始輸入時預先載入其記憶與角色配置，讓稍後送出的訊息直接命中快取，並統計預取命中率與節省的延遲
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+# 常數定義
+PREFETCH_WINDOW = 60  # 最後一次輸入後多久內送出訊息算是命中（秒）
+MAX_KNOWN_USERS = 4096  # 記住曾與角色對話過的使用者數上限
+
+
+class TypingPrefetcher:
+    """輸入中預取的去重與統計（所有角色共用）"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[str, str], Tuple[float, float]] = {}  # {(角色, 使用者): (預取時間, 預取耗時)}
+        self._known_users: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+        self._lock = threading.Lock()  # 各角色 Bot 在不同執行緒的事件迴圈中呼叫
+        self.prefetches = 0
+        self.hits = 0
+        self.wasted = 0
+        self.saved_seconds = 0.0
+
+    def remember_user(self, character_id: str, user_id: str):
+        """記錄曾與角色對話過的使用者"""
+        key = (character_id, user_id)
+        with self._lock:
+            self._known_users[key] = None
+            self._known_users.move_to_end(key)
+            while len(self._known_users) > MAX_KNOWN_USERS:
+                self._known_users.popitem(last=False)
+
+    def is_known_user(self, character_id: str, user_id: str) -> bool:
+        with self._lock:
+            return (character_id, user_id) in self._known_users
+
+    def begin(self, character_id: str, user_id: str) -> bool:
+        """登記一次預取；已有尚未使用的預取時只延長等待時間並返回 False"""
+        now = time.monotonic()
+        key = (character_id, user_id)
+        with self._lock:
+            self._expire(now)
+            pending = self._pending.get(key)
+            if pending is not None:
+                # 持續輸入會重複觸發事件，記憶已在快取中，不需再次載入
+                self._pending[key] = (now, pending[1])
+                return False
+            self._pending[key] = (now, 0.0)
+            self.prefetches += 1
+            return True
+
+    def finish(self, character_id: str, user_id: str, seconds: float):
+        """記錄預取耗時（即訊息送出時可省下的載入時間）"""
+        key = (character_id, user_id)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                self._pending[key] = (pending[0], seconds)
+
+    def consume(self, character_id: str, user_id: str) -> bool:
+        """使用者送出訊息時呼叫；有尚未過期的預取即算命中"""
+        now = time.monotonic()
+        key = (character_id, user_id)
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if pending is None:
+                return False
+            if now - pending[0] > PREFETCH_WINDOW:
+                self.wasted += 1
+                return False
+            self.hits += 1
+            self.saved_seconds += pending[1]
+            return True
+
+    def _expire(self, now: float):
+        """清除逾時未使用的預取（呼叫端需持有鎖）"""
+        expired = [key for key, (started_at, _) in self._pending.items() if now - started_at > PREFETCH_WINDOW]
+        for key in expired:
+            del self._pending[key]
+        self.wasted += len(expired)
+
+    def stats(self) -> Dict[str, float]:
+        """預取命中率與累計節省的延遲"""
+        with self._lock:
+            return {
+                'prefetches': self.prefetches,
+                'hits': self.hits,
+                'wasted': self.wasted,
+                'hit_rate': self.hits / self.prefetches if self.prefetches else 0.0,
+                'saved_ms': self.saved_seconds * 1000,
+                'avg_saved_ms': self.saved_seconds / self.hits * 1000 if self.hits else 0.0,
+            }
+
+
+# 全域預取實例
+typing_prefetcher = TypingPrefetcher()
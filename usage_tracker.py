@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Gemini 用量統計模組
+記錄每次 generate_content 的 token 用量，依角色、使用者、伺服器與提示詞類型彙整並批次寫入 Firestore，
+並依角色的每日預算決定是否改用較便宜的模型或略過記憶提取
+"""
+
+import atexit
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional, Set
+from zoneinfo import ZoneInfo
+from google.cloud import firestore
+from firebase_utils import firebase_manager
+from model_router import estimate_cost
+
+# 常數定義
+USAGE_COLLECTION = 'usage'  # 用量統計集合：usage/{日期}_{character_id}
+FLUSH_INTERVAL = 60  # 批次寫入間隔（秒）
+FLUSH_BATCH_SIZE = 50  # 累積多少筆紀錄就提早寫入
+USAGE_TIMEZONE = 'Asia/Taipei'  # 每日預算的日期切換時區
+DEFAULT_BUDGET = {
+    'daily_tokens': None,           # 每日 token 上限；None 表示不限制
+    'degrade_ratio': 0.8,           # 用量達上限的比例後改用 fallback_model
+    'fallback_model': 'gemini-2.0-flash',
+    'skip_memory_ratio': 1.0,       # 用量達上限的比例後略過記憶提取
+}
+
+
+class UsageScope(NamedTuple):
+    """用量歸屬（角色、使用者、伺服器）"""
+    character_id: Optional[str] = None
+    user_id: Optional[str] = None
+    guild_id: Optional[str] = None
+
+_usage_scope: ContextVar[UsageScope] = ContextVar('usage_scope', default=UsageScope())
+
+@contextmanager
+def usage_scope(character_id: Optional[str], user_id: Optional[str] = None, guild_id: Optional[str] = None):
+    """設定此區塊內 Gemini 呼叫的用量歸屬（會隨 asyncio task 與 to_thread 傳遞）"""
+    token = _usage_scope.set(UsageScope(character_id, user_id, guild_id))
+    try:
+        yield
+    finally:
+        _usage_scope.reset(token)
+
+def current_usage_scope() -> UsageScope:
+    """目前的用量歸屬"""
+    return _usage_scope.get()
+
+
+class UsageTracker:
+    """Gemini 用量統計與預算管理（所有角色共用）"""
+
+    def __init__(self):
+        self.firebase = firebase_manager
+        self._pending: Dict[str, dict] = {}  # {文件 ID: 待寫入的增量}
+        self._pending_records = 0
+        self._daily_tokens: Dict[tuple, int] = {}  # {(日期, character_id): tokens}
+        self._loaded_days: Set[tuple] = set()  # 已從 Firestore 載入今日用量的 (日期, character_id)
+        self._loading_days: Set[tuple] = set()  # 正在背景載入今日用量的 (日期, character_id)
+        self._flushed_tokens: Dict[tuple, int] = {}  # 本程序已寫入 Firestore 的用量，載入時避免重複計算
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    @property
+    def db(self):
+        """獲取 Firestore 資料庫實例"""
+        return self.firebase.db
+
+    def _today(self) -> str:
+        return datetime.now(ZoneInfo(USAGE_TIMEZONE)).strftime('%Y-%m-%d')
+
+    def record(self, prompt_type: str, model_name: str, usage_metadata, character_id: Optional[str] = None):
+        """記錄一次 generate_content 的 token 用量"""
+        if usage_metadata is None:
+            return
+        scope = _usage_scope.get()
+        character_id = scope.character_id or character_id or 'unknown'
+        input_tokens = getattr(usage_metadata, 'prompt_token_count', 0) or 0
+        output_tokens = getattr(usage_metadata, 'candidates_token_count', 0) or 0
+        cost = estimate_cost(model_name, input_tokens, output_tokens)
+        today = self._today()
+
+        usage = {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'calls': 1, 'cost': cost}
+        dimensions = [('by_prompt_type', prompt_type), ('by_model', model_name.replace('.', '_'))]
+        if scope.user_id:
+            dimensions.append(('by_user', scope.user_id))
+        if scope.guild_id:
+            dimensions.append(('by_guild', scope.guild_id))
+
+        with self._lock:
+            doc = self._pending.setdefault(f"{today}_{character_id}", {'date': today, 'character_id': character_id})
+            self._add(doc, usage)
+            for group, key in dimensions:
+                self._add(doc.setdefault(group, {}).setdefault(str(key), {}), usage)
+            daily_key = (today, character_id)
+            self._daily_tokens[daily_key] = self._daily_tokens.get(daily_key, 0) + input_tokens + output_tokens
+            self._pending_records += 1
+            should_flush = self._pending_records >= FLUSH_BATCH_SIZE
+
+        self._ensure_flusher()
+        if should_flush:
+            self._wakeup.set()
+
+    @staticmethod
+    def _add(target: dict, usage: dict):
+        for field, value in usage.items():
+            target[field] = target.get(field, 0) + value
+
+    def _to_increments(self, data: dict) -> dict:
+        """把累積的數值轉成 Firestore Increment，讓多個程序可以安全累加"""
+        return {
+            key: self._to_increments(value) if isinstance(value, dict)
+            else firestore.Increment(value) if isinstance(value, (int, float)) else value
+            for key, value in data.items()
+        }
+
+    def flush(self) -> int:
+        """將累積的用量以單一批次寫入 Firestore，返回寫入的文件數"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_records = 0
+        if not pending or not self.db:
+            return 0
+
+        try:
+            batch = self.db.batch()
+            for doc_id, data in pending.items():
+                batch.set(self.db.collection(USAGE_COLLECTION).document(doc_id), self._to_increments(data), merge=True)
+            batch.commit()
+            with self._lock:
+                for data in pending.values():
+                    daily_key = (data['date'], data['character_id'])
+                    self._flushed_tokens[daily_key] = (self._flushed_tokens.get(daily_key, 0)
+                                                       + data['input_tokens'] + data['output_tokens'])
+            return len(pending)
+        except Exception as e:
+            self.firebase.log_error("寫入 Gemini 用量", e)
+            # 寫入失敗時放回待寫入佇列，下次再試
+            with self._lock:
+                for doc_id, data in pending.items():
+                    self._merge(self._pending.setdefault(doc_id, {}), data)
+            return 0
+
+    def _merge(self, target: dict, data: dict):
+        for key, value in data.items():
+            if isinstance(value, dict):
+                self._merge(target.setdefault(key, {}), value)
+            elif isinstance(value, (int, float)):
+                target[key] = target.get(key, 0) + value
+            else:
+                target[key] = value
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='usage-flusher', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def get_budget(self, character_id: str) -> dict:
+        """獲取角色 system/budget 設定"""
+        budget = DEFAULT_BUDGET.copy()
+        budget.update(self.firebase.get_character_system_config(character_id).get('budget') or {})
+        return budget
+
+    def _load_daily_tokens(self, today: str, character_id: str) -> int:
+        """讀取今日已寫入 Firestore 的用量（重啟後只讀一次）"""
+        if not self.db:
+            return 0
+        try:
+            doc = self.db.collection(USAGE_COLLECTION).document(f"{today}_{character_id}").get()
+            data = doc.to_dict() if doc.exists else {}
+            return int(data.get('input_tokens', 0)) + int(data.get('output_tokens', 0))
+        except Exception as e:
+            self.firebase.log_error(f"讀取 {character_id} 今日用量", e)
+            return 0
+
+    def _load_in_background(self, daily_key: tuple):
+        """在背景執行緒載入今日已寫入的用量（每個 (日期, character_id) 同時只有一次讀取）"""
+        with self._lock:
+            if daily_key in self._loaded_days or daily_key in self._loading_days:
+                return
+            self._loading_days.add(daily_key)
+
+        def load():
+            try:
+                stored = self._load_daily_tokens(*daily_key)
+                with self._lock:
+                    self._loaded_days.add(daily_key)
+                    # 加上重啟前（或其他程序）已寫入 Firestore 的用量
+                    stored -= self._flushed_tokens.get(daily_key, 0)
+                    self._daily_tokens[daily_key] = self._daily_tokens.get(daily_key, 0) + max(stored, 0)
+            finally:
+                with self._lock:
+                    self._loading_days.discard(daily_key)
+
+        threading.Thread(target=load, name=f'usage-load-{daily_key[1]}', daemon=True).start()
+
+    def get_usage_ratio(self, character_id: str) -> float:
+        """今日用量佔預算的比例；未設定預算時為 0
+
+        在事件迴圈上呼叫，不直接讀取 Firestore：今日用量尚未載入時在背景載入，載入完成前只計算本程序的用量
+        """
+        budget = self.get_budget(character_id)
+        if not budget.get('daily_tokens'):
+            return 0.0
+        daily_key = (self._today(), character_id)
+        if daily_key not in self._loaded_days:
+            self._load_in_background(daily_key)
+        with self._lock:
+            used = self._daily_tokens.get(daily_key, 0)
+        return used / budget['daily_tokens']
+
+    def get_degraded_model(self, character_id: str) -> Optional[str]:
+        """用量接近預算時返回應改用的便宜模型，否則返回 None"""
+        budget = self.get_budget(character_id)
+        if budget.get('daily_tokens') and self.get_usage_ratio(character_id) >= budget['degrade_ratio']:
+            return budget['fallback_model']
+        return None
+
+    def should_skip_memory(self, character_id: str) -> bool:
+        """用量達預算時略過記憶提取"""
+        budget = self.get_budget(character_id)
+        return bool(budget.get('daily_tokens')) and self.get_usage_ratio(character_id) >= budget['skip_memory_ratio']
+
+
+# 全域用量統計實例
+usage_tracker = UsageTracker()
+atexit.register(usage_tracker.flush)